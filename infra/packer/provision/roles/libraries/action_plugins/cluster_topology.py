@@ -0,0 +1,86 @@
+# Use module_utils_loader to dynamically import module_utils from an action plugin
+try:
+    from ansible.module_utils.template_renderer import TemplateRenderer
+    from ansible.module_utils.topology import get_topology
+except ImportError:
+    from ansible.plugins.loader import module_utils_loader as ml
+
+    tr = ml._load_module_source('template_renderer', ml.find_plugin('template_renderer'))
+    tp = ml._load_module_source('topology', ml.find_plugin('topology'))
+
+    TemplateRenderer = tr.TemplateRenderer
+    get_topology = tp.get_topology
+
+
+class ActionModule(TemplateRenderer):
+    """
+    Publish the topology of the cluster as a fact, derived once from the inventory.
+    Run it once per play, the fact of a run_once task is set on every host of the play:
+
+    - name: derive the cluster topology
+      cluster_topology:
+        apps: [ /infra/vault ]
+        src: topology.json
+      run_once: true
+
+    Hosts then read `cluster_topology.zk_url`, `cluster_topology.master_quorum`, etc.
+    Without an odd number of masters, master_quorum is null and the task warns.
+    With `vracks`, the balanced vrack of every host is assigned once for the play, and
+    hosts read theirs from `cluster_topology.vracks[inventory_hostname]`.
+
+    Arguments:
+    - fact: name of the fact (default: cluster_topology)
+    - master_group: group of the master nodes (default: master)
+    - zk_port: ZooKeeper client port of the masters (default: 2181)
+    - apps: Marathon app names to derive URLs for
+    - vracks: amount of vracks to balance the hosts across, see the vrack_ids filter
+    - vrack_group: group of the hosts assigned a vrack (default: all)
+    - src: template in templates/topology, rendered with the `topology` variable,
+      whose keys are added to the topology
+    - parser: parser of the rendered template, json or yaml (default: json)
+    """
+
+    TRANSFERS_FILES = False
+
+    def run(self, tmp=None, task_vars=None):
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+
+        args = self._task.args
+        fact = args.get('fact', 'cluster_topology')
+
+        try:
+            topology = get_topology(
+                task_vars.get('groups', {}),
+                task_vars.get('hostvars'),
+                master_group=args.get('master_group', 'master'),
+                zk_port=args.get('zk_port', 2181),
+                apps=args.get('apps'),
+                vracks=args.get('vracks'),
+                vrack_group=args.get('vrack_group', 'all'),
+            )
+
+            src = args.get('src')
+            if src:
+                parser = args.get('parser', 'json')
+                srcfile = self._find_template(topdir='templates', subdir='topology', filename=src,
+                                              default_ext=parser)
+
+                # the cached topology is shared, add the template's keys to a copy
+                topology = dict(topology)
+                topology.update(self._render_template(task_vars, extra_vars={'topology': topology},
+                                                      srcfile=srcfile, parser=parser))
+        except (ValueError, NotImplementedError) as e:
+            result['failed'] = True
+            result['msg'] = 'cluster_topology: {}'.format(e)
+            return result
+
+        if topology.get('warning'):
+            result['warnings'] = ['cluster_topology: {}'.format(topology['warning'])]
+
+        result['changed'] = False
+        result['ansible_facts'] = {fact: topology}
+
+        return result
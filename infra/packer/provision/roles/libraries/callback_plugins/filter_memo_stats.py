@@ -0,0 +1,98 @@
+# the callbacks package has a json plugin, which an implicit relative import would load instead
+from __future__ import absolute_import
+
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+from ansible.plugins.callback import CallbackBase
+
+# Use module_utils_loader to dynamically import module_utils from a callback plugin
+try:
+    from ansible.module_utils import memoize
+except ImportError:
+    from ansible.plugins.loader import module_utils_loader as ml
+
+    memoize = ml._load_module_source('memoize', ml.find_plugin('memoize'))
+
+
+class CallbackModule(CallbackBase):
+    """
+    Print the hits and misses of the memoized filters at the end of every play.
+    Filters run in the forked workers, which write their counters to a folder when they
+    exit; the counters of the workers and of the main process are added up.
+
+    Enable it with ANSIBLE_CALLBACK_WHITELIST=filter_memo_stats and memoize the filters
+    with ANSIBLE_FILTER_MEMOIZE=1.
+    """
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'filter_memo_stats'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+
+        self.play = None
+        self.previous = {}
+
+        # the workers inherit the environment, and with it the folder of the counters
+        self.stats_dir = tempfile.mkdtemp(prefix='ansible-filter-memo-')
+        os.environ[memoize.MEMOIZE_STATS_ENV] = self.stats_dir
+
+    def _get_totals(self):
+        """
+        :return: the counters of the main process and of all the workers, by filter
+        :rtype: dict
+        """
+
+        totals = {}
+        counters = [memoize.get_stats()]
+
+        for stats_file in glob.glob(os.path.join(self.stats_dir, '*.json')):
+            try:
+                with open(stats_file, 'r') as f:
+                    counters.append(json.load(f))
+            except (IOError, ValueError):
+                # a worker that is still writing its counters is counted with the next play
+                continue
+
+        for stats in counters:
+            for name, counts in stats.items():
+                total = totals.setdefault(name, {'hits': 0, 'misses': 0, 'bypassed': 0})
+                for counter, value in counts.items():
+                    total[counter] += value
+
+        return totals
+
+    def _print_play_stats(self):
+        if self.play is None or not memoize.is_enabled():
+            return
+
+        totals = self._get_totals()
+
+        lines = []
+        for name in sorted(totals):
+            previous = self.previous.get(name, {})
+            counts = dict((c, v - previous.get(c, 0)) for c, v in totals[name].items())
+            calls = counts['hits'] + counts['misses'] + counts['bypassed']
+            if calls:
+                lines.append('  {}: {} calls, {} hits ({:.0%}), {} misses, {} bypassed'.format(
+                    name, calls, counts['hits'], float(counts['hits']) / calls,
+                    counts['misses'], counts['bypassed']))
+
+        self.previous = totals
+
+        if lines:
+            self._display.display('Memoized filters of play "{}":\n{}'.format(self.play, '\n'.join(lines)))
+
+    def v2_playbook_on_play_start(self, play):
+        self._print_play_stats()
+        self.play = play.get_name()
+
+    def v2_playbook_on_stats(self, stats):
+        self._print_play_stats()
+        shutil.rmtree(self.stats_dir, True)
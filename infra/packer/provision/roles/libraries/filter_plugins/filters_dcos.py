@@ -1,9 +1,9 @@
 import base64
-import hashlib
 import json
+from collections import OrderedDict
 
 from ansible import errors
-from ansible.module_utils.six import text_type
+from ansible.module_utils.six import string_types, text_type
 
 # import boolean converter
 try:
@@ -13,6 +13,26 @@ except ImportError:
 
     boolean = C.mk_boolean
 
+# Use module_utils_loader to dynamically import module_utils from a filter plugin
+try:
+    from ansible.module_utils.memoize import memoize_filters
+    from ansible.module_utils.vracks import assign_vracks, vrack_id
+except ImportError:
+    from ansible.plugins.loader import module_utils_loader as ml
+
+    mz = ml._load_module_source('memoize', ml.find_plugin('memoize'))
+    vr = ml._load_module_source('vracks', ml.find_plugin('vracks'))
+
+    memoize_filters = mz.memoize_filters
+    assign_vracks = vr.assign_vracks
+    vrack_id = vr.vrack_id
+
+# Number of host lists whose vrack assignment is kept
+VRACK_CACHE_SIZE = 16
+
+# Vrack assignments of the last host lists of this process, by host list and number of vracks
+_vrack_cache = OrderedDict()
+
 
 def get_network(a, tenant):
     """
@@ -94,32 +114,81 @@ def marathon_url(a, url_base='.marathon.mesos'):
     return ".".join(l) + url_base
 
 
-def vrack_id(a, vracks=5):
+def _get_vracks(hosts, vracks):
+    """
+    Return the cached vrack assignment of a host list, computing it on first use.
     """
-    Determine a virtual 'rack ID' based on the hostname of the machine.
-    Attempts to extract integers from a dash-separated (-) hostname, eg.
-    iot-private-slave-3. In case the string contains multiple integers,
-    the last one is used.
 
-    The vrack_id is calculated by performing a modulo operation on the
-    base integer. The amount of vracks can be altered using the 'vracks'
-    kwarg.
+    if isinstance(hosts, string_types) or not isinstance(hosts, (list, tuple, set)):
+        raise errors.AnsibleFilterError('vrack_ids: filter operand "{}" is not a list of hosts'.format(hosts))
+
+    key = (tuple(hosts), vracks)
+
+    out = _vrack_cache.pop(key, None)
+    if out is None:
+        try:
+            out = assign_vracks(hosts, vracks)
+        except ValueError as e:
+            raise errors.AnsibleFilterError('vrack_ids: {}'.format(e))
+
+    _vrack_cache[key] = out
+    while len(_vrack_cache) > VRACK_CACHE_SIZE:
+        _vrack_cache.popitem(last=False)
+
+    return out
 
-    In case the base integer (by splitting the string) cannot be derived,
-    the SHA2 hash of the hostname is used as the base for the modulo.
-    This may lead to an uneven distribution in some circumstances.
+
+def vrack_ids(a, vracks=5):
+    """
+    Determine the virtual 'rack IDs' of all the hosts of a list at once,
+    balanced across the vracks.
+
+    Every host gets its vrack_id, unless that vrack already holds its share of
+    the hosts, ceil(hosts / vracks). It then gets the first vrack with room in
+    an order derived from the SHA2 hash of the hostname. Hosts numbered in
+    sequence get the same vrack as with vrack_id, and hashed hostnames are
+    spread evenly instead of at random.
+
+    Adding hosts to the list only moves the few hosts whose vracks fill up.
+    The assignment sorts the whole list. The forked workers of Ansible don't
+    share their cache, so compute it once per play, with the `vracks` argument
+    of the cluster_topology action, rather than once per host.
+
+    :param a: the hostnames, eg. groups['all']
+    :type a: list
+    :param vracks: the amount of vracks
+    :type vracks: int
+    :return: the vrack of every host, by hostname
+    :rtype: dict
     """
 
-    # Extract all integers from the base string
-    n = [int(s) for s in a.split('-') if s.isdigit()]
+    return dict(_get_vracks(a, vracks))
 
-    # Return the last integer mod the amount of vracks
-    if n:
-        return int(n[-1] % vracks)
 
-    # Base integer(s) could not be derived, fall back to SHA2
-    h = hashlib.sha256(a).hexdigest()
-    return int(int(h, 16) % vracks)
+def balanced_vrack_id(a, hosts, vracks=5):
+    """
+    Look up the virtual 'rack ID' of a host in the balanced assignment of all
+    the hosts of a list, see vrack_ids. Eg.:
+    {{ inventory_hostname | balanced_vrack_id(groups['all']) }}
+
+    Every host computes the whole assignment, in large inventories look it up in
+    the fact of the cluster_topology action instead:
+    {{ cluster_topology.vracks[inventory_hostname] }}
+
+    :param a: the hostname
+    :type a: str
+    :param hosts: all the hostnames, the host among them
+    :type hosts: list
+    :param vracks: the amount of vracks
+    :type vracks: int
+    :return: the vrack of the host
+    :rtype: int
+    """
+
+    try:
+        return _get_vracks(hosts, vracks)[a]
+    except KeyError:
+        raise errors.AnsibleFilterError('balanced_vrack_id({}): host is not in the host list'.format(a))
 
 
 def image_metadata(a):
@@ -158,9 +227,12 @@ class FilterModule(object):
 
             # infrastructure helpers
             'vrack_id': vrack_id,
+            'vrack_ids': vrack_ids,
+            'balanced_vrack_id': balanced_vrack_id,
 
             # misc
             'image_metadata': image_metadata,
         }
 
-        return filters
+        # pure filters, memoized when ANSIBLE_FILTER_MEMOIZE is set
+        return memoize_filters(filters, ['get_network', 'marathon_url', 'vrack_id', 'image_metadata'])
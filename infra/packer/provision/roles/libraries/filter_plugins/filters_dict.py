@@ -1,10 +1,167 @@
+import copy
+from collections import OrderedDict
+
 from ansible.errors import AnsibleFilterError
 from ansible.module_utils.parsing.convert_bool import boolean
 from ansible.module_utils.six import iteritems, text_type, string_types
 from jinja2 import StrictUndefined
 
+# Use module_utils_loader to dynamically import module_utils from a filter plugin
+try:
+    from ansible.module_utils.dict_utils import compile_path, resolve_keys
+except ImportError:
+    from ansible.plugins.loader import module_utils_loader as ml
+
+    du = ml._load_module_source('dict_utils', ml.find_plugin('dict_utils'))
+
+    compile_path = du.compile_path
+    resolve_keys = du.resolve_keys
+
+# Types of the members dict_lookup accepts
+_KEY_TYPES = (string_types, text_type)
+
 
-def dict_query(a, attr=None, value=None, default=False):
+# Number of dicts whose query index is kept. Every cached index keeps its dict alive, eg.
+# the hostvars of a whole inventory, and a copy of the attribute values it indexes, until
+# it is evicted; plain dicts can't be referenced weakly.
+DICT_QUERY_CACHE_SIZE = 8
+
+# Query indexes of the last queried dicts, by id of the dict
+_dict_query_cache = OrderedDict()
+
+
+class DictQueryIndex(object):
+    """
+    Index of the values of a dict by attribute, to answer dict_query() without a scan
+    of the dict. The index of an attribute is built the first time it is queried.
+    Keys are returned in the iteration order of the dict.
+    """
+
+    def __init__(self, a):
+        self.keys = list(a)
+        self.values = [a[k] for k in self.keys]
+        self.attrs = {}
+        # copies of the attribute values each index was built from, by attribute
+        self.snapshots = {}
+
+    def _attr_values(self, attr):
+        return [v.get(attr) for v in self.values]
+
+    def is_current(self, a):
+        """
+        Check whether the dict still has the keys and values the index was built from, and
+        its values the attribute values of the indexes, so values replaced or modified in
+        place are detected. It compares the attributes without casting them, which is
+        cheaper than building the indexes again.
+        """
+
+        if len(a) != len(self.keys) or self.keys != list(a):
+            return False
+
+        if any(a[k] is not v for k, v in zip(self.keys, self.values)):
+            return False
+
+        return all(self._attr_values(attr) == snapshot for attr, snapshot in iteritems(self.snapshots))
+
+    def _attr_index(self, attr):
+        index = self.attrs.get(attr)
+        if index is not None:
+            return index
+
+        # positions of the values by attribute value, cast to boolean the Ansible way
+        buckets = {}
+        # positions and attribute values that can't be hashed, like lists
+        unhashable = []
+        # positions of the values without the attribute
+        missing = []
+
+        for pos, v in enumerate(self.values):
+            if v.get(attr) is None:
+                missing.append(pos)
+                continue
+
+            try:
+                iv = boolean(v[attr])
+            except TypeError:
+                iv = v[attr]
+
+            try:
+                buckets.setdefault(iv, []).append(pos)
+            except TypeError:
+                unhashable.append((pos, iv))
+
+        self.snapshots[attr] = copy.deepcopy(self._attr_values(attr))
+        index = self.attrs[attr] = (buckets, unhashable, missing)
+        return index
+
+    def positions(self, attr, value, default=False):
+        """
+        :returns: positions of the values whose attribute `attr` equals `value`
+        :rtype: set
+        """
+
+        buckets, unhashable, missing = self._attr_index(attr)
+
+        try:
+            out = set(buckets.get(value, ()))
+        except TypeError:
+            out = set()
+
+        out.update(pos for pos, iv in unhashable if iv == value)
+
+        if default == value:
+            out.update(missing)
+
+        return out
+
+    def query(self, predicates, default=False, match_any=False):
+        """
+        :param predicates: (attribute, value) pairs to match
+        :type predicates: list
+        :param default: Value to use as a default in case the key is missing from object.
+        :param match_any: match the keys matching any predicate instead of all of them
+        :type match_any: bool
+        :returns: list of dict keys that match the predicates
+        :rtype: list
+        """
+
+        out = None
+
+        for attr, value in predicates:
+            positions = self.positions(attr, value, default)
+            if out is None:
+                out = positions
+            elif match_any:
+                out |= positions
+            else:
+                out &= positions
+
+        return [self.keys[pos] for pos in sorted(out or ())]
+
+
+def get_dict_query_index(a):
+    """
+    Return the query index of a dict, from the cache as long as the dict is unchanged.
+
+    :param a: the dict to index
+    :type a: dict
+    :rtype: DictQueryIndex
+    """
+
+    entry = _dict_query_cache.pop(id(a), None)
+
+    # the cache holds a reference to the dict, so its id isn't reused while it's cached
+    if entry is None or entry[0] is not a or not entry[1].is_current(a):
+        entry = (a, DictQueryIndex(a))
+
+    _dict_query_cache[id(a)] = entry
+    while len(_dict_query_cache) > DICT_QUERY_CACHE_SIZE:
+        _dict_query_cache.popitem(last=False)
+
+    return entry[1]
+
+
+def dict_query(a, attr=None, value=None, default=False, operator='and'):
     """
     Given a dictionary, return a list of its keys that has a given attribute
     set to a specified value.
@@ -12,12 +169,22 @@ def dict_query(a, attr=None, value=None, default=False):
     `value` is always attempted to be interpreted as a boolean the Ansible way.
     'yes', 'no', 'y', 'n' are valid options.
 
-    :param attr: Attribute of the object to compare
-    :type attr: str
+    Several attributes can be matched at once by passing a dict of attributes and values,
+    or a list of [attribute, value] pairs, as `attr`. The keys match when all of them
+    match, or any of them with operator='or'.
+
+    Queries are answered from an index of the dict built once per attribute, and cached
+    while the keys, the values and their queried attributes are unchanged. Keys are
+    returned in the iteration order of the dict.
+
+    :param attr: Attribute of the object to compare, or the attributes and values to match
+    :type attr: str | dict | list
     :param value: Value of the object to look for. Attempts to be cast to boolean.
     :type value: str
     :param default: Value to use as a default in case the key is missing from object.
     :type default: str | bool
+    :param operator: 'and' to match all the attributes, 'or' to match any of them
+    :type operator: str
     :returns: list of dict keys that match the criteria
     :rtype: list
     """
@@ -28,23 +195,21 @@ def dict_query(a, attr=None, value=None, default=False):
     if not isinstance(a, dict):
         raise AnsibleFilterError('dict_query({}, {}): filter operand "{}" is not a dict'.format(attr, value, a))
 
-    out = []
+    if operator not in ('and', 'or'):
+        raise AnsibleFilterError("dict_query: filter parameter `operator` must be 'and' or 'or', not '{}'".format(operator))
 
-    for k, v in iteritems(a):
-
-        # Default the attribute to False if non-existent
-        if v.get(attr) is None:
-            iv = default
-        else:
-            try:
-                iv = boolean(v[attr])
-            except TypeError:
-                iv = v[attr]
+    if isinstance(attr, dict):
+        predicates = list(iteritems(attr))
+    elif isinstance(attr, (list, tuple)):
+        predicates = attr
+    else:
+        predicates = [(attr, value)]
 
-        if iv == value:
-            out.append(k)
+    for predicate in predicates:
+        if not isinstance(predicate, (list, tuple)) or len(predicate) != 2:
+            raise AnsibleFilterError('dict_query: predicate "{}" is not an [attribute, value] pair'.format(predicate))
 
-    return out
+    return get_dict_query_index(a).query(predicates, default, operator == 'or')
 
 
 def dict_lookup(*args, **kwargs):
@@ -62,52 +227,86 @@ def dict_lookup(*args, **kwargs):
 
     error = kwargs.pop('error', False)
 
-    # convert args to list so it can be mutated
-    args = list(args)
-
     if len(args) < 2:
         raise AnsibleFilterError('dict_lookup: need at least 1 operand and 1 parameter')
 
-    # pop off the leftmost element of the list, the operand (the jinja2 variable piped to this filter)
-    d = args.pop(0)
+    # the leftmost element is the operand (the jinja2 variable piped to this filter)
+    d = args[0]
 
     if not isinstance(d, dict):
         raise AnsibleFilterError('dict_lookup: operand needs to be a dict')
 
-    # list of accessed members throughout the tree
-    accessed = []
+    return _lookup(d, args[1:], error)
+
+
+def dict_lookups(d, paths, error=False):
+    """
+    Look up several members of the same nested dictionary in one call, like dict_lookup.
+
+    :param d: the dict to access
+    :type d: dict
+    :param paths: the dot-separated paths, or lists of members, in a list or a dict by name
+    :type paths: list | dict
+    :param error: fails filter when member is not found, default: False
+    :type error: bool
+    :return: the values at the given locations in the dict, in a list or a dict by name
+    :rtype: list | dict
+    :raises AnsibleFilterError: upon invalid input, or when a lookup fails (when error=True)
+    """
 
-    # tree pointer, overwritten on every access
-    ptr = d
+    if not isinstance(d, dict):
+        raise AnsibleFilterError('dict_lookups: operand needs to be a dict')
 
-    # iterate over all positional args and try to use them to access dict keys
-    for a in args:
+    if isinstance(paths, (string_types, text_type)):
+        raise AnsibleFilterError('dict_lookups: parameter needs to be a list or a dict of paths')
 
-        # only support accessing dict entries with string keys
-        if not isinstance(a, (string_types, text_type)):
-            raise AnsibleFilterError("dict_lookup: dict key parameter '{}' is not a string".format(a))
+    if isinstance(paths, dict):
+        return dict((name, _lookup_path(d, path, error)) for name, path in iteritems(paths))
 
-        # make sure we only attempt lookups in dictionaries
-        if not isinstance(ptr, dict):
-            raise AnsibleFilterError(
-                "dict_lookup: trying to access member '{}' of non-dictionary value at '.{}'"
-                    .format(a, '.'.join(accessed)))
+    return [_lookup_path(d, path, error) for path in paths]
 
-        try:
-            # keep a list of traversed members for error reporting
-            accessed.append(a)
 
-            # step into the requested member
-            ptr = ptr[a]
+def _lookup_path(d, path, error):
+    """
+    Resolve a path in a dict with the error handling of dict_lookup. The path is compiled
+    once, its keys don't need to be checked again when they are all strings.
+    """
+
+    accessor = compile_path(path)
+
+    return _lookup(d, accessor.keys, error, accessor.first_non_string is None)
 
-        except KeyError:
-            if error:
-                raise AnsibleFilterError("dict_lookup: dict member '.{}' does not exist".format('.'.join(accessed)))
 
-            # if the lookup fails at any point and error reporting is disabled, return StrictUndefined
-            return StrictUndefined(name="dict_lookup: '.{}'".format('.'.join(accessed)))
+def _lookup(d, keys, error, strings_checked=False):
+    """
+    Resolve the keys in a dict with the error handling of dict_lookup.
+    """
+
+    value, depth, failure = resolve_keys(d, keys)
+
+    # only support accessing dict entries with string keys, checked up to where the lookup went
+    if not strings_checked:
+        for a in (keys if failure is None else keys[:depth + 1]):
+            if not isinstance(a, _KEY_TYPES):
+                raise AnsibleFilterError("dict_lookup: dict key parameter '{}' is not a string".format(a))
+
+    if failure is None:
+        return value
+
+    # make sure we only attempt lookups in dictionaries
+    if failure == 'type':
+        raise AnsibleFilterError(
+            "dict_lookup: trying to access member '{}' of non-dictionary value at '.{}'"
+                .format(keys[depth], '.'.join(keys[:depth])))
+
+    # list of accessed members throughout the tree
+    accessed = '.'.join(keys[:depth + 1])
+
+    if error:
+        raise AnsibleFilterError("dict_lookup: dict member '.{}' does not exist".format(accessed))
 
-    return ptr
+    # if the lookup fails at any point and error reporting is disabled, return StrictUndefined
+    return StrictUndefined(name="dict_lookup: '.{}'".format(accessed))
 
 
 class FilterModule(object):
@@ -117,7 +316,8 @@ class FilterModule(object):
         filters = {
             'dict_select': dict_query,
             'dict_query': dict_query,
-            'dict_lookup': dict_lookup
+            'dict_lookup': dict_lookup,
+            'dict_lookups': dict_lookups
         }
 
         return filters
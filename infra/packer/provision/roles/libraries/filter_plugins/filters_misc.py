@@ -13,6 +13,19 @@ except ImportError:
 
     boolean = C.mk_boolean
 
+# Use module_utils_loader to dynamically import module_utils from a filter plugin
+try:
+    from ansible.module_utils.memoize import memoize_filters
+    from ansible.module_utils.topology import get_topology
+except ImportError:
+    from ansible.plugins.loader import module_utils_loader as ml
+
+    mz = ml._load_module_source('memoize', ml.find_plugin('memoize'))
+    tp = ml._load_module_source('topology', ml.find_plugin('topology'))
+
+    memoize_filters = mz.memoize_filters
+    get_topology = tp.get_topology
+
 
 def append_if_exists(a, astr):
     """
@@ -157,6 +170,21 @@ def quorum(a):
     return int(math.floor(a / 2) + 1)
 
 
+def cluster_topology(a, hostvars=None, master_group='master', zk_port=2181, apps=None):
+    """
+    Derive the topology of the cluster from the inventory groups once, instead of
+    computing connection strings, quorums and URLs again for every host, eg.
+    {{ (groups | cluster_topology(hostvars)).zk_url }}
+
+    The cluster_topology action plugin publishes the same topology as a fact.
+    """
+
+    try:
+        return get_topology(a, hostvars, master_group=master_group, zk_port=zk_port, apps=apps)
+    except ValueError as e:
+        raise errors.AnsibleFilterError('cluster_topology: {}'.format(e))
+
+
 class FilterModule(object):
     """ Miscellaneous Filters """
 
@@ -176,9 +204,11 @@ class FilterModule(object):
 
             # generation / concatenation
             'connection_string': connection_string,
+            'cluster_topology': cluster_topology,
 
             # math
             'quorum': quorum
         }
 
-        return filters
+        # pure filters, memoized when ANSIBLE_FILTER_MEMOIZE is set
+        return memoize_filters(filters, ['split', 'connection_string', 'quorum'])
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+import weakref
+
+import boto3
+from botocore.config import Config
+
+# Sessions by region and credentials, shared by every caller of the process
+_sessions = {}
+
+# Clients by service, endpoint and session key, dropped in a forked process
+_clients = {}
+
+# Keys of the clients created by get_client(), by client
+_client_keys = weakref.WeakKeyDictionary()
+
+# The process the clients belong to
+_clients_pid = None
+
+_lock = threading.Lock()
+
+
+def _session_key(region, access_key, secret_key, session_token, profile):
+    """
+    Key a session on its region and credentials, the secrets are hashed so they don't
+    show in the keys.
+    """
+
+    secrets = None
+    if secret_key is not None or session_token is not None:
+        secrets = hashlib.sha256('{}\0{}'.format(secret_key, session_token).encode('utf-8')).hexdigest()
+
+    return region, access_key, secrets, profile
+
+
+def get_session(region=None, access_key=None, secret_key=None, session_token=None, profile=None):
+    """
+    Get the boto3 session of a region and credentials, created once per process.
+    The credentials default to the environment and the AWS configuration, like boto3.
+
+    :param region: AWS region
+    :type region: str
+    :param access_key: AWS access key ID
+    :type access_key: str
+    :param secret_key: AWS secret access key
+    :type secret_key: str
+    :param session_token: AWS session token
+    :type session_token: str
+    :param profile: profile of the AWS configuration
+    :type profile: str
+    :return: the boto3 session
+    :rtype: boto3.session.Session
+    """
+
+    key = _session_key(region, access_key, secret_key, session_token, profile)
+
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = _sessions[key] = boto3.session.Session(
+                    aws_access_key_id=access_key,
+                    aws_secret_access_key=secret_key,
+                    aws_session_token=session_token,
+                    region_name=region,
+                    profile_name=profile,
+                )
+
+    return session
+
+
+def get_client(service, region=None, endpoint_url=None, access_key=None, secret_key=None, session_token=None,
+               profile=None):
+    """
+    Get a boto3 client of a service, region and credentials, created once per process
+    and shared by the action plugins. The clients are thread-safe, but their connections
+    are not shared with forked processes, which create their own clients from the
+    shared sessions.
+
+    :param service: the AWS service, eg. s3
+    :type service: str
+    :param region: AWS region
+    :type region: str
+    :param endpoint_url: URL of the service, eg. a local stand-in, addressed by path
+    :type endpoint_url: str
+    :param access_key: AWS access key ID
+    :type access_key: str
+    :param secret_key: AWS secret access key
+    :type secret_key: str
+    :param session_token: AWS session token
+    :type session_token: str
+    :param profile: profile of the AWS configuration
+    :type profile: str
+    :return: the boto3 client
+    """
+
+    global _clients_pid
+
+    session_key = _session_key(region, access_key, secret_key, session_token, profile)
+    key = (service, endpoint_url) + session_key
+
+    if _clients_pid != os.getpid():
+        with _lock:
+            if _clients_pid != os.getpid():
+                _clients.clear()
+                _clients_pid = os.getpid()
+
+    client = _clients.get(key)
+    if client is None:
+        session = get_session(region, access_key, secret_key, session_token, profile)
+        config = Config(s3={'addressing_style': 'path'}) if endpoint_url else None
+
+        # the sessions are not thread-safe, clients are created one at a time
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = _clients[key] = session.client(service, endpoint_url=endpoint_url, config=config)
+                _client_keys[client] = key
+
+    return client
+
+
+def client_key(client):
+    """
+    Key a client created by get_client() on the service, endpoint, region and credentials
+    it was created with, the secrets are hashed so they don't show in the key.
+
+    :param client: boto3 client instance
+    :return: the key of the client, or None when get_client() didn't create it
+    :rtype: tuple
+    """
+
+    return _client_keys.get(client)
+
+
+def clear_clients():
+    """
+    Drop the cached sessions and clients, eg. when the credentials were rotated.
+    """
+
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
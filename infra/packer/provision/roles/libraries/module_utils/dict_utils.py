@@ -1,3 +1,115 @@
+# Number of compiled paths kept
+PATH_CACHE_SIZE = 1024
+
+# Compiled paths, by dot-separated path or tuple of keys
+_path_cache = {}
+
+
+class PathAccessor(object):
+    """
+    Accessor of a path of keys in nested dictionaries. Paths are compiled once by
+    compile_path() and shared by dict_path(), dict_paths() and the dict_lookup filter.
+    """
+
+    __slots__ = ('keys', 'first_non_string')
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+
+        # index of the first key that isn't a string, for the callers that only accept strings
+        self.first_non_string = None
+        for i, key in enumerate(self.keys):
+            if not isinstance(key, (str, type(u''))):
+                self.first_non_string = i
+                break
+
+    def get(self, d, default=None):
+        """
+        Traverse the path with get(), like dict_path().
+
+        :param d: the dictionary to traverse
+        :param default: value returned when an element on the way doesn't support get()
+        :return: element at path
+        """
+
+        rv = d
+
+        try:
+            for key in self.keys:
+                rv = rv.get(key)
+        except AttributeError:
+            return default
+
+        return rv
+
+    def resolve(self, d):
+        """
+        Traverse the path with explicit dictionary access, see resolve_keys().
+        """
+
+        return resolve_keys(d, self.keys)
+
+
+def resolve_keys(d, keys):
+    """
+    Traverse nested dictionaries with explicit dictionary access, stopping at the first failure.
+
+    :param d: the dictionary to traverse
+    :type d: dict
+    :param keys: the keys to access, one per level
+    :type keys: list | tuple
+    :return: a (value, depth, failure) tuple. On success the depth is the length of the
+        path and the failure is None. Otherwise the value is None, the depth is the index
+        of the key that failed and the failure is 'type' when the value at that depth is
+        not a dictionary, or 'missing' when it has no such key.
+    :rtype: tuple
+    """
+
+    ptr = d
+    depth = 0
+
+    for key in keys:
+        if not isinstance(ptr, dict):
+            return None, depth, 'type'
+
+        try:
+            ptr = ptr[key]
+        except (KeyError, TypeError):
+            return None, depth, 'missing'
+
+        depth += 1
+
+    return ptr, depth, None
+
+
+def compile_path(path):
+    """
+    Compile a path into an accessor, cached by path.
+
+    :param path: the dot-separated path, or a list of keys
+    :type path: str | list
+    :rtype: PathAccessor
+    """
+
+    cache_key = path if isinstance(path, (str, type(u''))) else tuple(path)
+
+    try:
+        accessor = _path_cache.get(cache_key)
+    except TypeError:
+        # keys that can't be hashed, like lists, are not cached
+        return PathAccessor(cache_key)
+
+    if accessor is None:
+        keys = path.split('.') if cache_key is path else cache_key
+        accessor = PathAccessor(keys)
+
+        if len(_path_cache) >= PATH_CACHE_SIZE:
+            _path_cache.clear()
+        _path_cache[cache_key] = accessor
+
+    return accessor
+
+
 def dict_path(d, path, default=None):
     """
     Traverse the path in the dictionary and return the element.
@@ -10,16 +122,27 @@ def dict_path(d, path, default=None):
     :return: element at path
     """
 
-    keys = path.split('.')
-    rv = d
+    accessor = _path_cache.get(path) or compile_path(path)
 
-    try:
-        for key in keys:
-            rv = rv.get(key)
-    except AttributeError:
-        return default
+    return accessor.get(d, default)
+
+
+def dict_paths(d, paths, default=None):
+    """
+    Traverse several paths in the same dictionary, like dict_path().
+
+    :param d: the dictionary to traverse
+    :type d: dict
+    :param paths: the dot-separated paths, or a dict of names and paths
+    :type paths: list | dict
+    :return: the elements at the paths, in a list, or in a dict by name
+    :rtype: list | dict
+    """
+
+    if isinstance(paths, dict):
+        return dict((name, dict_path(d, path, default)) for name, path in paths.items())
 
-    return rv
+    return [dict_path(d, path, default) for path in paths]
 
 
 def filter_dict(fdict, mask):
@@ -0,0 +1,193 @@
+import json
+import os
+from collections import OrderedDict
+from multiprocessing import current_process, util
+
+# Set to a true value to memoize the pure filters
+MEMOIZE_ENV = 'ANSIBLE_FILTER_MEMOIZE'
+
+# Number of results kept per filter
+MEMOIZE_SIZE_ENV = 'ANSIBLE_FILTER_MEMOIZE_SIZE'
+MEMOIZE_SIZE = 256
+
+# Folder the worker processes write their counters to, set by the filter_memo_stats callback
+MEMOIZE_STATS_ENV = 'ANSIBLE_FILTER_MEMOIZE_STATS'
+
+# Arguments with more items than this, like large dicts, are not worth hashing and bypass the cache
+MEMOIZE_MAX_KEY_ITEMS = 64
+
+# Memoized filters of this process, by name
+_memoized = {}
+
+# The process the counters belong to, they start at zero in every forked worker
+_stats_pid = None
+
+
+def is_enabled():
+    """
+    :return: whether the memoization of filters is enabled in the environment
+    :rtype: bool
+    """
+
+    return os.environ.get(MEMOIZE_ENV, '').lower() in ('1', 'true', 'yes', 'on')
+
+
+def freeze(value, budget=None):
+    """
+    Convert a filter argument into a hashable form. The type is part of the form,
+    so 1, 1.0 and True don't share a result.
+
+    :param value: the argument
+    :param budget: the number of items left to convert, shared by nested values
+    :type budget: list
+    :return: a hashable form of the argument
+    :raise TypeError: when the argument can't be hashed or is too large
+    """
+
+    if budget is None:
+        budget = [MEMOIZE_MAX_KEY_ITEMS]
+
+    budget[0] -= 1
+    if budget[0] < 0:
+        raise TypeError('argument too large to memoize')
+
+    if isinstance(value, dict):
+        return dict, frozenset((freeze(k, budget), freeze(v, budget)) for k, v in value.items())
+
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(freeze(v, budget) for v in value)
+
+    if isinstance(value, (set, frozenset)):
+        return frozenset, frozenset(freeze(v, budget) for v in value)
+
+    hash(value)
+
+    return type(value), value
+
+
+class MemoizedFilter(object):
+    """
+    A pure filter with a bounded LRU cache of its results, keyed on the hashable form of
+    its arguments. Calls with arguments that can't be hashed, or raising an error, are
+    passed through and never cached. Lists and dicts are copied on the way out, so the
+    cached results can't be modified by the templates.
+    """
+
+    def __init__(self, name, func, size=MEMOIZE_SIZE):
+        self.name = name
+        self.func = func
+        self.size = size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def __call__(self, *args, **kwargs):
+        _check_fork()
+
+        # undefined values can raise errors of their own when hashed
+        try:
+            key = freeze((args, kwargs))
+        except Exception:
+            self.bypassed += 1
+            return self.func(*args, **kwargs)
+
+        try:
+            out = self.cache.pop(key)
+        except KeyError:
+            self.misses += 1
+            out = self.func(*args, **kwargs)
+        else:
+            self.hits += 1
+
+        self.cache[key] = out
+        if len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+        if isinstance(out, list):
+            return list(out)
+        if isinstance(out, dict):
+            return dict(out)
+        return out
+
+    def reset_stats(self):
+        self.hits = self.misses = self.bypassed = 0
+
+
+def memoize_filters(filters, names):
+    """
+    Memoize some filters of a FilterModule, when enabled in the environment.
+
+    :param filters: the filters, by name
+    :type filters: dict
+    :param names: the names of the pure filters to memoize
+    :type names: list
+    :return: the filters, the pure ones memoized
+    :rtype: dict
+    """
+
+    if not is_enabled():
+        return filters
+
+    try:
+        size = int(os.environ.get(MEMOIZE_SIZE_ENV, MEMOIZE_SIZE))
+    except ValueError:
+        size = MEMOIZE_SIZE
+
+    out = dict(filters)
+    for name in names:
+        # filters() is called more than once, keep one cache per filter
+        if name not in _memoized or _memoized[name].func is not filters[name]:
+            _memoized[name] = MemoizedFilter(name, filters[name], size)
+        out[name] = _memoized[name]
+
+    return out
+
+
+def get_stats():
+    """
+    :return: the hits, misses and bypassed calls of the memoized filters of this process, like:
+        {"marathon_url": {"hits": 120, "misses": 4, "bypassed": 0}}
+    :rtype: dict
+    """
+
+    return dict(
+        (name, {'hits': f.hits, 'misses': f.misses, 'bypassed': f.bypassed})
+        for name, f in _memoized.items()
+    )
+
+
+def write_stats():
+    """
+    Write the counters of this process to the folder of the filter_memo_stats callback.
+    The file is named after the process, so writing it again replaces it.
+    """
+
+    stats_dir = os.environ.get(MEMOIZE_STATS_ENV)
+    if not stats_dir or not os.path.isdir(stats_dir) or not _memoized:
+        return
+
+    with open(os.path.join(stats_dir, '{}.json'.format(os.getpid())), 'w') as f:
+        json.dump(get_stats(), f)
+
+
+def _check_fork():
+    """
+    Start the counters at zero in a forked worker, and write them when the worker exits.
+    The cached results stay valid.
+    """
+
+    global _stats_pid
+
+    if os.getpid() == _stats_pid:
+        return
+
+    if _stats_pid is not None:
+        for f in _memoized.values():
+            f.reset_stats()
+    _stats_pid = os.getpid()
+
+    # workers are multiprocessing processes, which run their finalizers on exit,
+    # the callback reads the counters of the main process itself
+    if current_process().name != 'MainProcess':
+        util.Finalize(None, write_stats, exitpriority=10)
@@ -1,9 +1,39 @@
+import hashlib
+import hmac
 import json
-from binascii import hexlify, unhexlify
+import os
+import struct
+import tempfile
+from base64 import b64decode, b64encode
+from binascii import Error as BinasciiError, hexlify, unhexlify
 
 from Crypto import Random
 from Crypto.Cipher import AES
 
+# Versioned envelope of the secrets, base64-encoded or binary:
+#   magic, version, CFB segment size, padding, iv, key check, ciphertext
+# The secrets without it are unversioned, see armor_wrap()
+ENVELOPE_MAGIC = b'PDCE'
+ENVELOPE_VERSION = 1
+PADDING_NUL = 0
+PADDING_PKCS7 = 1
+
+_ENVELOPE_HEADER = struct.Struct('>4sBBB16s8s')
+
+# Framed format of the encrypted streams:
+#   header: magic, version, chunk size, iv, key check
+#   frames: flag, plain-text length, ciphertext of the chunk padded to the AES block size
+# Every frame holds a full chunk, but the last one, which can be empty
+STREAM_MAGIC = b'PDCS'
+STREAM_VERSION = 1
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+
+_STREAM_HEADER = struct.Struct('>4sBI16s8s')
+_STREAM_FRAME = struct.Struct('>BI')
+_FRAME_MORE = 0
+_FRAME_LAST = 1
+
 
 def generate_iv():
     """
@@ -127,7 +157,121 @@ def armor_unwrap(blob):
     return unhexlify(iv), unhexlify(payload)
 
 
-def encrypt(secret, key):
+def pad_pkcs7(value):
+    """
+    Pad a value to align to the AES.block_size, with the number of padding bytes
+    repeated. Unlike the NUL padding, any trailing bytes of the value are kept.
+
+    :param value: input value to pad
+    :type value: str
+    :return: padded value
+    :rtype: str
+    """
+
+    pad_size = AES.block_size - (len(value) % AES.block_size)
+
+    return value + bytes(bytearray([pad_size] * pad_size))
+
+
+def unpad_pkcs7(value):
+    """
+    Strip the padding added by pad_pkcs7().
+
+    :param value: input value to strip
+    :type value: str
+    :return: unpadded value
+    :rtype: str
+    :raises: ValueError when the padding is invalid
+    """
+
+    pad_size = bytearray(value[-1:])[0] if value else 0
+
+    if not 0 < pad_size <= AES.block_size or value[-pad_size:] != value[-1:] * pad_size:
+        raise ValueError('invalid padding, the secret is corrupt')
+
+    return value[:-pad_size]
+
+
+def is_legacy(blob):
+    """
+    Check if a blob is an unversioned secret, the JSON-encoded iv/payload of armor_wrap().
+
+    :param blob: the encrypted secret
+    :type blob: str
+    :return: whether the blob is an unversioned secret
+    :rtype: bool
+    """
+
+    return blob.lstrip()[:1] in ('{', b'{')
+
+
+def envelope_wrap(iv, payload, key_check, segment_size=128, padding=PADDING_PKCS7, encoding='base64'):
+    """
+    Wrap an IV and payload in a versioned envelope, which records the cipher parameters.
+
+    :param iv: the initialization vector the secret was encrypted with
+    :type iv: str
+    :param payload: the encrypted payload
+    :type payload: str
+    :param key_check: the key check of the key and IV
+    :type key_check: str
+    :param segment_size: CFB segment size the secret was encrypted with
+    :type segment_size: int
+    :param padding: padding of the secret, PADDING_NUL or PADDING_PKCS7
+    :type padding: int
+    :param encoding: encoding of the envelope, base64 or binary
+    :type encoding: str
+    :return: the envelope
+    :rtype: str
+    """
+
+    envelope = _ENVELOPE_HEADER.pack(ENVELOPE_MAGIC, ENVELOPE_VERSION, segment_size, padding, iv, key_check) + payload
+
+    if encoding == 'binary':
+        return envelope
+    if encoding == 'base64':
+        return b64encode(envelope).decode('ascii')
+
+    raise ValueError('unknown envelope encoding `{}`'.format(encoding))
+
+
+def envelope_unwrap(blob):
+    """
+    Unwrap a versioned envelope, base64-encoded or binary.
+
+    :param blob: the envelope
+    :type blob: str
+    :return: segment size, padding, iv, key check, payload tuple
+    :rtype: tuple
+    :raises: ValueError when the blob is not an envelope, or of an unsupported version
+    """
+
+    if not isinstance(blob, bytes):
+        blob = blob.encode('utf-8')
+
+    if blob[:len(ENVELOPE_MAGIC)] != ENVELOPE_MAGIC:
+        try:
+            blob = b64decode(blob)
+        except (TypeError, BinasciiError):
+            raise ValueError('not an envelope')
+
+        if blob[:len(ENVELOPE_MAGIC)] != ENVELOPE_MAGIC:
+            raise ValueError('not an envelope')
+
+    if len(blob) < _ENVELOPE_HEADER.size:
+        raise ValueError('truncated envelope')
+
+    _, version, segment_size, padding, iv, key_check = _ENVELOPE_HEADER.unpack(blob[:_ENVELOPE_HEADER.size])
+
+    if version != ENVELOPE_VERSION:
+        raise ValueError('unsupported envelope version {}'.format(version))
+    if segment_size not in (8, 128) or padding not in (PADDING_NUL, PADDING_PKCS7):
+        raise ValueError('unsupported cipher parameters in the envelope')
+
+    return segment_size, padding, iv, key_check, blob[_ENVELOPE_HEADER.size:]
+
+
+def encrypt(secret, key, encoding='base64'):
     """
     Encrypt a secret with a given key. Implicitly generates
     an initialization vector for use in the encryption operation.
@@ -136,40 +280,275 @@ def encrypt(secret, key):
     :type secret: str
     :param key: the key to encrypt the secret with
     :type key: str
-    :return: armored and json-encoded iv/payload
+    :param encoding: encoding of the envelope, base64 or binary (default: base64)
+    :type encoding: str
+    :return: the versioned envelope of the iv/payload
     :rtype: str
     """
-    if len(key) not in {16, 24, 32}:
-        raise ValueError('`key` needs to be either 16, 24 or 32 bytes long')
+
+    check_key(key)
+
+    if not isinstance(secret, bytes):
+        secret = secret.encode('utf-8')
 
     iv = generate_iv()
 
     # pad the input to align with the AES block size
-    psecret = pad_aes(secret)
+    pl = encrypt_aes(pad_pkcs7(secret), iv, key)
 
-    pl = encrypt_aes(psecret, iv, key)
-
-    return armor_wrap(iv, pl)
+    return envelope_wrap(iv, pl, _key_check(key, iv), encoding=encoding)
 
 
 def decrypt(armor, key, segment_size=128):
     """
-    Decrypt a secret inside an armored iv/payload JSON string
-    using the given key.
+    Decrypt a secret inside a versioned envelope, or an unversioned armored
+    iv/payload JSON string, using the given key.
 
-    :param armor: armored and json-encoded iv/payload
+    :param armor: the envelope, or armored and json-encoded iv/payload
     :type armor: str
     :param key: the encryption key previously used to encrypt the payload
     :type key: str
-    :param segment_size: CFB segment size (default: 128) for backwards-compatible decryption
+    :param segment_size: CFB segment size (default: 128) of an unversioned secret,
+        the envelopes record theirs
     :type segment_size: int
     :return: the decrypted value
     :rtype: str
+    :raises: ValueError when the key is wrong, or the secret is corrupt
+    """
+
+    check_key(key)
+
+    if is_legacy(armor):
+        iv, pl = armor_unwrap(armor)
+
+        return unpad_aes(decrypt_aes(pl, iv, key, segment_size=segment_size))
+
+    segment_size, padding, iv, key_check, pl = envelope_unwrap(armor)
+
+    if not hmac.compare_digest(key_check, _key_check(key, iv)):
+        raise ValueError('the secret was encrypted with another key')
+
+    plain = decrypt_aes(pl, iv, key, segment_size=segment_size)
+
+    if padding == PADDING_NUL:
+        return unpad_aes(plain)
+
+    return unpad_pkcs7(plain).decode('utf-8')
+
+
+def check_key(key):
+    """
+    Check the length of an AES key.
+
+    :param key: the encryption key
+    :type key: str
+    :raises: ValueError when the key is not 16, 24 or 32 bytes long
     """
 
     if len(key) not in {16, 24, 32}:
         raise ValueError('`key` needs to be either 16, 24 or 32 bytes long')
 
-    iv, pl = armor_unwrap(armor)
 
-    return unpad_aes(decrypt_aes(pl, iv, key, segment_size=segment_size))
+def is_stream(blob):
+    """
+    Check if a blob, or its first bytes, is an encrypted stream.
+
+    :param blob: the blob or its first bytes
+    :type blob: str
+    :return: whether the blob starts with the stream header
+    :rtype: bool
+    """
+
+    return blob[:len(STREAM_MAGIC)] == STREAM_MAGIC
+
+
+def _key_check(key, iv):
+    """
+    Derive a short value from the key and IV, to tell a wrong key from a corrupt stream
+    before decrypting it.
+    """
+
+    return hmac.new(key, STREAM_MAGIC + iv, hashlib.sha256).digest()[:8]
+
+
+def _read_full(src, size):
+    """
+    Read `size` bytes from a file object, fewer only at the end of the stream.
+    """
+
+    data = src.read(size)
+    if len(data) == size or not data:
+        return data
+
+    parts = [data]
+    size -= len(data)
+    while size > 0:
+        data = src.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+
+    return b''.join(parts)
+
+
+def encrypt_stream(src, dst, key, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encrypt a stream chunk by chunk, with a given key. Only one chunk is held in memory,
+    the ciphertext is written to `dst` in frames, see STREAM_MAGIC for the format.
+
+    :param src: the binary file object to encrypt
+    :param dst: the binary file object to write the encrypted stream to
+    :param key: the key to encrypt the stream with
+    :type key: str
+    :param chunk_size: the size of the chunks, a multiple of the AES block size
+    :type chunk_size: int
+    :return: the number of bytes encrypted
+    :rtype: int
+    :raises: ValueError when the key or the chunk size is invalid
+    """
+
+    check_key(key)
+
+    if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE or chunk_size % AES.block_size:
+        raise ValueError('`chunk_size` needs to be a multiple of {} up to {}'.format(
+            AES.block_size, STREAM_MAX_CHUNK_SIZE))
+
+    iv = generate_iv()
+
+    # the cipher keeps its state across chunks, the stream is encrypted as one payload
+    aes = AES.new(key, AES.MODE_CFB, iv, segment_size=128)
+
+    dst.write(_STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size, iv, _key_check(key, iv)))
+
+    size = 0
+    while True:
+        chunk = _read_full(src, chunk_size)
+        length = len(chunk)
+        size += length
+
+        if length < chunk_size:
+            # the last chunk is padded, its length in the frame tells the padding apart
+            dst.write(_STREAM_FRAME.pack(_FRAME_LAST, length))
+            if chunk:
+                dst.write(aes.encrypt(chunk.ljust(length + (-length % AES.block_size), b'\x00')))
+            return size
+
+        dst.write(_STREAM_FRAME.pack(_FRAME_MORE, length))
+        dst.write(aes.encrypt(chunk))
+
+
+def decrypt_stream(src, dst, key):
+    """
+    Decrypt a stream written by encrypt_stream() chunk by chunk, with the given key.
+    Only one chunk is held in memory.
+
+    :param src: the binary file object to decrypt
+    :param dst: the binary file object to write the decrypted stream to
+    :param key: the encryption key previously used to encrypt the stream
+    :type key: str
+    :return: the number of bytes decrypted
+    :rtype: int
+    :raises: ValueError when the key is wrong, or the stream is not an encrypted stream,
+        is corrupt or truncated
+    """
+
+    check_key(key)
+
+    header = _read_full(src, _STREAM_HEADER.size)
+    if not is_stream(header):
+        raise ValueError('not an encrypted stream')
+    if len(header) < _STREAM_HEADER.size:
+        raise ValueError('truncated stream header')
+
+    _, version, chunk_size, iv, key_check = _STREAM_HEADER.unpack(header)
+
+    if version != STREAM_VERSION:
+        raise ValueError('unsupported stream version {}'.format(version))
+    if not 0 < chunk_size <= STREAM_MAX_CHUNK_SIZE or chunk_size % AES.block_size:
+        raise ValueError('invalid chunk size {}'.format(chunk_size))
+    if not hmac.compare_digest(key_check, _key_check(key, iv)):
+        raise ValueError('the stream was encrypted with another key')
+
+    aes = AES.new(key, AES.MODE_CFB, iv, segment_size=128)
+
+    size = 0
+    while True:
+        frame = _read_full(src, _STREAM_FRAME.size)
+        if len(frame) < _STREAM_FRAME.size:
+            raise ValueError('truncated stream, the last frame is missing')
+
+        flag, length = _STREAM_FRAME.unpack(frame)
+        if flag not in (_FRAME_MORE, _FRAME_LAST):
+            raise ValueError('unknown frame flag {}'.format(flag))
+        if flag == _FRAME_MORE and length != chunk_size or flag == _FRAME_LAST and length >= chunk_size:
+            raise ValueError('corrupt frame at byte {} of the stream'.format(size))
+
+        padded = length + (-length % AES.block_size)
+        encrypted = _read_full(src, padded)
+        if len(encrypted) < padded:
+            raise ValueError('truncated stream, frame at byte {} is incomplete'.format(size))
+
+        if encrypted:
+            dst.write(aes.decrypt(encrypted)[:length])
+        size += length
+
+        if flag == _FRAME_LAST:
+            return size
+
+
+def _transform_file(transform, src_path, dst_path, *args):
+    """
+    Run a stream transformation from a file to another. The output is written to a
+    temporary file next to `dst_path`, which replaces `dst_path` only on success.
+    """
+
+    dst_dir = os.path.dirname(os.path.abspath(dst_path))
+    fd, tmp_path = tempfile.mkstemp(dir=dst_dir, prefix='.' + os.path.basename(dst_path) + '.')
+
+    try:
+        with open(src_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            size = transform(src, dst, *args)
+        os.rename(tmp_path, dst_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return size
+
+
+def encrypt_file(src_path, dst_path, key, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Encrypt a file, like genconf backups or bootstrap tarballs, with bounded memory.
+    See encrypt_stream().
+
+    :param src_path: path of the file to encrypt
+    :type src_path: str
+    :param dst_path: path of the encrypted file, replaced once it's complete
+    :type dst_path: str
+    :param key: the key to encrypt the file with
+    :type key: str
+    :param chunk_size: the size of the chunks, a multiple of the AES block size
+    :type chunk_size: int
+    :return: the number of bytes encrypted
+    :rtype: int
+    """
+
+    return _transform_file(encrypt_stream, src_path, dst_path, key, chunk_size)
+
+
+def decrypt_file(src_path, dst_path, key):
+    """
+    Decrypt a file encrypted by encrypt_file() with bounded memory. See decrypt_stream().
+
+    :param src_path: path of the encrypted file
+    :type src_path: str
+    :param dst_path: path of the decrypted file, replaced once it's complete
+    :type dst_path: str
+    :param key: the encryption key previously used to encrypt the file
+    :type key: str
+    :return: the number of bytes decrypted
+    :rtype: int
+    """
+
+    return _transform_file(decrypt_stream, src_path, dst_path, key)
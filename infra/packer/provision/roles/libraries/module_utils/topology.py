@@ -0,0 +1,157 @@
+from collections import OrderedDict
+
+# Use module_utils_loader to dynamically import module_utils from an action plugin
+try:
+    from ansible.module_utils.vracks import assign_vracks
+except ImportError:
+    from ansible.plugins.loader import module_utils_loader as ml
+
+    vr = ml._load_module_source('vracks', ml.find_plugin('vracks'))
+
+    assign_vracks = vr.assign_vracks
+
+# Number of topologies kept
+TOPOLOGY_CACHE_SIZE = 16
+
+# Topologies of the last inventories, by groups, options and master addresses
+_topology_cache = OrderedDict()
+
+
+def _address(host, hostvars, address_var):
+    """
+    Return the address of a host, its `address_var` when hostvars are given, or its name.
+    """
+
+    if hostvars is None:
+        return host
+
+    try:
+        return hostvars[host].get(address_var) or host
+    except KeyError:
+        return host
+
+
+def _connection_string(addrs, schema=None, port=None, delim=','):
+    """
+    Same format as the connection_string filter.
+    """
+
+    s = '' if schema is None else str(schema) + '://'
+    p = '' if port is None else ':' + str(port)
+
+    return delim.join(s + addr + p for addr in addrs)
+
+
+def _marathon_url(app, url_base='.marathon.mesos'):
+    """
+    Same format as the marathon_url filter.
+    """
+
+    return '.'.join(filter(None, reversed(app.split('/')))) + url_base
+
+
+def build_topology(groups, hostvars=None, master_group='master', address_var='ansible_host',
+                   zk_port=2181, zk_path='/mesos', apps=None, vracks=None, vrack_group='all'):
+    """
+    Derive the topology facts of a cluster from its inventory groups.
+
+    :param groups: the hosts of every group, eg. the `groups` variable
+    :type groups: dict
+    :param hostvars: the variables of every host, eg. the `hostvars` variable, to read
+        the addresses from (optional, the hostnames are used otherwise)
+    :param master_group: the group of the master nodes
+    :type master_group: str
+    :param address_var: the host variable holding the address of a host
+    :type address_var: str
+    :param zk_port: the ZooKeeper client port of the masters
+    :type zk_port: int
+    :param zk_path: the ZooKeeper path of Mesos
+    :type zk_path: str
+    :param apps: Marathon app names to derive URLs for (optional)
+    :type apps: list
+    :param vracks: the amount of vracks to balance the hosts of `vrack_group` across (optional)
+    :type vracks: int
+    :param vrack_group: the group of the hosts assigned a vrack
+    :type vrack_group: str
+    :return: the topology, like:
+        {
+            "groups": {"master": ["10.0.1.12", ...], ...},
+            "counts": {"master": 3, ...},
+            "masters": ["10.0.1.12", ...],
+            "master_quorum": 2,
+            "zk_hosts": "10.0.1.12:2181,...",
+            "zk_url": "zk://10.0.1.12:2181,.../mesos",
+            "marathon_urls": {"/infra/vault": "vault.infra.marathon.mesos"},
+            "vracks": {"private-slave-1": 1, ...},
+            "warning": None
+        }
+        master_quorum is None, and warning tells why, when the number of masters is
+        not odd, eg. 0 in a play without masters
+    :rtype: dict
+    :raise ValueError: when groups is not a dict
+    """
+
+    if not isinstance(groups, dict):
+        raise ValueError('groups `{}` is not a dict'.format(groups))
+
+    hosts = dict((group, list(members)) for group, members in groups.items())
+    masters = [_address(host, hostvars, address_var) for host in hosts.get(master_group, [])]
+
+    # same threshold as the quorum filter, a quorum needs an odd number of masters, the
+    # rest of the topology is still derived, eg. for plays without masters or a scale-out
+    master_quorum = None
+    warning = None
+    if len(masters) % 2 == 0:
+        warning = 'the number of hosts in group `{}` ({}) is not odd, there is no master quorum'.format(
+            master_group, len(masters))
+    else:
+        master_quorum = len(masters) // 2 + 1
+
+    zk_hosts = _connection_string(masters, port=zk_port)
+
+    return {
+        'groups': hosts,
+        'counts': dict((group, len(members)) for group, members in hosts.items()),
+        'masters': masters,
+        'master_quorum': master_quorum,
+        'zk_hosts': zk_hosts,
+        'zk_url': 'zk://' + zk_hosts + zk_path,
+        'marathon_urls': dict((app, _marathon_url(app)) for app in apps or []),
+        'vracks': assign_vracks(hosts.get(vrack_group, []), vracks) if vracks else {},
+        'warning': warning,
+    }
+
+
+def get_topology(groups, hostvars=None, **kwargs):
+    """
+    Return the topology of an inventory, see build_topology(). It is derived once per
+    inventory and cached, the same object is returned to every caller and must not be
+    modified.
+
+    :raise ValueError: when the topology can't be derived
+    """
+
+    # the hostvars are a new object in every task, only the addresses of the masters are
+    # read from them, so they are part of the key instead
+    try:
+        master_group = kwargs.get('master_group', 'master')
+        address_var = kwargs.get('address_var', 'ansible_host')
+        key = (
+            tuple(sorted((group, tuple(members)) for group, members in groups.items())),
+            tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                         for name, value in kwargs.items())),
+            tuple(_address(host, hostvars, address_var) for host in groups.get(master_group, [])),
+        )
+        topology = _topology_cache.pop(key, None)
+    except (AttributeError, TypeError):
+        # inputs that can't be keyed are not cached, build_topology() validates them
+        return build_topology(groups, hostvars, **kwargs)
+
+    if topology is None:
+        topology = build_topology(groups, hostvars, **kwargs)
+
+    _topology_cache[key] = topology
+    while len(_topology_cache) > TOPOLOGY_CACHE_SIZE:
+        _topology_cache.popitem(last=False)
+
+    return topology
@@ -1,36 +1,91 @@
+import copy
+import hashlib
 import json
+import os
+import tempfile
+import time
 
 from botocore.exceptions import ClientError
 
 # Use module_utils_loader to dynamically import module_utils from an action plugin
 try:
-    from ansible.module_utils.secret_storage import encrypt, decrypt
+    from ansible.module_utils.secret_storage import encrypt, decrypt, is_legacy
+    from ansible.module_utils.aws_utils import client_key
 except ImportError:
     from ansible.plugins.loader import module_utils_loader as ml
 
     ss = ml._load_module_source('secret_storage', ml.find_plugin('secret_storage'))
+    au = ml._load_module_source('aws_utils', ml.find_plugin('aws_utils'))
 
     encrypt = ss.encrypt
     decrypt = ss.decrypt
+    is_legacy = ss.is_legacy
+    client_key = au.client_key
 
 # Location of the environment's keyfile in the bucket
 KEY_PATH_FORMAT = 'environments/{env}/vault/keys'
+KEY_PATH_PREFIX = 'environments/'
+KEY_PATH_SUFFIX = '/vault/keys'
 
+# Seconds a bucket found by bucket_exists() is not checked again
+BUCKET_CACHE_TTL = 60
 
-def bucket_exists(client, bucket):
+# Expiry of the buckets found, by key of the client (see aws_utils.client_key()) and name
+_bucket_cache = {}
+
+# Seconds the Vault keys are used without checking their object in S3, 0 disables the cache
+KEYS_CACHE_TTL_ENV = 'VAULT_KEYS_CACHE_TTL'
+
+# Folder of the encrypted copies of the Vault keys, shared by the processes of the
+# control host (default: the keys are cached in memory only)
+KEYS_CACHE_DIR_ENV = 'VAULT_KEYS_CACHE_DIR'
+
+# Cached Vault keys of this process, with their ETag and expiry, by _keys_cache_key()
+_keys_cache = {}
+
+
+def bucket_exists(client, bucket, ttl=BUCKET_CACHE_TTL):
     """
-    Check if an S3 bucket exists.
+    Check if an S3 bucket exists, with a head request. The buckets found are not
+    checked again for `ttl` seconds by the clients of aws_utils.get_client() with the
+    same endpoint and credentials, the missing ones and the other clients are checked
+    every time.
+
+    A bucket the credentials may not access exists, the requests that follow fail
+    with the access error.
 
     :param client: boto3 client instance
     :param bucket: name of the S3 bucket
     :type bucket: str
+    :param ttl: seconds the bucket is known to exist once found
+    :type ttl: int
     :return: whether the bucket exists
     :rtype: bool
+    :raises ClientError: any S3 errors but a missing bucket
     """
 
-    blist = client.list_buckets()
+    key = client_key(client)
+    if key is not None:
+        key += (bucket,)
+    now = time.time()
 
-    return bucket in [b['Name'] for b in blist['Buckets']]
+    if key is not None and _bucket_cache.get(key, 0) > now:
+        return True
+
+    try:
+        client.head_bucket(Bucket=bucket)
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('404', 'NoSuchBucket', 'NotFound'):
+            _bucket_cache.pop(key, None)
+            return False
+        if code not in ('403', 'AccessDenied', 'Forbidden'):
+            raise e
+
+    if key is not None and ttl > 0:
+        _bucket_cache[key] = now + ttl
+
+    return True
 
 
 def key_path(environment):
@@ -77,51 +132,244 @@ def sanitize_vault_keys(vault_keys):
     return result
 
 
+def decode_vault_keys(blob, crypt_secret):
+    """
+    Decrypt and decode an encrypted Vault keys blob. The envelopes record their cipher
+    parameters and are decrypted once, unversioned blobs are tried with the default
+    segment size (128), then with the 8-bit one.
+
+    :param blob: the encrypted Vault keys
+    :type blob: str
+    :param crypt_secret: object storage encryption secret
+    :return: the Vault keys
+    :rtype: dict
+    :raises: ValueError when the blob can't be decrypted or decoded
+    """
+
+    if not is_legacy(blob):
+        try:
+            return json.loads(decrypt(blob, crypt_secret))
+        except Exception as e:
+            raise ValueError('error decrypting or interpreting vault_json: {}'.format(e))
+
+    try:
+        # attempt to decrypt object from object storage with default segment size (128)
+        vault_json = decrypt(blob, crypt_secret)
+        # decode the decrypted json string
+        return json.loads(vault_json)
+    except Exception as e:
+        try:
+            # fallback to 8-bit segment size (backwards compatibility)
+            vault_json = decrypt(blob, crypt_secret, segment_size=8)
+            return json.loads(vault_json)
+        except Exception:
+            raise ValueError('error decrypting or interpreting vault_json: {}'.format(e))
+
+
+def _keys_cache_ttl():
+    """
+    Return the TTL of the Vault keys cache from the environment, 0 when it's disabled.
+    """
+
+    try:
+        return max(0.0, float(os.environ.get(KEYS_CACHE_TTL_ENV, 0)))
+    except ValueError:
+        return 0.0
+
+
+def _keys_cache_key(client, bucket, environment, crypt_secret):
+    """
+    Key the Vault keys on their object and encryption secret, hashed so the key can name
+    the file of the keys without revealing them.
+    """
+
+    if not isinstance(crypt_secret, bytes):
+        crypt_secret = crypt_secret.encode('utf-8')
+
+    obj = json.dumps([client.meta.endpoint_url, bucket, key_path(environment=environment)])
+
+    return hashlib.sha256(obj.encode('utf-8') + b'\0' + hashlib.sha256(crypt_secret).digest()).hexdigest()
+
+
+def _cache_file_stamp(cache_path):
+    """
+    Return the modification time and inode of a file of the cache folder, which change
+    whenever a process writes it, or None when it is missing.
+    """
+
+    try:
+        st = os.stat(cache_path)
+    except OSError:
+        return None
+
+    return [st.st_mtime, st.st_ino]
+
+
+def _read_keys_cache(cache_key, crypt_secret):
+    """
+    Return the cached entry of some Vault keys, from memory or from the cache folder,
+    or None. With a cache folder, the entry in memory is only used while its file is
+    the one it was read from or written to, the other processes write through it.
+    """
+
+    entry = _keys_cache.get(cache_key)
+    cache_dir = os.environ.get(KEYS_CACHE_DIR_ENV)
+
+    if not cache_dir:
+        return entry
+
+    cache_path = os.path.join(cache_dir, cache_key)
+    stamp = _cache_file_stamp(cache_path)
+
+    # the entry written by this process when the folder can't be written has no file either
+    if entry is not None and entry.get('stamp') == stamp:
+        return entry
+
+    if stamp is None:
+        # dropped by another process, or never written
+        _keys_cache.pop(cache_key, None)
+        return None
+
+    try:
+        with open(cache_path, 'rb') as f:
+            entry = json.loads(decrypt(f.read(), crypt_secret))
+    except (IOError, OSError, ValueError):
+        # missing, or written with another secret
+        _keys_cache.pop(cache_key, None)
+        return None
+
+    entry['stamp'] = stamp
+    _keys_cache[cache_key] = entry
+
+    return entry
+
+
+def _write_keys_cache(cache_key, crypt_secret, etag, vault_keys, ttl):
+    """
+    Cache some Vault keys for `ttl` seconds, in memory and encrypted in the cache folder.
+    The cache is best effort, a folder that can't be written is ignored.
+    """
+
+    entry = {'etag': etag, 'expires': time.time() + ttl, 'vault_keys': copy.deepcopy(vault_keys)}
+    _keys_cache[cache_key] = entry
+
+    cache_dir = os.environ.get(KEYS_CACHE_DIR_ENV)
+    if not cache_dir:
+        return
+
+    cache_path = os.path.join(cache_dir, cache_key)
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+
+        # written next to its file and renamed, the other processes never read half of it
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.' + cache_key)
+        with os.fdopen(fd, 'w') as f:
+            f.write(encrypt(json.dumps(entry), crypt_secret))
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        pass
+
+    entry['stamp'] = _cache_file_stamp(cache_path)
+
+
+def _drop_keys_cache(cache_key):
+    """
+    Drop the cached entry of some Vault keys, in memory and in the cache folder.
+    """
+
+    _keys_cache.pop(cache_key, None)
+
+    cache_dir = os.environ.get(KEYS_CACHE_DIR_ENV)
+    if cache_dir:
+        try:
+            os.remove(os.path.join(cache_dir, cache_key))
+        except OSError:
+            pass
+
+
+def clear_keys_cache():
+    """
+    Drop the Vault keys cached in memory, the cache folder is left to its TTL.
+    """
+
+    _keys_cache.clear()
+
+
 def get_keys_s3(client, bucket, environment, crypt_secret):
     """
     Get Vault keys from S3.
 
+    When VAULT_KEYS_CACHE_TTL is set, the keys are cached for that many seconds, in memory
+    and, when VAULT_KEYS_CACHE_DIR is set, encrypted in that folder, where the processes
+    sharing it see the keys the others write. Once expired, they are fetched again only
+    when the ETag of their object changed.
+
     :param client: boto3 client instance
     :param bucket: name of the S3 bucket
     :type bucket: str
     :param environment: environment the Vault keys belong to
     :type environment: str
     :param crypt_secret: object storage encryption secret
-    :return: the object string, or None
-    :rtype: str
+    :return: the Vault keys, or None
+    :rtype: dict
     :raises: ClientError if it's not a `NoSuchKey`
     """
 
+    ttl = _keys_cache_ttl()
+    cache_key = entry = None
+    kwargs = {}
+
+    if ttl:
+        cache_key = _keys_cache_key(client, bucket, environment, crypt_secret)
+        entry = _read_keys_cache(cache_key, crypt_secret)
+
+        if entry is not None:
+            if entry['expires'] > time.time():
+                return copy.deepcopy(entry['vault_keys'])
+            if entry.get('etag'):
+                kwargs['IfNoneMatch'] = entry['etag']
+
     blob = None
+    etag = None
 
     try:
         # raises ClientError if the key is not found in the bucket
         # raises KeyError of the key does not contain a body
-        blob = client.get_object(Bucket=bucket, Key=key_path(environment=environment)).get('Body').read()
+        obj = client.get_object(Bucket=bucket, Key=key_path(environment=environment), **kwargs)
+        blob = obj.get('Body').read()
+        etag = obj.get('ETag')
 
     except KeyError:
         return None
 
     except ClientError as e:
+        code = e.response['Error']['Code']
+
+        # the cached keys are current, keep them for another TTL
+        if code in ('304', 'NotModified') and entry is not None:
+            _write_keys_cache(cache_key, crypt_secret, entry['etag'], entry['vault_keys'], ttl)
+            return copy.deepcopy(entry['vault_keys'])
+
         # re-raise when the error code isn't 'NoSuchKey'
-        if e.response['Error']['Code'] != "NoSuchKey":
+        if code != "NoSuchKey":
             raise e
 
-    try:
-        # attempt to decrypt object from object storage with default segment size (128)
-        vault_json = decrypt(blob, crypt_secret)
-        # decode the decrypted json string
-        vault_keys = json.loads(vault_json)
-    except Exception as e:
-        try:
-            # fallback to 8-bit segment size (backwards compatibility)
-            vault_json = decrypt(blob, crypt_secret, segment_size=8)
-            vault_keys = json.loads(vault_json)
-        except Exception:
-            raise ValueError('error decrypting or interpreting vault_json: {}'.format(e))
+    if blob is None:
+        if cache_key is not None:
+            _drop_keys_cache(cache_key)
+        return None
+
+    vault_keys = decode_vault_keys(blob, crypt_secret)
 
     # validate the output and return
-    return sanitize_vault_keys(vault_keys)
+    vault_keys = sanitize_vault_keys(vault_keys)
+
+    if cache_key is not None:
+        _write_keys_cache(cache_key, crypt_secret, etag, vault_keys, ttl)
+
+    return vault_keys
 
 
 def put_keys_s3(client, bucket, environment, vault_keys, crypt_secret):
@@ -146,13 +394,94 @@ def put_keys_s3(client, bucket, environment, vault_keys, crypt_secret):
     # (root_token, keys, keys_base64)
     vault_json = json.dumps(sanitize_vault_keys(vault_keys))
 
-    # encrypt and armor (iv/payload) the Vault keys
+    # encrypt the Vault keys in a versioned envelope
     try:
         vault_crypt = encrypt(vault_json, crypt_secret)
     except Exception as e:
         raise ValueError('error encrypting vault_json: {}'.format(e))
 
     # push the keys to object storage
-    client.put_object(Bucket=bucket, Key=key_path(environment=environment), Body=vault_crypt)
+    response = client.put_object(Bucket=bucket, Key=key_path(environment=environment), Body=vault_crypt)
+
+    # write the keys through the cache, with the ETag of the new object
+    ttl = _keys_cache_ttl()
+    if ttl:
+        cache_key = _keys_cache_key(client, bucket, environment, crypt_secret)
+        _write_keys_cache(cache_key, crypt_secret, response.get('ETag'), sanitize_vault_keys(vault_keys), ttl)
 
     return True
+
+
+def migrate_keys_s3(client, bucket, crypt_secret, environments=None, dry_run=False):
+    """
+    Rewrite the unversioned Vault keys of a bucket in the versioned envelope.
+    The keys are decrypted and checked before they are rewritten, keys that can't be
+    decrypted are left untouched. Readers older than the envelope can't read the
+    migrated keys.
+
+    The keys are only rewritten when their object still has the ETag it was read with,
+    keys written in the meantime, eg. by a Vault init or rekey, are reported `changed`.
+    The object is checked right before the write, S3 has no conditional put here.
+
+    :param client: boto3 client instance
+    :param bucket: name of the S3 bucket
+    :type bucket: str
+    :param crypt_secret: object storage encryption secret
+    :param environments: the environments to migrate (default: all the environments of the bucket)
+    :type environments: list
+    :param dry_run: only report the keys to migrate
+    :type dry_run: bool
+    :return: the outcome by environment: migrated, current, changed, missing or the error, like
+        {"prod": "migrated", "staging": "current"}
+    :rtype: dict
+    :raises ClientError: any S3 errors but a missing key
+    """
+
+    if environments is None:
+        environments = []
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=KEY_PATH_PREFIX):
+            for obj in page.get('Contents', []):
+                path = obj['Key']
+                if path.endswith(KEY_PATH_SUFFIX):
+                    environment = path[len(KEY_PATH_PREFIX):-len(KEY_PATH_SUFFIX)]
+                    if key_path(environment) == path:
+                        environments.append(environment)
+
+    outcome = {}
+    for environment in environments:
+        try:
+            obj = client.get_object(Bucket=bucket, Key=key_path(environment=environment))
+            blob = obj['Body'].read()
+        except ClientError as e:
+            if e.response['Error']['Code'] != "NoSuchKey":
+                raise e
+            outcome[environment] = 'missing'
+            continue
+
+        if not is_legacy(blob):
+            outcome[environment] = 'current'
+            continue
+
+        try:
+            vault_keys = sanitize_vault_keys(decode_vault_keys(blob, crypt_secret))
+        except ValueError as e:
+            outcome[environment] = 'error: {}'.format(e)
+            continue
+
+        if not dry_run:
+            try:
+                etag = client.head_object(Bucket=bucket, Key=key_path(environment=environment)).get('ETag')
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ('404', 'NoSuchKey', 'NotFound'):
+                    raise e
+                etag = None
+
+            if etag != obj.get('ETag'):
+                outcome[environment] = 'changed'
+                continue
+
+            put_keys_s3(client, bucket, environment, vault_keys, crypt_secret)
+        outcome[environment] = 'migrated'
+
+    return outcome
@@ -0,0 +1,95 @@
+import hashlib
+from collections import OrderedDict
+
+from ansible.module_utils._text import to_bytes
+
+
+def vrack_id(a, vracks=5):
+    """
+    Determine a virtual 'rack ID' based on the hostname of the machine.
+    Attempts to extract integers from a dash-separated (-) hostname, eg.
+    iot-private-slave-3. In case the string contains multiple integers,
+    the last one is used.
+
+    The vrack_id is calculated by performing a modulo operation on the
+    base integer. The amount of vracks can be altered using the 'vracks'
+    kwarg.
+
+    In case the base integer (by splitting the string) cannot be derived,
+    the SHA2 hash of the hostname is used as the base for the modulo.
+    This may lead to an uneven distribution in some circumstances.
+    """
+
+    # Extract all integers from the base string
+    n = [int(s) for s in a.split('-') if s.isdigit()]
+
+    # Return the last integer mod the amount of vracks
+    if n:
+        return int(n[-1] % vracks)
+
+    # Base integer(s) could not be derived, fall back to SHA2
+    h = hashlib.sha256(to_bytes(a)).hexdigest()
+    return int(int(h, 16) % vracks)
+
+
+def _vrack_fallbacks(host, vracks, first):
+    """
+    Return the vracks a host falls back to when its vrack_id is full, in an order derived
+    from the SHA2 hash of the hostname and the vrack.
+    """
+
+    return sorted(
+        (r for r in range(vracks) if r != first),
+        key=lambda r: hashlib.sha256(to_bytes('{}/{}'.format(host, r))).hexdigest()
+    )
+
+
+def assign_vracks(hosts, vracks=5):
+    """
+    Assign a virtual 'rack ID' to all the hosts of a list at once, balanced
+    across the vracks.
+
+    Every host gets its vrack_id, unless that vrack already holds its share of
+    the hosts, ceil(hosts / vracks). It then gets the first vrack with room in
+    an order derived from the SHA2 hash of the hostname. Hosts numbered in
+    sequence get the same vrack as with vrack_id, and hashed hostnames are
+    spread evenly instead of at random. Adding hosts to the list only moves the
+    few hosts whose vracks fill up.
+
+    The assignment sorts the whole list, derive it once per play, eg. with the
+    cluster_topology action, rather than once per host.
+
+    :param hosts: the hostnames, eg. groups['all']
+    :type hosts: list
+    :param vracks: the amount of vracks
+    :type vracks: int
+    :return: the vrack of every host, by hostname
+    :rtype: dict
+    :raise ValueError: when vracks is not a positive integer
+    """
+
+    try:
+        vracks = int(vracks)
+    except (TypeError, ValueError):
+        vracks = 0
+
+    if vracks < 1:
+        raise ValueError('vracks must be a positive integer')
+
+    hosts = list(OrderedDict.fromkeys(hosts))
+    capacity = -(-len(hosts) // vracks)
+    loads = [0] * vracks
+    out = {}
+
+    # place the hosts in the order of their hash, so a new host lands anywhere in the order
+    # and only takes a vrack slot that a host placed after it wanted
+    for host in sorted(hosts, key=lambda h: (hashlib.sha256(to_bytes(h)).hexdigest(), h)):
+        rack = vrack_id(host, vracks)
+
+        if loads[rack] >= capacity:
+            rack = next(r for r in _vrack_fallbacks(host, vracks, rack) if loads[r] < capacity)
+
+        loads[rack] += 1
+        out[host] = rack
+
+    return out
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import argparse
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+from os import path
+
+import yaml
+
+from code_executor import init_terraform
+from setup_env import get_args, get_env_path, get_terraform_path
+
+
+def get_batch_args():
+    """Parse argument for the script.
+
+    Returns:
+        object -- the object contains the arguments of the script.
+    """
+
+    parser = argparse.ArgumentParser(description='Setup several clusters at the same time.')
+
+    parser.add_argument('manifest',
+                        help='The path of the manifest file that lists the clusters')
+    parser.add_argument('--max-parallel', '-m', dest='max_parallel', type=int, default=None,
+                        help='The maximum number of clusters setup at the same time')
+
+    args = parser.parse_args()
+    return args
+
+
+def read_manifest(manifest_path):
+    """Read the manifest of the clusters to setup. The manifest is a yaml file, like:
+
+        max_parallel: 4
+        defaults:
+          provider: aws
+          env: staging
+          cluster: dcos
+        clusters:
+          - name: test-1
+          - name: test-2
+            key_type: ed25519
+
+    Every cluster takes the options of setup_env.py, with underscores instead of dashes.
+    The defaults apply to all the clusters.
+
+    Arguments:
+        manifest_path {string} -- The path of the manifest file.
+
+    Returns:
+        tuple -- The maximum number of clusters setup at the same time, and the list of
+        the options of each cluster.
+    """
+
+    with open(manifest_path) as f:
+        manifest = yaml.safe_load(f)
+
+    defaults = manifest.get("defaults", {})
+    clusters = []
+    for cluster in manifest.get("clusters", []):
+        options = dict(defaults)
+        options.update(cluster)
+        clusters.append(options)
+
+    names = [options.get("name") for options in clusters]
+    if len(set(names)) != len(names):
+        raise Exception("The names of the clusters in %s aren't unique." % manifest_path)
+
+    return manifest.get("max_parallel", len(clusters)), clusters
+
+
+def get_setup_argv(options):
+    """Convert the options of a cluster to the arguments of setup_env.py. Every cluster
+    has its own terraform workspace, named after the cluster, and runs unattended.
+
+    Arguments:
+        options {dict} -- The options of the cluster.
+
+    Returns:
+        list -- The arguments of setup_env.py.
+    """
+
+    options = dict(options)
+    options.setdefault("workspace", options.get("name"))
+    options["auto_approve"] = True
+
+    argv = []
+    for key in sorted(options):
+        value = options[key]
+        flag = '--' + key.replace('_', '-')
+        if value is True:
+            argv.append(flag)
+        elif value is not None and value is not False:
+            argv.extend([flag, str(value)])
+    return argv
+
+
+def setup_cluster(argv):
+    """Setup a cluster with setup_env.py in a process of its own. The output is written to
+    setup.log in the environment folder of the cluster.
+
+    Arguments:
+        argv {list} -- The arguments of setup_env.py.
+
+    Returns:
+        dict -- The result of the setup, like:
+        {
+            "name": "test-1",
+            "return_code": 0,
+            "duration": 1250.3,
+            "log": "/path/to/env/aws/staging/dcos/test-1/setup.log"
+        }
+    """
+
+    args = get_args(argv)
+    log_path = path.join(get_env_path(args), 'setup.log')
+    setup_env = path.join(path.dirname(path.realpath(__file__)), 'setup_env.py')
+
+    print("Setting up cluster %s, see %s ..." % (args.name, log_path))
+    start = time.time()
+    with open(log_path, 'w') as log:
+        return_code = subprocess.call(
+            [sys.executable, '-u', setup_env] + argv, stdout=log, stderr=subprocess.STDOUT
+        )
+    result = {
+        "name": args.name,
+        "return_code": return_code,
+        "duration": time.time() - start,
+        "log": log_path,
+    }
+    print("Cluster %s finished with return code %d." % (args.name, return_code))
+    return result
+
+
+def main():
+    # Get the argument of the script.
+    args = get_batch_args()
+    max_parallel, clusters = read_manifest(args.manifest)
+    if args.max_parallel is not None:
+        max_parallel = args.max_parallel
+    if not clusters:
+        print("There are no clusters in %s." % args.manifest)
+        return
+
+    argvs = [get_setup_argv(options) for options in clusters]
+    # Check the arguments of every cluster before starting any of them, and initialize the
+    # terraform folders once, the clusters sharing a folder can't initialize it in parallel.
+    terraform_paths = set(get_terraform_path(get_args(argv)) for argv in argvs)
+    for terraform_path in sorted(terraform_paths):
+        if init_terraform(terraform_path) != 0:
+            print("Failed to initialize terraform in %s." % terraform_path)
+            sys.exit(1)
+
+    pool = ThreadPool(max(1, min(max_parallel, len(argvs))))
+    try:
+        results = pool.map(setup_cluster, argvs)
+    finally:
+        pool.close()
+        pool.join()
+
+    print("Summary:")
+    for result in results:
+        print("  %-24s %-7s %8.1fs  %s" % (
+            result["name"], "ok" if result["return_code"] == 0 else "failed",
+            result["duration"], result["log"]
+        ))
+
+    if any(result["return_code"] != 0 for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+"""Micro-benchmark of helpers.render_template.
+
+Measures the cost of the first render in a new process (cold), with and without the
+bytecode cache on disk, and of the renders after it (warm).
+
+Usage:
+    python benchmarks/bench_render_template.py [--renders N]
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import timeit
+from os import path
+
+sys.path.insert(0, path.realpath(path.join(path.dirname(path.realpath(__file__)), '..')))
+
+import helpers
+
+
+TEMPLATES = {
+    'ansible.cfg.j2': {'ssh_cfg_path': '/tmp/env/ssh.cfg'},
+    'ssh.cfg.j2': {
+        'bastion_ip': '123.123.123.123',
+        'private_key_path': '/tmp/env/private.key',
+        'ssh_cfg_path': '/tmp/env/ssh.cfg',
+        'control_id': '0123456789ab',
+    },
+    'aws_terraform.tfvars.j2': {'cluster_name': 'bench', 'public_key_path': '/tmp/env/public.key'},
+}
+
+
+def render_all():
+    for template_name, kwargs in TEMPLATES.items():
+        helpers.render_template(template_name, **kwargs)
+
+
+def cold_render(cache_path=None):
+    """Render every template with a new environment, like the first render of a process."""
+
+    helpers._TEMPLATE_ENV = None
+    if cache_path is not None:
+        helpers.enable_template_bytecode_cache(cache_path)
+    render_all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark helpers.render_template.')
+    parser.add_argument('--renders', type=int, default=1000,
+                        help='The number of renders of each measure')
+    args = parser.parse_args()
+
+    cache_path = tempfile.mkdtemp()
+    try:
+        # Fill the bytecode cache.
+        cold_render(cache_path)
+
+        results = [
+            ('cold, no bytecode cache', timeit.timeit(cold_render, number=args.renders)),
+            ('cold, bytecode cache', timeit.timeit(lambda: cold_render(cache_path), number=args.renders)),
+            ('warm', timeit.timeit(render_all, number=args.renders)),
+        ]
+    finally:
+        helpers._TEMPLATE_ENV = None
+        shutil.rmtree(cache_path, True)
+
+    print("%d renders of %d templates" % (args.renders, len(TEMPLATES)))
+    for name, seconds in results:
+        print("  %-24s %8.1f us per render" % (name, seconds / args.renders / len(TEMPLATES) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""Throughput benchmark of the encryption of files with secret_storage.
+
+Every payload size runs in a process of its own, which reports the throughput and the
+peak memory of:
+    stream    -- encrypt_file and decrypt_file, chunk by chunk
+    in memory -- encrypt and decrypt of the whole payload, skipped above --max-in-memory
+
+The payloads are printable, the in-memory decrypt only returns text.
+
+Usage:
+    python benchmarks/bench_secret_storage.py [--sizes 1,16,128,1024] [--chunk-size 1024]
+                                              [--max-in-memory 128]
+"""
+
+import argparse
+import json
+import os
+import resource
+import shutil
+import string
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+
+sys.path.insert(0, path.realpath(path.join(path.dirname(path.realpath(__file__)), '..', '..', 'packer', 'provision',
+                                           'roles', 'libraries', 'module_utils')))
+
+import secret_storage
+
+MB = 1024 * 1024
+
+KEY = b'0123456789abcdef0123456789abcdef'
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def write_payload(payload_path, size_mb):
+    """Write a printable payload of `size_mb` MB, one random MB repeated."""
+
+    alphabet = (string.ascii_letters + string.digits).encode('ascii')
+    block = bytes(bytearray(alphabet[b % len(alphabet)] for b in bytearray(os.urandom(MB))))
+
+    with open(payload_path, 'wb') as f:
+        for _ in range(size_mb):
+            f.write(block)
+
+
+def run_once(size_mb, chunk_size, max_in_memory, result_file):
+    work_dir = tempfile.mkdtemp()
+    try:
+        payload = path.join(work_dir, 'payload')
+        encrypted = path.join(work_dir, 'payload.enc')
+        decrypted = path.join(work_dir, 'payload.out')
+
+        write_payload(payload, size_mb)
+        base_rss = peak_rss_mb()
+
+        start = time.time()
+        secret_storage.encrypt_file(payload, encrypted, KEY, chunk_size)
+        encrypt_seconds = time.time() - start
+
+        start = time.time()
+        secret_storage.decrypt_file(encrypted, decrypted, KEY)
+        decrypt_seconds = time.time() - start
+
+        result = {
+            'size_mb': size_mb,
+            'stream_encrypt_mb_s': size_mb / encrypt_seconds,
+            'stream_decrypt_mb_s': size_mb / decrypt_seconds,
+            'stream_rss_mb': peak_rss_mb() - base_rss,
+        }
+
+        os.remove(encrypted)
+        os.remove(decrypted)
+
+        if size_mb <= max_in_memory:
+            with open(payload, 'rb') as f:
+                plain = f.read()
+
+            start = time.time()
+            armor = secret_storage.encrypt(plain, KEY)
+            encrypt_seconds = time.time() - start
+
+            start = time.time()
+            secret_storage.decrypt(armor, KEY)
+            decrypt_seconds = time.time() - start
+
+            result.update({
+                'memory_encrypt_mb_s': size_mb / encrypt_seconds,
+                'memory_decrypt_mb_s': size_mb / decrypt_seconds,
+                'memory_rss_mb': peak_rss_mb() - base_rss,
+            })
+    finally:
+        shutil.rmtree(work_dir, True)
+
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the encryption of files with secret_storage.')
+    parser.add_argument('--sizes', default='1,16,128,1024',
+                        help='Comma-separated payload sizes, in MB')
+    parser.add_argument('--chunk-size', type=int, default=secret_storage.STREAM_CHUNK_SIZE // 1024,
+                        help='The chunk size of the streams, in KB')
+    parser.add_argument('--max-in-memory', type=int, default=128,
+                        help='The largest payload to encrypt in memory too, in MB')
+    parser.add_argument('--run-once', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once is not None:
+        run_once(args.run_once, args.chunk_size * 1024, args.max_in_memory, args.result_file)
+        return
+
+    results = []
+    for size_mb in [int(s) for s in args.sizes.split(',')]:
+        fd, result_file = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        try:
+            subprocess.check_call([
+                sys.executable, path.realpath(__file__), '--run-once', str(size_mb),
+                '--chunk-size', str(args.chunk_size), '--max-in-memory', str(args.max_in_memory),
+                '--result-file', result_file,
+            ])
+            with open(result_file) as f:
+                results.append(json.load(f))
+        finally:
+            os.remove(result_file)
+
+    print("chunks of %d KB, throughput in MB/s, memory above the baseline in MB" % args.chunk_size)
+    print("%8s | %9s %9s %9s | %9s %9s %9s" % (
+        'size MB', 'stream en', 'stream de', 'rss', 'memory en', 'memory de', 'rss'))
+    for r in results:
+        memory = ('%9.1f %9.1f %9.1f' % (r['memory_encrypt_mb_s'], r['memory_decrypt_mb_s'], r['memory_rss_mb'])
+                  if 'memory_rss_mb' in r else '%9s %9s %9s' % ('-', '-', '-'))
+        print("%8d | %9.1f %9.1f %9.1f | %s" % (
+            r['size_mb'], r['stream_encrypt_mb_s'], r['stream_decrypt_mb_s'], r['stream_rss_mb'], memory))
+
+
+if __name__ == '__main__':
+    main()
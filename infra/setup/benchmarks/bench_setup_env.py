@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+"""End-to-end benchmark of setup_env.setup with local stand-ins for the cloud.
+
+A fake terraform executable writes a tfstate with N nodes after configurable delays, and
+a local paramiko server stands in for the bastion and, through it, for the other nodes.
+The playbooks are replaced by one debug task per play, so the ansible session, the forks
+and the playbook scheduling are measured without configuring anything.
+
+Every node count runs in a process of its own, which reports:
+    total             -- the wall time of setup_env.setup
+    terraform         -- the time spent in terraform commands
+    outside_external  -- the wall time outside the terraform commands
+    inventory         -- the time to read the tfstate and write the inventory
+    ssh_check         -- the time to check the ssh availability of all the nodes
+    playbooks         -- the time from the start of the first playbook to the end of the last
+    peak_rss_mb       -- the peak memory of the setup process
+    peak_child_rss_mb -- the peak memory of the largest process it started
+
+Usage:
+    python benchmarks/bench_setup_env.py [--nodes 5,50,500] [--write-baseline FILE]
+                                         [--compare FILE [--tolerance 0.25]]
+"""
+
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from os import close, environ, fdopen, makedirs, path, pathsep, remove
+
+import paramiko
+
+SETUP_PATH = path.realpath(path.join(path.dirname(path.realpath(__file__)), '..'))
+sys.path.insert(0, SETUP_PATH)
+
+# The bastion is reached over tcp, the other nodes through it, so only the bastion needs
+# an address of the machine.
+BASTION_IP = '127.0.0.1'
+
+# The metrics compared with a baseline, all of them lower is better.
+METRICS = ['total', 'outside_external', 'inventory', 'ssh_check', 'playbooks', 'peak_rss_mb']
+
+FAKE_TERRAFORM = '''#!%(python)s
+import json, os, sys, time
+
+command = sys.argv[1]
+nodes = json.loads(os.environ["BENCH_NODES"])
+if command == "init":
+    os.mkdir(".terraform")
+elif command == "workspace":
+    os.makedirs(os.path.join("terraform.tfstate.d", sys.argv[3]))
+elif command == "plan":
+    time.sleep(float(os.environ["BENCH_PLAN_DELAY"]))
+    plan_file = [arg[len("-out="):] for arg in sys.argv if arg.startswith("-out=")][0]
+    with open(plan_file, "w") as f:
+        f.write("plan")
+    print("Plan: %%d to add, 0 to change, 0 to destroy." %% len(nodes["resources"]))
+elif command == "apply":
+    delay = float(os.environ["BENCH_APPLY_DELAY"])
+    for name in nodes["resources"]:
+        print("%%s: Creating..." %% name)
+    time.sleep(delay)
+    for name in nodes["resources"]:
+        print("%%s: Creation complete after %%ds (ID: i-0123456789)" %% (name, delay))
+    outputs = dict(
+        (output, {"sensitive": False, "type": "string", "value": ",".join(ips)})
+        for output, ips in nodes["outputs"].items()
+    )
+    resources = dict(
+        (name, {"type": "aws_instance", "primary": {
+            "id": "i-0123456789", "attributes": {"private_ip": ip, "instance_type": "m4.large"}
+        }})
+        for name, ip in nodes["resources"].items()
+    )
+    state = {"version": 3, "terraform_version": "0.11.7", "serial": 1, "modules": [
+        {"path": ["root"], "outputs": outputs, "resources": resources}
+    ]}
+    workspace = os.environ.get("TF_WORKSPACE")
+    tfstate_dir = "." if workspace in (None, "default") else os.path.join("terraform.tfstate.d", workspace)
+    with open(os.path.join(tfstate_dir, "terraform.tfstate"), "w") as f:
+        json.dump(state, f, indent=2)
+    print("Apply complete! Resources: %%d added, 0 changed, 0 destroyed." %% len(nodes["resources"]))
+'''
+
+PLAYBOOK = '''---
+- hosts: %(group)s
+  gather_facts: no
+  tasks:
+    - name: configure %(group)s
+      debug:
+        msg: "{{ inventory_hostname }}"
+'''
+
+
+def get_nodes(node_count):
+    """Lay out a cluster of node_count nodes, with a bastion, masters, public and private slaves.
+
+    Returns:
+        dict -- The outputs and the resources of the tfstate written by the fake terraform.
+    """
+
+    master_count = 3 if node_count >= 10 else 1
+    public_count = max(1, node_count // 10)
+    private_count = max(1, node_count - 1 - master_count - public_count)
+
+    ips = ['10.0.%d.%d' % (i // 250, i % 250 + 2) for i in range(node_count)]
+    groups = [
+        ('master', 'master_private_ips', master_count),
+        ('public_slave', 'public_slave_private_ips', public_count),
+        ('private_slave', 'private_slave_private_ips', private_count),
+    ]
+    outputs = {'bastion_public_ip': [BASTION_IP]}
+    resources = {'aws_instance.bastion': BASTION_IP}
+    for group, output, count in groups:
+        outputs[output] = [ips.pop() for _ in range(count)]
+        for index, ip in enumerate(outputs[output]):
+            resources['aws_instance.%s.%d' % (group, index)] = ip
+    return {'outputs': outputs, 'resources': resources}
+
+
+class StandInServer(paramiko.ServerInterface):
+    """The ssh server of the stand-in nodes. Any public key is accepted and the nodes
+    behind the bastion are reachable once they are booted."""
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        if not self.hosts.is_booted(destination[0]):
+            return paramiko.OPEN_FAILED_CONNECT_FAILED
+        return paramiko.OPEN_SUCCEEDED
+
+
+class StandInHosts(object):
+    """Local stand-ins of the nodes of a cluster. The bastion listens on a local port and
+    serves the other nodes on the channels forwarded through it, each one with a ssh
+    server of its own. A node boots a random time, up to boot_delay seconds, after the
+    first node behind the bastion is tried."""
+
+    def __init__(self, ips, boot_delay=0, seed=0):
+        rand = random.Random(seed)
+        self.boot_offsets = dict((ip, rand.uniform(0, boot_delay)) for ip in ips)
+        self.boot_start = None
+        self.lock = threading.Lock()
+        self.host_key = paramiko.ECDSAKey.generate()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((BASTION_IP, 0))
+        self.listener.listen(128)
+        self.port = self.listener.getsockname()[1]
+
+    def is_booted(self, ip):
+        with self.lock:
+            if self.boot_start is None:
+                self.boot_start = time.time()
+        return time.time() >= self.boot_start + self.boot_offsets.get(ip, 0)
+
+    def start(self):
+        self._spawn(self._accept)
+
+    def stop(self):
+        self.listener.close()
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except socket.error:
+                return
+            self._spawn(self._serve, sock, True)
+
+    def _serve(self, sock, forward):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=StandInServer(self))
+        except (paramiko.SSHException, EOFError, socket.error):
+            return
+        while forward and transport.is_active():
+            channel = transport.accept(1)
+            if channel is not None:
+                self._spawn(self._serve, channel, False)
+
+
+def run_once(node_count, apply_delay, plan_delay, boot_delay, result_file):
+    """Set up a cluster of node_count stand-in nodes and write the measures to result_file."""
+
+    import helpers
+    import setup_env
+    import tracing
+
+    nodes = get_nodes(node_count)
+    root = tempfile.mkdtemp(prefix='bench_setup_env')
+    try:
+        bin_path = path.join(root, 'bin')
+        terraform_path = path.join(root, 'terraform')
+        modules_path = path.join(root, 'modules')
+        ansible_path = path.join(root, 'ansible')
+        env_path = path.join(root, 'env')
+        for folder in [bin_path, terraform_path, modules_path, ansible_path, env_path]:
+            makedirs(folder)
+
+        fake_terraform = path.join(bin_path, 'terraform')
+        with open(fake_terraform, 'w') as f:
+            f.write(FAKE_TERRAFORM % {'python': sys.executable})
+        subprocess.check_call(['chmod', '+x', fake_terraform])
+        shutil.copy(path.join(SETUP_PATH, '..', 'terraform', 'providers', 'aws', 'prod', 'prod.tf'),
+                    terraform_path)
+        for name, group in setup_env.PLAYBOOK_GROUPS.items():
+            with open(path.join(ansible_path, name + '.yml'), 'w') as f:
+                f.write(PLAYBOOK % {'group': group})
+
+        environ['PATH'] = bin_path + pathsep + environ['PATH']
+        environ['BENCH_NODES'] = json.dumps(nodes)
+        environ['BENCH_APPLY_DELAY'] = str(apply_delay)
+        environ['BENCH_PLAN_DELAY'] = str(plan_delay)
+
+        setup_env.get_terraform_path = lambda args: terraform_path
+        setup_env.get_terraform_modules_path = lambda args: modules_path
+        setup_env.get_ansible_path = lambda args: ansible_path
+        setup_env.get_env_path = lambda args: env_path
+
+        hosts = StandInHosts(nodes['resources'].values(), boot_delay)
+        hosts.start()
+        helpers.connect_ssh = partial(helpers.connect_ssh, port=hosts.port)
+
+        args = setup_env.get_args(['-p', 'aws', '-e', 'prod', '-c', 'dcos', '-n', 'bench',
+                                   '--key-type', 'ed25519', '--auto-approve'])
+        start = time.time()
+        try:
+            setup_env.setup(args)
+        finally:
+            total = time.time() - start
+            hosts.stop()
+    finally:
+        shutil.rmtree(root, True)
+
+    spans = [event for event in tracing.TRACER.events if event["ph"] == "X"]
+
+    def span_seconds(names):
+        matched = [span for span in spans if span["name"] in names]
+        if not matched:
+            return 0.0
+        return (max(span["ts"] + span["dur"] for span in matched) -
+                min(span["ts"] for span in matched)) / 1e6
+
+    terraform = sum(span["dur"] for span in spans
+                    if span["name"].startswith('terraform ')) / 1e6
+    # Linux reports the peak memory in kilobytes.
+    result = {
+        'nodes': node_count,
+        'total': total,
+        'terraform': terraform,
+        'outside_external': total - terraform,
+        'inventory': span_seconds(['generate inventory']),
+        'ssh_check': span_seconds(['ssh check']),
+        'playbooks': span_seconds([name + ' playbook' for name in setup_env.PLAYBOOK_GRAPH]),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0,
+    }
+    with open(result_file, 'w') as f:
+        json.dump(result, f)
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results with a baseline.
+
+    Returns:
+        list -- The descriptions of the metrics that are worse than the baseline by more
+        than the tolerance.
+    """
+
+    regressions = []
+    baseline_results = dict((result['nodes'], result) for result in baseline['results'])
+    for result in results:
+        base = baseline_results.get(result['nodes'])
+        if base is None:
+            continue
+        for metric in METRICS:
+            if base.get(metric) and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append('%s at %d nodes: %.2f, baseline %.2f' % (
+                    metric, result['nodes'], result[metric], base[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark setup_env.setup end to end.')
+    parser.add_argument('--nodes', default='5,50,500',
+                        help='The node counts to measure, separated by commas')
+    parser.add_argument('--apply-delay', type=float, default=1.0,
+                        help='Seconds the fake terraform apply takes')
+    parser.add_argument('--plan-delay', type=float, default=0.5,
+                        help='Seconds the fake terraform plan takes')
+    parser.add_argument('--boot-delay', type=float, default=0.0,
+                        help='Seconds up to which a stand-in node takes to accept ssh')
+    parser.add_argument('--write-baseline', dest='baseline_out', default=None,
+                        help='Write the results to this baseline file')
+    parser.add_argument('--compare', dest='baseline_in', default=None,
+                        help='Compare the results with this baseline file')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='The part a metric can exceed the baseline by')
+    parser.add_argument('--run-once', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_once is not None:
+        run_once(args.run_once, args.apply_delay, args.plan_delay, args.boot_delay,
+                 args.result_file)
+        return
+
+    results = []
+    for node_count in [int(count) for count in args.nodes.split(',')]:
+        result_fd, result_file = tempfile.mkstemp(suffix='.json')
+        close(result_fd)
+        log_fd, log_file = tempfile.mkstemp(suffix='.log')
+        # A process for every node count, so the peak memory of a run is its own.
+        with fdopen(log_fd, 'w') as log:
+            return_code = subprocess.call(
+                [sys.executable, path.realpath(__file__), '--run-once', str(node_count),
+                 '--result-file', result_file, '--apply-delay', str(args.apply_delay),
+                 '--plan-delay', str(args.plan_delay), '--boot-delay', str(args.boot_delay)],
+                stdout=log, stderr=subprocess.STDOUT
+            )
+        if return_code != 0:
+            remove(result_file)
+            print("The run with %d nodes failed, see %s" % (node_count, log_file))
+            sys.exit(1)
+        with open(result_file) as f:
+            results.append(json.load(f))
+        subprocess.call(['rm', '-f', result_file, log_file])
+
+    print("%6s %8s %9s %9s %9s %9s %9s %9s %9s" % (
+        'nodes', 'total', 'terraform', 'outside', 'inventory', 'ssh', 'playbooks', 'rss MB',
+        'child MB'))
+    for result in results:
+        print("%6d %8.2f %9.2f %9.2f %9.2f %9.2f %9.2f %9.1f %9.1f" % (
+            result['nodes'], result['total'], result['terraform'], result['outside_external'],
+            result['inventory'], result['ssh_check'], result['playbooks'],
+            result['peak_rss_mb'], result['peak_child_rss_mb']))
+
+    if args.baseline_out is not None:
+        with open(args.baseline_out, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'settings': {
+                    'apply_delay': args.apply_delay,
+                    'plan_delay': args.plan_delay,
+                    'boot_delay': args.boot_delay,
+                },
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        print("Wrote the baseline to %s" % args.baseline_out)
+
+    if args.baseline_in is not None:
+        with open(args.baseline_in) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("Regression: %s" % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
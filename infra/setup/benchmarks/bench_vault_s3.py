@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+
+"""Benchmark of the S3 calls of vault_s3 against a local S3 stand-in.
+
+The stand-in serves a configurable number of buckets after a configurable latency, like
+a bucket in a remote region, and reports:
+    bucket_exists  -- the list of all the buckets, a head request, and a cached head request
+    clients        -- a new boto3 client per call, and the shared client of aws_utils
+    get_keys_s3    -- a fetch of the Vault keys with a new client, and with the shared one
+
+and then the fetches of the Vault keys with the keys cache of vault_s3:
+    none        -- without the cache
+    fresh       -- cached in memory, within the TTL
+    revalidated -- cached in memory, past the TTL, with an unchanged ETag
+    disk        -- cached in the cache folder, within the TTL, like in a new process
+
+Usage:
+    python benchmarks/bench_vault_s3.py [--buckets 10,100,1000] [--latency 20] [--calls 20]
+"""
+
+import argparse
+import hashlib
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import boto3
+from botocore.config import Config
+
+MODULE_UTILS_PATH = path.realpath(path.join(path.dirname(path.realpath(__file__)), '..', '..', 'packer', 'provision',
+                                            'roles', 'libraries', 'module_utils'))
+
+# vault_s3 loads its module_utils with the module_utils loader of ansible, which reads its
+# paths from the environment, and so does this script
+os.environ.setdefault('ANSIBLE_MODULE_UTILS', MODULE_UTILS_PATH)
+sys.path.insert(0, MODULE_UTILS_PATH)
+
+import vault_s3
+from ansible.plugins.loader import module_utils_loader as ml
+
+# the aws_utils of vault_s3, which keys its caches on the clients of aws_utils
+aws_utils = ml._load_module_source('aws_utils', ml.find_plugin('aws_utils'))
+
+CREDENTIALS = {'access_key': 'bench', 'secret_key': 'bench'}
+
+KEY = b'0123456789abcdef0123456789abcdef'
+
+VAULT_KEYS = {'root_token': 'token', 'keys': ['key'] * 5, 'keys_base64': ['a2V5'] * 5}
+
+
+class S3StandIn(ThreadingMixIn, HTTPServer):
+    """A local S3 with path-style addressing: list of buckets, head of a bucket, get and put of objects."""
+
+    daemon_threads = True
+
+    def __init__(self, buckets, latency):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), S3Handler)
+        self.buckets = set(buckets)
+        self.latency = latency
+        self.objects = {}
+        self.connections = set()
+
+    @property
+    def endpoint_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        ThreadingMixIn.process_request(self, request, client_address)
+
+    def handle_error(self, request, client_address):
+        # the connections kept alive are closed by stop()
+        pass
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        self.server_close()
+
+
+class S3Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # send the replies at once, or the delayed acks of the clients add to the latency
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        self._reply(status, ('<Error><Code>%s</Code></Error>' % code).encode('utf-8'))
+
+    def _route(self):
+        time.sleep(self.server.latency)
+
+        parts = self.path.split('?')[0].lstrip('/').split('/', 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 else None
+
+        body = b''
+        if 'Content-Length' in self.headers:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+
+        if not bucket:
+            names = ''.join('<Bucket><Name>%s</Name><CreationDate>2018-01-01T00:00:00.000Z</CreationDate></Bucket>'
+                            % name for name in sorted(self.server.buckets))
+            return self._reply(200, ('<ListAllMyBucketsResult><Buckets>%s</Buckets></ListAllMyBucketsResult>'
+                                     % names).encode('utf-8'))
+
+        if bucket not in self.server.buckets:
+            return self._error(404, 'NoSuchBucket')
+
+        if key is None:
+            return self._reply(200)
+
+        if self.command == 'PUT':
+            etag = '"%s"' % hashlib.md5(body).hexdigest()
+            self.server.objects[(bucket, key)] = (body, etag)
+            return self._reply(200, headers={'ETag': etag})
+
+        if (bucket, key) not in self.server.objects:
+            return self._error(404, 'NoSuchKey')
+
+        body, etag = self.server.objects[(bucket, key)]
+        if self.headers.get('If-None-Match') == etag:
+            return self._reply(304, headers={'ETag': etag})
+
+        return self._reply(200, body, {'ETag': etag})
+
+    do_GET = do_HEAD = do_PUT = _route
+
+
+def new_client(endpoint_url):
+    return boto3.client('s3', endpoint_url=endpoint_url, region_name='us-east-1',
+                        aws_access_key_id='bench', aws_secret_access_key='bench',
+                        config=Config(s3={'addressing_style': 'path'}))
+
+
+def list_bucket_exists(client, bucket):
+    """The check of bucket_exists before the head requests."""
+
+    return bucket in [b['Name'] for b in client.list_buckets()['Buckets']]
+
+
+def measure(func, calls):
+    start = time.time()
+    for _ in range(calls):
+        func()
+    return (time.time() - start) / calls * 1000
+
+
+def measure_keys_cache(client, bucket, calls):
+    """Measure the fetches of the Vault keys with the keys cache, see the module documentation."""
+
+    cache_dir = tempfile.mkdtemp()
+    fetch = lambda: vault_s3.get_keys_s3(client, bucket, 'bench', KEY)
+
+    def fetch_from_disk():
+        vault_s3.clear_keys_cache()
+        fetch()
+
+    try:
+        os.environ.pop(vault_s3.KEYS_CACHE_TTL_ENV, None)
+        results = [measure(fetch, calls)]
+
+        os.environ[vault_s3.KEYS_CACHE_TTL_ENV] = '3600'
+        fetch()
+        results.append(measure(fetch, calls))
+
+        # expired as soon as cached, every fetch is revalidated
+        os.environ[vault_s3.KEYS_CACHE_TTL_ENV] = '0.000001'
+        vault_s3.clear_keys_cache()
+        fetch()
+        results.append(measure(fetch, calls))
+
+        os.environ[vault_s3.KEYS_CACHE_TTL_ENV] = '3600'
+        os.environ[vault_s3.KEYS_CACHE_DIR_ENV] = cache_dir
+        vault_s3.put_keys_s3(client, bucket, 'bench', VAULT_KEYS, KEY)
+        results.append(measure(fetch_from_disk, calls))
+    finally:
+        os.environ.pop(vault_s3.KEYS_CACHE_TTL_ENV, None)
+        os.environ.pop(vault_s3.KEYS_CACHE_DIR_ENV, None)
+        vault_s3.clear_keys_cache()
+        shutil.rmtree(cache_dir, True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the S3 calls of vault_s3 against a local stand-in.')
+    parser.add_argument('--buckets', default='10,100,1000',
+                        help='Comma-separated numbers of buckets in the account')
+    parser.add_argument('--latency', type=float, default=20,
+                        help='The latency of every request, in ms')
+    parser.add_argument('--calls', type=int, default=20,
+                        help='The number of calls of each measure')
+    args = parser.parse_args()
+
+    print("latency of %.0f ms per request, time per call in ms" % args.latency)
+    print("%8s | %9s %9s %9s | %9s %9s | %9s %9s" % (
+        'buckets', 'list', 'head', 'cached', 'new', 'shared', 'new', 'shared'))
+
+    keys_cache = None
+    for bucket_count in [int(b) for b in args.buckets.split(',')]:
+        buckets = ['bucket-%05d' % i for i in range(bucket_count)]
+        server = S3StandIn(buckets, args.latency / 1000.0)
+        server.start()
+        try:
+            endpoint_url = server.endpoint_url
+            bucket = buckets[-1]
+
+            aws_utils.clear_clients()
+            client = aws_utils.get_client('s3', region='us-east-1', endpoint_url=endpoint_url, **CREDENTIALS)
+            vault_s3.put_keys_s3(client, bucket, 'bench', VAULT_KEYS, KEY)
+
+            exists = [
+                measure(lambda: list_bucket_exists(client, bucket), args.calls),
+                measure(lambda: vault_s3.bucket_exists(client, bucket, ttl=0), args.calls),
+            ]
+            vault_s3.bucket_exists(client, bucket)
+            exists.append(measure(lambda: vault_s3.bucket_exists(client, bucket), args.calls))
+            clients = [
+                measure(lambda: new_client(endpoint_url), args.calls),
+                measure(lambda: aws_utils.get_client('s3', region='us-east-1', endpoint_url=endpoint_url,
+                                                     **CREDENTIALS), args.calls),
+            ]
+            get_keys = [
+                measure(lambda: vault_s3.get_keys_s3(new_client(endpoint_url), bucket, 'bench', KEY), args.calls),
+                measure(lambda: vault_s3.get_keys_s3(
+                    aws_utils.get_client('s3', region='us-east-1', endpoint_url=endpoint_url, **CREDENTIALS),
+                    bucket, 'bench', KEY), args.calls),
+            ]
+            if keys_cache is None:
+                keys_cache = measure_keys_cache(client, bucket, args.calls)
+        finally:
+            server.stop()
+
+        print("%8d | %9.1f %9.1f %9.3f | %9.1f %9.3f | %9.1f %9.1f" % (
+            (bucket_count,) + tuple(exists) + tuple(clients) + tuple(get_keys)))
+
+    print("")
+    print("get_keys_s3 with the keys cache, time per call in ms")
+    print("%9s %9s %11s %9s" % ('none', 'fresh', 'revalidated', 'disk'))
+    print("%9.1f %9.3f %11.1f %9.3f" % tuple(keys_cache))
+
+
+if __name__ == '__main__':
+    main()
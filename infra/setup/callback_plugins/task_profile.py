@@ -0,0 +1,106 @@
+# the callbacks package has a json plugin, which an implicit relative import would load instead
+from __future__ import absolute_import
+
+import json
+import os
+import time
+from collections import OrderedDict
+from os import makedirs, path
+
+from ansible.plugins.callback import CallbackBase
+
+# Folder of the records files, one per playbook (default: nothing is recorded)
+TASK_PROFILE_DIR_ENV = 'ANSIBLE_TASK_PROFILE_DIR'
+
+
+class CallbackModule(CallbackBase):
+    """An ansible callback that records the wall time of every task on every host.
+    The time of a task on a host runs from the start of the task to the result of the host,
+    so it includes the wait for a free fork when there are more hosts than forks.
+
+    Enable it with ANSIBLE_CALLBACK_WHITELIST=task_profile, the records of every playbook are
+    written to a file of their own in the folder of ANSIBLE_TASK_PROFILE_DIR when the
+    playbooks end.
+    """
+
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'task_profile'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self.playbook = None
+        self.play = None
+        self.task_starts = {}
+        # the records of the playbooks of the executor, by playbook
+        self.records = OrderedDict()
+
+    def v2_playbook_on_start(self, playbook):
+        self.playbook = path.splitext(path.basename(playbook._file_name))[0]
+        self.play = None
+        self.task_starts = {}
+        self.records.setdefault(self.playbook, [])
+
+    def v2_playbook_on_play_start(self, play):
+        self.play = play.get_name()
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self.task_starts[task._uuid] = time.time()
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self.task_starts[task._uuid] = time.time()
+
+    def _record(self, result, status):
+        """Record the time a task took on a host.
+
+        Arguments:
+            result {TaskResult} -- The result of the task on the host.
+            status {string} -- The status of the result, like ok or failed.
+        """
+
+        task = result._task
+        start = self.task_starts.get(task._uuid)
+        if start is None:
+            return
+        self.records[self.playbook].append({
+            "playbook": self.playbook,
+            "play": self.play,
+            "task": task.get_name(),
+            "host": result._host.get_name(),
+            "status": status,
+            "start": start,
+            "duration": time.time() - start,
+        })
+
+    def v2_runner_on_ok(self, result):
+        self._record(result, 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._record(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._record(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        """Write the task times recorded by every playbook to its records file. Depending on
+        the ansible version, the stats are sent after every playbook or once after the last
+        one, so the records of all the playbooks are kept and written every time.
+        """
+
+        records_dir = os.environ.get(TASK_PROFILE_DIR_ENV)
+        if not records_dir:
+            return
+
+        # the playbooks running in parallel share the folder
+        try:
+            makedirs(records_dir)
+        except OSError:
+            if not path.isdir(records_dir):
+                raise
+        for playbook, records in self.records.items():
+            with open(path.join(records_dir, playbook + '.json'), 'w') as file_handler:
+                json.dump(records, file_handler)
@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
+import re
 import sys
 import json
-from os import environ, path
+import glob
+import time
+import subprocess
+from os import environ, path, remove
 
-# Terraform libs
-from python_terraform import Terraform
+import tracing
+from helpers import DEFAULT_WORKSPACE, get_files_hash, get_forks, get_tfstate_path
+from task_profile import clear_profile_records, write_profile_report
 
 # Ansible libs
 import shutil
@@ -15,47 +20,498 @@ from ansible.parsing.dataloader import DataLoader
 from ansible.vars.manager import VariableManager
 from ansible.inventory.manager import InventoryManager
 from ansible.executor.playbook_executor import PlaybookExecutor
+from ansible.plugins.loader import callback_loader
 
 
 
-def execute_terraform(working_dir):
+# Resource events in the output of terraform apply, like:
+#   aws_instance.master: Creating...
+#   aws_instance.master: Creation complete after 1m2s (ID: i-0123456789abcdef0)
+TERRAFORM_START_EVENT = re.compile(r'^(?P<resource>\S+): (?P<action>Creating|Modifying|Destroying)\.\.\.')
+TERRAFORM_COMPLETE_EVENT = re.compile(
+    r'^(?P<resource>\S+): (?P<action>Creation|Modifications|Destruction) complete after (?P<duration>\S+)'
+)
+TERRAFORM_ACTIONS = {
+    'Creating': 'create',
+    'Creation': 'create',
+    'Modifying': 'modify',
+    'Modifications': 'modify',
+    'Destroying': 'destroy',
+    'Destruction': 'destroy',
+}
+
+
+def parse_duration(duration):
+    """Convert a terraform duration, like 1h2m3s, to seconds.
+
+    Arguments:
+        duration {string} -- The terraform duration.
+
+    Returns:
+        int -- The duration in seconds.
+    """
+
+    seconds = 0
+    for value, unit in re.findall(r'(\d+)([hms])', duration):
+        seconds += int(value) * {'h': 3600, 'm': 60, 's': 1}[unit]
+    return seconds
+
+
+def parse_terraform_event(line):
+    """Parse a resource event from a line of terraform output.
+
+    Arguments:
+        line {string} -- The line of terraform output.
+
+    Returns:
+        dict -- The event, or None if the line isn't a resource event, like:
+        {
+            "resource": "aws_instance.master",
+            "action": "create",
+            "phase": "complete",
+            "duration": 62
+        }
+    """
+
+    match = TERRAFORM_START_EVENT.match(line)
+    if match:
+        return {
+            "resource": match.group('resource'),
+            "action": TERRAFORM_ACTIONS[match.group('action')],
+            "phase": "start",
+            "duration": None,
+        }
+
+    match = TERRAFORM_COMPLETE_EVENT.match(line)
+    if match:
+        return {
+            "resource": match.group('resource'),
+            "action": TERRAFORM_ACTIONS[match.group('action')],
+            "phase": "complete",
+            "duration": parse_duration(match.group('duration')),
+        }
+
+    return None
+
+
+class TerraformStream(object):
+    """Run a terraform command and iterate over its output line by line while it runs.
+    Every line is yielded with the resource event parsed from it, or None. Once the
+    iteration is over, return_code holds the return code of the command and events
+    holds all the resource events.
+    """
+
+    def __init__(self, working_dir, command, *args):
+        """
+        Arguments:
+            working_dir {string} -- The path of terraform working direcory.
+            command {string} -- The terraform command, like 'apply'.
+            args -- The options and arguments of the command.
+        """
+
+        self.working_dir = working_dir
+        self.command = ['terraform', command, '-no-color'] + list(args)
+        self.return_code = None
+        self.events = []
+
+    def __iter__(self):
+        process = subprocess.Popen(
+            self.command, cwd=self.working_dir, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, universal_newlines=True
+        )
+        for line in iter(process.stdout.readline, ''):
+            line = line.rstrip('\n')
+            event = parse_terraform_event(line)
+            if event is not None:
+                event["time"] = time.time()
+                self.events.append(event)
+            yield line, event
+        process.stdout.close()
+        self.return_code = process.wait()
+
+
+def run_terraform(working_dir, command, *args):
+    """Run a terraform command and print its output while it runs.
+
+    Arguments:
+        working_dir {string} -- The path of terraform working direcory.
+        command {string} -- The terraform command, like 'apply'.
+        args -- The options and arguments of the command.
+
+    Returns:
+        TerraformStream -- The finished stream, with the return code and the resource events.
+    """
+
+    stream = TerraformStream(working_dir, command, *args)
+    with tracing.span("terraform " + command) as span_args:
+        for line, _ in stream:
+            print(line)
+        span_args["exit_code"] = stream.return_code
+        completed = [event for event in stream.events if event["phase"] == "complete"]
+        if completed:
+            for action in sorted(set(TERRAFORM_ACTIONS.values())):
+                span_args[action] = len([event for event in completed if event["action"] == action])
+            span_args["slowest"] = [
+                "%s %ds" % (event["resource"], event["duration"])
+                for event in sorted(completed, key=lambda event: event["duration"], reverse=True)[:10]
+            ]
+    return stream
+
+
+def print_terraform_events(events, limit=10):
+    """Print the resources that took the longest to complete.
+
+    Arguments:
+        events {list} -- The resource events of a terraform run.
+        limit {int} -- The number of resources to print. (default: {10})
+    """
+
+    completed = [event for event in events if event["phase"] == "complete"]
+    if not completed:
+        return
+
+    print("Slowest resources:")
+    for event in sorted(completed, key=lambda event: event["duration"], reverse=True)[:limit]:
+        print("  %6ds  %-7s  %s" % (event["duration"], event["action"], event["resource"]))
+
+
+def get_terraform_inputs(working_dir, env_path, modules_path, workspace=None):
+    """Get the paths of the files a terraform plan depends on: the terraform code of the
+    working dir, the variables, the modules and the state.
+
+    Arguments:
+        working_dir {string} -- The path of terraform working direcory.
+        env_path {string} -- The path of the environment folder, with the variables.
+        modules_path {string} -- The path of the terraform modules used by the working dir.
+        workspace {string} -- The terraform workspace, None for the default one. (default: {None})
+
+    Returns:
+        list -- The paths of the files and directories.
+    """
+
+    return sorted(glob.glob(path.join(working_dir, '*.tf'))) + [
+        path.join(env_path, 'terraform.tfvars'),
+        modules_path,
+        get_tfstate_path(working_dir, workspace),
+    ]
+
+
+def read_fingerprint(fingerprint_file):
+    """Read a fingerprint, the hash of the inputs of a terraform run.
+
+    Arguments:
+        fingerprint_file {string} -- The path of the fingerprint file.
+
+    Returns:
+        string -- The hash of the inputs, or None if there is no fingerprint.
+    """
+
+    if not path.isfile(fingerprint_file):
+        return None
+    with open(fingerprint_file) as f:
+        return f.read().strip()
+
+
+def write_fingerprint(fingerprint_file, inputs_hash):
+    """Write a fingerprint, the hash of the inputs of a terraform run.
+
+    Arguments:
+        fingerprint_file {string} -- The path of the fingerprint file.
+        inputs_hash {string} -- The hash of the inputs.
+    """
+
+    with open(fingerprint_file, 'w') as file_handler:
+        file_handler.write(inputs_hash)
+
+
+def read_saved_plan(plan_file):
+    """Read the hash of the inputs a saved plan was made from.
+
+    Arguments:
+        plan_file {string} -- The path of the plan file.
+
+    Returns:
+        string -- The hash of the inputs, or None if there is no saved plan.
+    """
+
+    if not path.isfile(plan_file):
+        return None
+    return read_fingerprint(plan_file + '.sha256')
+
+
+def remove_saved_plan(plan_file):
+    """Remove a saved plan and the hash of its inputs.
+
+    Arguments:
+        plan_file {string} -- The path of the plan file.
+    """
+
+    for file_path in [plan_file, plan_file + '.sha256']:
+        if path.isfile(file_path):
+            remove(file_path)
+
+
+def init_terraform(working_dir):
+    """Init the terraform working dir, unless it's already initialized.
+
+    Arguments:
+        working_dir {string} -- The path of terraform working direcory.
+
+    Returns:
+        int -- The return code of terraform init, 0 if it's already initialized.
+    """
+
+    hiden_dir = path.realpath(path.join(working_dir, ".terraform"))
+    if path.isdir(hiden_dir):
+        return 0
+    return run_terraform(working_dir, 'init', '-input=false').return_code
+
+
+def create_terraform_workspace(working_dir, workspace):
+    """Create a terraform workspace, unless it already exists. The workspace is selected
+    with the TF_WORKSPACE environment variable, by every run.
+
+    terraform workspace new also selects the new workspace in the working dir, the default
+    workspace is selected again, so a run of another cluster doesn't end up in it.
+
+    Arguments:
+        working_dir {string} -- The path of terraform working direcory.
+        workspace {string} -- The name of the workspace.
+
+    Returns:
+        int -- The return code of terraform workspace new, 0 if the workspace exists.
+    """
+
+    # terraform starts with the default workspace, it can't be created
+    if workspace in (None, DEFAULT_WORKSPACE):
+        return 0
+
+    if path.isdir(path.join(working_dir, 'terraform.tfstate.d', workspace)):
+        return 0
+
+    # The workspace commands refuse to run while TF_WORKSPACE overrides the selection.
+    env = dict(environ)
+    env.pop('TF_WORKSPACE', None)
+
+    return_code = subprocess.call(['terraform', 'workspace', 'new', workspace], cwd=working_dir, env=env)
+    if return_code == 0:
+        subprocess.call(['terraform', 'workspace', 'select', 'default'], cwd=working_dir, env=env)
+    return return_code
+
+
+def execute_terraform(working_dir, env_path, modules_path, workspace=None, auto_approve=False,
+                      refresh=False):
     """Execute terraform code to setup cloud resources, including servers, networks and so on.
+    The plan is saved in the env path and applied from there, so terraform refreshes the
+    resources once and applies the plan that was approved. A saved plan is reused as long
+    as the terraform code, the variables, the modules and the state are unchanged.
+    The output of terraform is printed while it runs.
+
+    When the inputs are the same as after the last successful apply, there is nothing to
+    do and terraform isn't run at all, unless refresh is set.
     
     Arguments:
         working_dir {string} -- The path of terraform working direcory.
+        env_path {string} -- The path of the environment folder, with the variables. The plan
+        is saved there.
+        modules_path {string} -- The path of the terraform modules used by the working dir.
+        workspace {string} -- The terraform workspace, None for the default one. (default: {None})
+        auto_approve {bool} -- Apply the plan without asking for approval. (default: {False})
+        refresh {bool} -- Run terraform even if the inputs are unchanged. (default: {False})
     
     Returns:
-        string -- return_code, stdout, stderr.
+        int -- The return code of terraform apply.
     """
 
-    tf = Terraform(working_dir=working_dir)
-    hiden_dir = path.realpath(path.join(working_dir, ".terraform"))
+    inputs = get_terraform_inputs(working_dir, env_path, modules_path, workspace)
+    inputs_hash = get_files_hash(inputs)
+    fingerprint_file = path.realpath(path.join(env_path, 'terraform.fingerprint'))
+    if not refresh and read_fingerprint(fingerprint_file) == inputs_hash:
+        print("Terraform inputs are unchanged since the last successful apply, skipping terraform.")
+        return 0
+
     # Init terraform env.
-    if not path.isdir(hiden_dir):
-        tf.init()
+    if init_terraform(working_dir) != 0:
+        sys.exit(1)
 
-    # Run terraform plan.
-    plan_return_code, plan_stdout, plan_stderr = tf.plan()
-    
-    # If there is no error, the stderr returned is unicode instead of a None type. So have to
-    # Check the length of the stderr.
-    if len(plan_stderr) == 0:
-        print(plan_stdout)
+    plan_file = path.realpath(path.join(env_path, 'terraform.tfplan'))
+
+    if read_saved_plan(plan_file) == inputs_hash:
+        print("Reusing the saved plan %s ..." % plan_file)
+        if run_terraform(working_dir, 'show', plan_file).return_code != 0:
+            sys.exit(1)
+    else:
+        # Run terraform plan.
+        remove_saved_plan(plan_file)
+        var_file = path.realpath(path.join(env_path, 'terraform.tfvars'))
+        if run_terraform(working_dir, 'plan', '-input=false', '-var-file=' + var_file,
+                         '-out=' + plan_file).return_code != 0:
+            sys.exit(1)
+        write_fingerprint(plan_file + '.sha256', inputs_hash)
+
+    if not auto_approve:
         input_str = raw_input("Do you want to perform these actions? Only 'yes' will be accepted to approve.\n  Enter a value:")
-        if input_str == "yes":
-            print("Start setting up cloud resources ...")
-            return tf.apply(skip_plan=True)
-        else:
+        if input_str != "yes":
             print("Apply cancelled.")
-            sys.exit()
-    else:
-        print(plan_stderr)
-        sys.exit()
-            
+            sys.exit(1)
+
+    print("Start setting up cloud resources ...")
+    try:
+        stream = run_terraform(working_dir, 'apply', '-input=false', plan_file)
+    finally:
+        # The state has changed, the plan can't be applied again.
+        remove_saved_plan(plan_file)
+    print_terraform_events(stream.events)
+
+    # Record the inputs, including the new state, of the successful apply.
+    if stream.return_code == 0:
+        write_fingerprint(fingerprint_file, get_files_hash(inputs))
+    elif path.isfile(fingerprint_file):
+        remove(fingerprint_file)
+    return stream.return_code
+
+
+# The callback plugins of the sessions, like task_profile
+CALLBACK_PLUGINS_PATH = path.join(path.dirname(path.realpath(__file__)), 'callback_plugins')
+
+# The folder the task_profile callback writes its records to
+TASK_PROFILE_DIR_ENV = 'ANSIBLE_TASK_PROFILE_DIR'
+
+# since API is constructed for CLI it expects certain options to always be set, named tuple 'fakes'
+# the args parsing options object
+Options = namedtuple(
+    'Options', [
+        'connection', 'listhosts', 'listtasks', 'listtags',
+        'syntax', 'module_path', 'forks', 'become', 'become_method',
+        'become_user', 'check', 'diff', 'remote_user', 'verbosity'
+    ]
+)
+
+
+class AnsibleSession(object):
+    """A long-lived ansible session. The inventory is parsed once and the loader, with its
+    file cache, and the variable manager are shared by every playbook run in the session.
+    Playbooks run in forked processes inherit the session of their parent.
+    """
+
+    def __init__(self, inventory_path, max_forks=None, parallel=1, profile=True, **kwargs):
+        """Parse the inventory and set up the shared ansible objects.
+
+        Arguments:
+            inventory_path {string} -- The path of the inventory file.
+            max_forks {int} -- An upper limit of the number of forks of a playbook. (default: {None})
+            parallel {int} -- The number of playbooks of the session running at the same time,
+            they share the CPUs and the memory of the control host. (default: {1})
+            profile {bool} -- Record the time of every task on every host and write a report
+            of them to the folder of the inventory when the session is closed. (default: {True})
+            kwagrs -- Extra varibles for the playbooks.
+        """
+
+        self.inventory_path = inventory_path
+        self.max_forks = max_forks
+        self.parallel = parallel
+        self.profile = profile
+        self.profile_path = path.join(path.dirname(inventory_path), 'ansible_profile')
+        if profile:
+            clear_profile_records(self.profile_path)
+            # ansible reads its configuration when it is imported, before ANSIBLE_CONFIG is set,
+            # so the callback is enabled in the configuration of the session
+            callback_loader.add_directory(CALLBACK_PLUGINS_PATH)
+            if 'task_profile' not in (C.DEFAULT_CALLBACK_WHITELIST or []):
+                C.DEFAULT_CALLBACK_WHITELIST = list(C.DEFAULT_CALLBACK_WHITELIST or []) + ['task_profile']
+            environ[TASK_PROFILE_DIR_ENV] = self.profile_path
+        else:
+            environ.pop(TASK_PROFILE_DIR_ENV, None)
+        self.options = Options(
+            connection='ssh', listhosts=False, listtasks=False, listtags=False,
+            syntax=False, module_path=None, forks=1, become=True, become_method='sudo',
+            become_user='root', check=False, diff=True, remote_user='centos', verbosity=None
+        )
+        self.passwords = dict()
+        # Takes care of finding and reading yaml, json and ini files
+        self.loader = DataLoader()
+        # create inventory, use path to host config file as source or hosts in a comma separated string
+        self.inventory = InventoryManager(loader=self.loader, sources=inventory_path)
+        # variable manager takes care of merging all the different sources to give you
+        # a unifed view of variables available in each context
+        self.variable_manager = VariableManager(loader=self.loader, inventory=self.inventory)
+        self.variable_manager.extra_vars = kwargs
+
+    def count_hosts(self, playbook_paths):
+        """Count the hosts targeted by the plays of the playbooks. The plays run one after
+        another, so this is the host count of the largest play.
+
+        Arguments:
+            playbook_paths {list} -- The paths of the playbooks.
+
+        Returns:
+            int -- The number of hosts of the largest play.
+        """
+
+        host_count = 0
+        for playbook_path in playbook_paths:
+            for play in self.loader.load_from_file(playbook_path) or []:
+                if 'hosts' in play:
+                    host_count = max(host_count, len(self.inventory.get_hosts(play['hosts'])))
+        return host_count
+
+    def run(self, playbook_paths, limit=None):
+        """Execute one or several ansible playbooks with a single playbook executor.
+
+        Arguments:
+            playbook_paths {string|list} -- The path of the playbook, or a list of paths.
+            limit {string} -- Limit the playbooks to a subset of the hosts, like
+            the --limit option of ansible-playbook. (default: {None})
+
+        Returns:
+            int -- The return code of the playbook executor.
+        """
+
+        if not isinstance(playbook_paths, list):
+            playbook_paths = [playbook_paths]
+
+        print "Env varible 'ANSIBLE_CONFIG' is '%s' for playbook '%s'" % (
+            environ.get('ANSIBLE_CONFIG', 'Not Set'),
+            ", ".join(playbook_paths)
+        )
+        print "Running playbook: %s" % ", ".join(playbook_paths)
+
+        if limit is not None:
+            print "Limiting playbook %s to hosts: %s" % (", ".join(playbook_paths), limit)
+        self.inventory.subset(limit)
+        try:
+            host_count = self.count_hosts(playbook_paths)
+            forks = get_forks(host_count, self.max_forks, self.parallel)
+            print "Using %d forks for %d hosts in playbook: %s" % (forks, host_count, ", ".join(playbook_paths))
+
+            pbex = PlaybookExecutor(
+                playbooks=playbook_paths,
+                inventory=self.inventory,
+                variable_manager=self.variable_manager,
+                loader=self.loader,
+                options=self.options._replace(forks=forks),
+                passwords=self.passwords
+            )
+            # most interesting data for a play is actually sent to the callback's methods,
+            # the task_profile callback writes the task times of every playbook when it ends
+            return pbex.run()
+        finally:
+            self.inventory.subset(None)
+
+    def close(self):
+        """Write the report of the task times and remove the temporary files of the session,
+        including the ansible local tmpdir. Playbooks running in parallel share the same tmpdir,
+        so this is called once all of them have finished.
+        """
+
+        if self.profile:
+            write_profile_report(self.profile_path, self.profile_path + '.json')
+        self.loader.cleanup_all_tmp_files()
+        shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
 
 
 def execute_ansible(inventory_path, playbook_path, **kwargs):
-    """Execute ansible playbook.
+    """Execute ansible playbook in a session of its own.
     
     Arguments:
         inventory_path {string} -- The path of the inventory file.
@@ -63,51 +519,11 @@ def execute_ansible(inventory_path, playbook_path, **kwargs):
         kwagrs -- Extra varibles for the playbook.
 
     Return:
-
+        int -- The return code of the playbook executor.
     """
 
-    print "Env varible 'ANSIBLE_CONFIG' is '%s' for playbook '%s'" % (
-        environ.get('ANSIBLE_CONFIG', 'Not Set'), 
-        playbook_path
-    )
-    print "Running playbook: %s" % playbook_path
-    # since API is constructed for CLI it expects certain options to always be set, named tuple 'fakes' 
-    # the args parsing options object
-    Options = namedtuple(
-        'Options', [
-            'connection', 'listhosts', 'listtasks', 'listtags', 
-            'syntax', 'module_path', 'forks', 'become', 'become_method', 
-            'become_user', 'check', 'diff', 'remote_user', 'verbosity'
-        ]
-    )
-    options = Options(
-        connection='ssh', listhosts=False, listtasks=False, listtags=False, 
-        syntax=False, module_path=None, forks=10, become=True, become_method='sudo', 
-        become_user='root', check=False, diff=True, remote_user='centos', verbosity=None
-    )
-    # initialize needed objects
-    loader = DataLoader() # Takes care of finding and reading yaml, json and ini files
-    passwords = dict()
-
-    # create inventory, use path to host config file as source or hosts in a comma separated string
-    inventory = InventoryManager(loader=loader, sources=inventory_path)
-
-    # variable manager takes care of merging all the different sources to give you 
-    # a unifed view of variables available in each context
-    variable_manager = VariableManager(loader=loader, inventory=inventory)
-    variable_manager.extra_vars = kwargs
-
-    pbex = PlaybookExecutor(
-        playbooks=[playbook_path], 
-        inventory=inventory, 
-        variable_manager=variable_manager, 
-        loader=loader, 
-        options=options, 
-        passwords=passwords
-    )
-    result = pbex.run() # most interesting data for a play is actually sent to the callback's methods
-    # Remove ansible tmpdir
-    shutil.rmtree(C.DEFAULT_LOCAL_TMP, True)
-
-    return result
-
+    session = AnsibleSession(inventory_path, **kwargs)
+    try:
+        return session.run(playbook_path)
+    finally:
+        session.close()
@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
 from os import path, chmod
+import hashlib
 import json
 import yaml
 from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 
 from helpers import (
     get_tfstate_file, convert_list_to_dict, get_nodes_ips, render_template
@@ -29,13 +32,14 @@ def generate_ansible_cfg(env_path):
         file_handler.write(stream)
 
 
-def generate_inventory(env_path, terraform_path):
+def generate_inventory(env_path, terraform_path, workspace=None):
     """Format the dictionary of ip addresses to yaml file, and write them to environment folder,
     make it as a inventory file.
     
     Arguments:
         env_path {string} -- The path of environment folder.
         terraform_path {string} -- The path of the terraform working path.
+        workspace {string} -- The terraform workspace, None for the default one. (default: {None})
     
     Return:
         dict -- The dictionary of ip addresses that returned by function get_nodes_ips()
@@ -43,7 +47,7 @@ def generate_inventory(env_path, terraform_path):
 
     inventory_file = path.realpath(path.join(env_path, 'hosts.yml'))
 
-    tfstate_file = get_tfstate_file(terraform_path)
+    tfstate_file = get_tfstate_file(terraform_path, workspace)
 
     nodes_ips_dic = get_nodes_ips(tfstate_file)
 
@@ -54,6 +58,43 @@ def generate_inventory(env_path, terraform_path):
     return nodes_ips_dic
 
 
+def read_inventory_snapshot(env_path):
+    """Read the snapshot of the inventory that was last configured successfully.
+
+    Arguments:
+        env_path {string} -- The path of environment folder.
+
+    Return:
+        dict -- The snapshot, or None if there is none, like:
+        {
+            "nodes": {... the dictionary returned by get_nodes_ips() ...},
+            "ansible_hash": "9f86d08..."
+        }
+    """
+
+    snapshot_file = path.realpath(path.join(env_path, 'hosts.snapshot.json'))
+    if not path.isfile(snapshot_file):
+        return None
+
+    with open(snapshot_file) as f:
+        return json.load(f)
+
+
+def write_inventory_snapshot(env_path, nodes_ips_dict, ansible_hash):
+    """Write the snapshot of an inventory that has been configured successfully.
+
+    Arguments:
+        env_path {string} -- The path of environment folder.
+        nodes_ips_dict {dict} -- The dictionary of ip addresses that returned by function get_nodes_ips()
+        ansible_hash {string} -- The hash of the ansible code the inventory was configured with.
+    """
+
+    snapshot_file = path.realpath(path.join(env_path, 'hosts.snapshot.json'))
+
+    with open(snapshot_file, "w") as file_handler:
+        json.dump({"nodes": nodes_ips_dict, "ansible_hash": ansible_hash}, file_handler, indent=2)
+
+
 def generate_ssh_cfg(env_path, bastion_ip):
     """Render ssh config file in environment path to make it possible to 
     ssh cloud servers with bastion server.
@@ -67,24 +108,31 @@ def generate_ssh_cfg(env_path, bastion_ip):
     bastion_ip = bastion_ip
     private_key_path = path.realpath(path.join(env_path, 'private.key'))
     ssh_cfg_path = path.realpath(path.join(env_path, 'ssh.cfg'))
+    # The clusters share the private ip range, their multiplexed connections are kept
+    # apart by the environment path. A short hash keeps the socket path under its limit.
+    control_id = hashlib.sha1(path.realpath(env_path).encode('utf-8')).hexdigest()[:12]
 
     stream = render_template(
         "ssh.cfg.j2", 
         bastion_ip=bastion_ip, 
         private_key_path=private_key_path, 
-        ssh_cfg_path=ssh_cfg_path
+        ssh_cfg_path=ssh_cfg_path,
+        control_id=control_id
     )
 
     with open(cfg_path, "w") as file_handler:
         file_handler.write(stream)
 
 
-def generate_sshkey_pair(env_path):
-    """Generate ssh key pair and write them to env path.
+def generate_sshkey_pair(env_path, key_type='rsa'):
+    """Generate ssh key pair and write them to env path. An existing key pair is kept,
+    whatever its type.
     
     Arguments:
         env_path {string} -- The path of the folder that contain env information, 
         like hosts.yml, ssh.cfg, key pairs and so on.
+        key_type {string} -- The type of the key, 'rsa' or 'ed25519'. An ed25519 key is
+        generated much faster than a RSA-2048 key. (default: {'rsa'})
 
     Return:
         The path of the private key and public key.
@@ -93,27 +141,52 @@ def generate_sshkey_pair(env_path):
     private_key_path = path.realpath(path.join(env_path, "private.key"))
     public_key_path = path.realpath(path.join(env_path, "public.key"))
     if not path.isfile(private_key_path):
-        key = RSA.generate(2048)
+        if key_type == 'ed25519':
+            private_key, public_key = generate_ed25519_key()
+        elif key_type == 'rsa':
+            key = RSA.generate(2048)
+            private_key = key.exportKey('PEM')
+            public_key = key.publickey().exportKey('OpenSSH')
+        else:
+            raise Exception("The key type %s isn't supported." % key_type)
+
         with open(private_key_path, 'w') as file_handler:
             chmod(private_key_path, 0600)
-            file_handler.write(key.exportKey('PEM'))
-        pubkey = key.publickey()
+            file_handler.write(private_key)
         with open(public_key_path, 'w') as file_handler:
-            file_handler.write(pubkey.exportKey('OpenSSH'))
+            file_handler.write(public_key)
     return private_key_path, public_key_path
 
 
-def generate_terraform_cfg(provider, terraform_path, env_path, cluster_name):
-    """Generate terraform config file and write it to terraform folder.
+def generate_ed25519_key():
+    """Generate an ed25519 key.
+
+    Return:
+        The private key in OpenSSH format and the public key in OpenSSH format.
+    """
+
+    key = Ed25519PrivateKey.generate()
+    private_key = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+        serialization.NoEncryption()
+    )
+    public_key = key.public_key().public_bytes(
+        serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH
+    )
+    return private_key, public_key
+
+
+def generate_terraform_cfg(provider, env_path, cluster_name):
+    """Generate terraform config file and write it to environment folder. Each cluster has
+    its own, so clusters sharing the terraform folder don't overwrite each other's.
     
     Arguments:
         providor {string} -- The name of the cloud providor.
-        terraform_path {string} -- The path of the terraform folder.
         env_path {string} -- The path of the environment foldeer.
         cluster_name {string} -- The name of the cluster defined by the user.
     """
 
-    terraform_cfg_path = path.realpath(path.join(terraform_path, 'terraform.tfvars'))
+    terraform_cfg_path = path.realpath(path.join(env_path, 'terraform.tfvars'))
     public_key_path = path.realpath(path.join(env_path, 'public.key'))
 
     template_name = provider + "_terraform.tfvars.j2"
@@ -2,11 +2,96 @@
 
 import sys
 import json
+import hashlib
+import random
+import socket
 import time
-from os import path
-from jinja2 import Environment, FileSystemLoader
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from os import makedirs, path, sysconf, walk
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from paramiko import SSHClient, AutoAddPolicy
-from python_terraform import Terraform
+
+import tracing
+
+# ijson parses the tfstate file incrementally, fall back to json when it's not installed.
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+
+# Number of ansible forks a single CPU of the control host can drive. The forks spend most of
+# their time waiting on ssh, so a CPU can drive several of them.
+FORKS_PER_CPU = 8
+# Approximate memory used by a single ansible fork, in bytes.
+MEMORY_PER_FORK = 64 * 1024 * 1024
+
+# Seconds before the first retry of a ssh check, the delay doubles on every retry
+# up to SSH_MAX_INTERVAL.
+SSH_INTERVAL = 1
+SSH_MAX_INTERVAL = 20
+# Seconds to wait for a tcp connection or a ssh banner.
+SSH_CONNECT_TIMEOUT = 10
+# Number of nodes checked at the same time.
+SSH_CHECK_WORKERS = 32
+
+
+# The workspace terraform starts with, its state is kept in the working dir itself.
+DEFAULT_WORKSPACE = 'default'
+
+# The terraform output of the ip addresses of each group of nodes.
+NODE_GROUP_OUTPUTS = [
+    ("bastion", "bastion_public_ip"),
+    ("master", "master_private_ips"),
+    ("private_slave", "private_slave_private_ips"),
+    ("public_slave", "public_slave_private_ips"),
+]
+
+# Number of compiled templates kept in memory.
+TEMPLATE_CACHE_SIZE = 50
+# The jinja2 environment shared by all the renders, see get_template_env().
+_TEMPLATE_ENV = None
+
+# The outputs of the tfstate files read so far, with the mtime and the size of the files.
+_TFSTATE_OUTPUTS_CACHE = {}
+
+
+def get_template_env():
+    """Get the process-wide jinja2 environment of the templates folder. The environment keeps
+    up to TEMPLATE_CACHE_SIZE compiled templates and recompiles a template when its file changes.
+
+    Returns:
+        Environment -- The jinja2 environment.
+    """
+
+    global _TEMPLATE_ENV
+
+    if _TEMPLATE_ENV is None:
+        # Capture our current directory
+        current_path = path.dirname(path.realpath(__file__))
+        template_folder = path.realpath(path.join(
+            current_path, './templates/'
+        ))
+        # Create the jinja2 environment.
+        # Notice the use of trim_blocks, which greatly helps control whitespace.
+        _TEMPLATE_ENV = Environment(loader=FileSystemLoader(template_folder),
+                                    trim_blocks=True, auto_reload=True,
+                                    cache_size=TEMPLATE_CACHE_SIZE)
+    return _TEMPLATE_ENV
+
+
+def enable_template_bytecode_cache(cache_path):
+    """Store the compiled templates on disk, so other processes and later runs don't compile
+    them again.
+
+    Arguments:
+        cache_path {string} -- The path of the folder to store the compiled templates in.
+    """
+
+    if not path.isdir(cache_path):
+        makedirs(cache_path)
+    get_template_env().bytecode_cache = FileSystemBytecodeCache(cache_path)
 
 
 def render_template(template_name, **kwargs):
@@ -19,31 +104,39 @@ def render_template(template_name, **kwargs):
         string -- The string of the file that rendered by the template.
     """
 
-    # Capture our current directory
-    current_path = path.dirname(path.realpath(__file__))
-    template_folder = path.realpath(path.join(
-        current_path, './templates/'
-    ))
-    # Create the jinja2 environment.
-    # Notice the use of trim_blocks, which greatly helps control whitespace.
-    j2_env = Environment(loader=FileSystemLoader(template_folder),
-                         trim_blocks=True)
-    return j2_env.get_template(template_name).render(
+    return get_template_env().get_template(template_name).render(
         **kwargs
     )
 
 
-def get_tfstate_file(terraform_path):
+def get_tfstate_path(terraform_path, workspace=None):
+    """Get the path of the tfstate file, whether it exists or not.
+
+    Arguments:
+        terraform_path {string} -- The path of the terraform environment.
+        workspace {string} -- The terraform workspace, None for the default one. (default: {None})
+
+    Returns:
+        string -- The path of the tfstate file.
+    """
+
+    if workspace in (None, DEFAULT_WORKSPACE):
+        return path.realpath(path.join(terraform_path, 'terraform.tfstate'))
+    return path.realpath(path.join(terraform_path, 'terraform.tfstate.d', workspace, 'terraform.tfstate'))
+
+
+def get_tfstate_file(terraform_path, workspace=None):
     """Get the path of the tfstate file.
     
     Arguments:
         terraform_path {string} -- The path of the terraform environment.
+        workspace {string} -- The terraform workspace, None for the default one. (default: {None})
     
     Returns:
         string -- The path of the terraform environment.
     """
 
-    tfstate_file = path.realpath(path.join(terraform_path, 'terraform.tfstate'))
+    tfstate_file = get_tfstate_path(terraform_path, workspace)
 
     if path.isfile(tfstate_file):
         return tfstate_file
@@ -68,6 +161,48 @@ def convert_list_to_dict(from_list):
     return to_dict
 
 
+def read_tfstate_outputs(tfstate_file):
+    """Read the outputs of the root module from a tfstate file. Both the legacy state format,
+    with the outputs under "modules", and the current one, with the outputs at the top level,
+    are supported. The outputs come before the resources in the file, so with ijson only the
+    beginning of the file is parsed. The outputs are cached until the file changes.
+
+    Arguments:
+        tfstate_file {string} -- The path of the tfstate file.
+
+    Returns:
+        dict -- The outputs, like:
+        {
+            "bastion_public_ip": {
+                "type": "string",
+                "value": "123.123.123.123"
+            }
+        }
+    """
+
+    cache_key = (path.getmtime(tfstate_file), path.getsize(tfstate_file))
+    cached = _TFSTATE_OUTPUTS_CACHE.get(tfstate_file)
+    if cached is not None and cached[0] == cache_key:
+        return cached[1]
+
+    with open(tfstate_file, 'rb') as f:
+        if ijson is None:
+            data = json.load(f)
+            if "modules" in data:
+                outputs = data["modules"][0].get("outputs", {})
+            else:
+                outputs = data.get("outputs", {})
+        else:
+            # The version is the first key of the state, the legacy format is version 3.
+            version = next(ijson.items(f, 'version'), None)
+            f.seek(0)
+            prefix = 'modules.item.outputs' if version is not None and version < 4 else 'outputs'
+            outputs = next(ijson.items(f, prefix), {})
+
+    _TFSTATE_OUTPUTS_CACHE[tfstate_file] = (cache_key, outputs)
+    return outputs
+
+
 def get_nodes_ips(tfstate_file):
     """Get the ip address of the nodes created by terraform form the tfstate file.
     
@@ -97,33 +232,59 @@ def get_nodes_ips(tfstate_file):
         }
     """
 
+    nodes_ips = read_tfstate_outputs(tfstate_file)
+    if not nodes_ips:
+        raise Exception("The nodes' ip addresses don't exist in the tfstate file.")
+
     nodes_ips_dict = {}
-    with open(tfstate_file) as f:
-        data = json.load(f)
-        nodes_ips = data["modules"][0]["outputs"]
-
-    if nodes_ips:
-        if nodes_ips["bastion_public_ip"]["value"]:
-            nodes_ips_dict["bastion"] = { 
-                "hosts": convert_list_to_dict(nodes_ips["bastion_public_ip"]["value"].split(","))
+    for group, output in NODE_GROUP_OUTPUTS:
+        value = nodes_ips.get(output, {}).get("value")
+        if value:
+            # Terraform 0.12 and later can output lists, older versions join them with commas.
+            ips = value if isinstance(value, list) else value.split(",")
+            nodes_ips_dict[group] = {
+                "hosts": convert_list_to_dict(ips)
             }
-        if nodes_ips["master_private_ips"]["value"]:
-            nodes_ips_dict["master"] = {
-                "hosts": convert_list_to_dict(nodes_ips["master_private_ips"]["value"].split(","))
-            }
-        if nodes_ips["private_slave_private_ips"]["value"]:
-            nodes_ips_dict["private_slave"] = {
-                "hosts": convert_list_to_dict(nodes_ips["private_slave_private_ips"]["value"].split(","))
-            }
-        if nodes_ips["public_slave_private_ips"]["value"]:
-            nodes_ips_dict["public_slave"] = {
-                "hosts": convert_list_to_dict(nodes_ips["public_slave_private_ips"]["value"].split(","))
-            }
-    else:
-        raise Exception("The nodes' ip addresses don't exist in the tfstate file.")
-    
+
     return nodes_ips_dict
-    
+
+
+def get_new_hosts(old_nodes_ips_dict, nodes_ips_dict):
+    """Get the hosts of each group that are not in an older dictionary of node ips.
+
+    Arguments:
+        old_nodes_ips_dict {dict} -- The older dictionary of node ip addresses.
+        nodes_ips_dict {dict} -- The dictionary of node ip addresses.
+
+    Returns:
+        dict -- The sorted lists of new hosts of the groups that have new hosts, like:
+        {
+            "private_slave": ["10.0.7.21", "10.0.8.12"]
+        }
+    """
+
+    new_hosts = {}
+    for group, nodes in nodes_ips_dict.items():
+        old_hosts = old_nodes_ips_dict.get(group, {}).get("hosts", {})
+        hosts = sorted(host for host in nodes["hosts"] if host not in old_hosts)
+        if hosts:
+            new_hosts[group] = hosts
+    return new_hosts
+
+
+def has_removed_hosts(old_nodes_ips_dict, nodes_ips_dict):
+    """Check whether some hosts of an older dictionary of node ips are gone.
+
+    Arguments:
+        old_nodes_ips_dict {dict} -- The older dictionary of node ip addresses.
+        nodes_ips_dict {dict} -- The dictionary of node ip addresses.
+
+    Returns:
+        Boolean -- Return True if a host of the older dictionary is gone.
+    """
+
+    return bool(get_new_hosts(nodes_ips_dict, old_nodes_ips_dict))
+
 
 def get_bastion_ip(nodes_ips_dict):
     """Get the bastion ip address from the dictionary of node ips.
@@ -138,33 +299,233 @@ def get_bastion_ip(nodes_ips_dict):
     return nodes_ips_dict["bastion"]["hosts"].keys()[0]
 
 
-def check_ssh(ip, user, key_file):
-    """Check the ssh availability of the a server.
-    
+def connect_ssh(ip, user, key_file, bastion=None, port=22):
+    """Open a ssh connection to a server. The tcp connection is made first, so an unreachable
+    server fails fast without a ssh handshake.
+
     Arguments:
         ip {string} -- The ip address of the server.
         user {string} -- The user name to ssh the server
         key_file {string} -- The path of the key file
-    
+        bastion {SSHClient} -- A connected client of the bastion server to reach a
+        private server through. (default: {None})
+        port {int} -- The ssh port of the server. (default: {22})
+
     Returns:
-        Boolean -- Return True if the server can be ssh.
+        SSHClient -- The connected client.
     """
 
-    interval = 20
-    retries = 15
+    if bastion is None:
+        sock = socket.create_connection((ip, port), timeout=SSH_CONNECT_TIMEOUT)
+    else:
+        sock = bastion.get_transport().open_channel(
+            'direct-tcpip', (ip, port), ('127.0.0.1', 0), timeout=SSH_CONNECT_TIMEOUT
+        )
+
     ssh = SSHClient()
     ssh.set_missing_host_key_policy(AutoAddPolicy())
+    try:
+        ssh.connect(ip, port=port, username=user, key_filename=key_file, sock=sock,
+                    timeout=SSH_CONNECT_TIMEOUT, banner_timeout=SSH_CONNECT_TIMEOUT)
+    except Exception:
+        sock.close()
+        raise
+    return ssh
 
-    for _ in range(retries):
+
+def wait_for_ssh(ip, user, key_file, deadline, bastion=None):
+    """Wait for a server to accept ssh connections. The delay between two tries grows
+    exponentially with random jitter, so servers that come up early are found early and
+    many waiting servers don't retry in lockstep.
+
+    Arguments:
+        ip {string} -- The ip address of the server.
+        user {string} -- The user name to ssh the server
+        key_file {string} -- The path of the key file
+        deadline {float} -- The time after which to give up, as returned by time.time().
+        bastion {SSHClient} -- A connected client of the bastion server to reach a
+        private server through. (default: {None})
+
+    Returns:
+        SSHClient -- The connected client, or None if the server isn't ready in time.
+    """
+
+    start = time.time()
+    attempt = 0
+    while True:
         try:
-            ssh.connect(ip, username=user, key_filename=key_file)
-            print("Bastion is available.")
-            return True
+            ssh = connect_ssh(ip, user, key_file, bastion=bastion)
+            tracing.add_span("ssh " + ip, start, time.time() - start, attempts=attempt + 1, ready=True)
+            return ssh
         except Exception, e:
-            print("Waiting for the server to be ready ...")
-            time.sleep(interval)
-    print("Failed to ssh the server %s" % ip)
-    print(e)
-    return False
+            error = e
+
+        delay = random.uniform(0, min(SSH_MAX_INTERVAL, SSH_INTERVAL * 2 ** attempt))
+        if time.time() + delay > deadline:
+            print("Failed to ssh the server %s: %s" % (ip, error))
+            tracing.add_span("ssh " + ip, start, time.time() - start, attempts=attempt + 1,
+                             ready=False, error=str(error))
+            return None
+        time.sleep(delay)
+        attempt += 1
+
+
+def check_ssh(nodes_ips_dict, user, key_file, timeout=300, on_group_ready=None):
+    """Check the ssh availability of all the nodes. The bastion server is checked first, then
+    the other nodes are checked concurrently through the bastion server. Every group of nodes
+    is signaled as soon as all of its nodes are ready, so its playbooks can start while the
+    other groups are still checked.
+
+    Arguments:
+        nodes_ips_dict {dict} -- The dictionary of node ip addresses.
+        user {string} -- The user name to ssh the servers
+        key_file {string} -- The path of the key file
+        timeout {int} -- Seconds to wait for the nodes to be ready. (default: {300})
+        on_group_ready {function} -- Called with the name of every group and the seconds it
+        took to be ready, as soon as all of its nodes are ready. (default: {None})
+
+    Returns:
+        dict -- The seconds it took each node to be ready, None for the nodes that weren't
+        ready in time, like:
+        {
+            "123.123.123.123": 21.3,
+            "10.0.1.12": 45.8,
+            "10.0.7.20": None
+        }
+    """
+
+    start = time.time()
+    deadline = start + timeout
+    ready_times = {}
+
+    bastion_ip = get_bastion_ip(nodes_ips_dict)
+    bastion = wait_for_ssh(bastion_ip, user, key_file, deadline)
+    if bastion is None:
+        ready_times[bastion_ip] = None
+        return ready_times
+    ready_times[bastion_ip] = time.time() - start
+    print("Bastion is available after %.1fs." % ready_times[bastion_ip])
+
+    groups = dict(
+        (group, list(nodes["hosts"].keys()))
+        for group, nodes in nodes_ips_dict.items() if group != "bastion"
+    )
+
+    def group_ready(group, ready_time):
+        print("All %s nodes are available after %.1fs." % (group, ready_time))
+        if on_group_ready is not None:
+            on_group_ready(group, ready_time)
+
+    if on_group_ready is not None:
+        on_group_ready("bastion", ready_times[bastion_ip])
+    for group, ips in groups.items():
+        if not ips:
+            group_ready(group, ready_times[bastion_ip])
+
+    def check_node(ip):
+        ssh = wait_for_ssh(ip, user, key_file, deadline, bastion=bastion)
+        if ssh is None:
+            return ip, None
+        ssh.close()
+        return ip, time.time() - start
+
+    hosts = [ip for ips in groups.values() for ip in ips]
+    pool = ThreadPool(min(len(hosts), SSH_CHECK_WORKERS) or 1)
+    try:
+        for ip, ready_time in pool.imap_unordered(check_node, hosts):
+            ready_times[ip] = ready_time
+            if ready_time is not None:
+                print("Node %s is available after %.1fs." % (ip, ready_time))
+            for group, ips in groups.items():
+                if ip in ips and all(ready_times.get(i) is not None for i in ips):
+                    group_ready(group, ready_time)
+    finally:
+        pool.close()
+        pool.join()
+        bastion.close()
+
+    return ready_times
+
+
+def get_available_memory():
+    """Get the memory available on the control host.
+
+    Returns:
+        int -- The available memory in bytes, or None if it can't be found out.
+    """
+
+    # MemAvailable accounts for the page cache that can be reclaimed, prefer it on linux.
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+
+    try:
+        return sysconf('SC_AVPHYS_PAGES') * sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+
+def get_forks(host_count, max_forks=None, parallel=1):
+    """Get the number of ansible forks for a playbook. There is no point in more forks than
+    target hosts, and the control host must have the CPUs and the memory to run them. The
+    playbooks running at the same time share the CPUs and the memory.
+
+    Arguments:
+        host_count {int} -- The number of hosts the playbook targets.
+        max_forks {int} -- An upper limit of the number of forks. (default: {None})
+        parallel {int} -- The number of playbooks running at the same time. (default: {1})
+
+    Returns:
+        int -- The number of forks.
+    """
+
+    parallel = max(1, parallel)
+    limits = [host_count, cpu_count() * FORKS_PER_CPU // parallel]
+
+    available_memory = get_available_memory()
+    if available_memory is not None:
+        limits.append(available_memory // MEMORY_PER_FORK // parallel)
+    if max_forks is not None:
+        limits.append(max_forks)
+
+    return max(1, min(limits))
+
+
+def get_files_hash(paths, values=None):
+    """Get the sha256 hash of the content of files. Directories are walked recursively,
+    skipping hidden entries, and missing paths are hashed by name only.
+
+    Arguments:
+        paths {list} -- The paths of the files and directories.
+        values {list} -- Extra strings to hash along with the files. (default: {None})
+
+    Returns:
+        string -- The hex digest of the hash.
+    """
 
+    sha = hashlib.sha256()
+    for value in values or []:
+        sha.update(value.encode('utf-8') + b'\0')
+    for root_path in paths:
+        if path.isdir(root_path):
+            files = []
+            for dir_path, dir_names, file_names in walk(root_path):
+                dir_names[:] = sorted(name for name in dir_names if not name.startswith('.'))
+                files.extend(
+                    path.join(dir_path, name) for name in sorted(file_names) if not name.startswith('.')
+                )
+        else:
+            files = [root_path]
 
+        for file_path in files:
+            sha.update(file_path.encode('utf-8') + b'\0')
+            if path.isfile(file_path):
+                with open(file_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(65536), b''):
+                        sha.update(chunk)
+            sha.update(b'\0')
+    return sha.hexdigest()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import json
+import threading
+import time
+from os import path, rename
+
+
+class StepJournal(object):
+    """A journal of the completed steps of the setup pipeline, stored in the env path.
+    Every completed step is recorded with the hash of its inputs. When resuming, a step is
+    skipped if it completed with the same inputs in a previous run. The first step that
+    runs again ends the resume, so every step after it runs again too.
+    """
+
+    def __init__(self, env_path, resume=False):
+        """Load the journal of the previous runs when resuming, otherwise start a new one.
+
+        Arguments:
+            env_path {string} -- The path of the environment folder.
+            resume {bool} -- Skip the steps completed in the previous runs. (default: {False})
+        """
+
+        self.journal_file = path.realpath(path.join(env_path, 'journal.json'))
+        self.resuming = resume
+        self.steps = {}
+        # steps are completed from several threads, like the ssh check
+        self.lock = threading.Lock()
+
+        if resume and path.isfile(self.journal_file):
+            with open(self.journal_file) as f:
+                self.steps = json.load(f).get("steps", {})
+        else:
+            self._write()
+
+    def _write(self):
+        """Write the journal to a temporary file and move it in place, so an interrupted
+        write never leaves a broken journal behind.
+        """
+
+        tmp_file = self.journal_file + '.tmp'
+        with open(tmp_file, 'w') as file_handler:
+            json.dump({"steps": self.steps}, file_handler, indent=2, sort_keys=True)
+        rename(tmp_file, self.journal_file)
+
+    def is_completed(self, name, inputs_hash):
+        """Check whether a step completed with the same inputs in a previous run.
+
+        Arguments:
+            name {string} -- The name of the step.
+            inputs_hash {string} -- The hash of the current inputs of the step.
+
+        Returns:
+            Boolean -- Return True if the step can be skipped.
+        """
+
+        return self.resuming and self.steps.get(name, {}).get("inputs") == inputs_hash
+
+    def skip(self, name, inputs_hash):
+        """Check whether a step can be skipped. If it can't, the resume is over.
+
+        Arguments:
+            name {string} -- The name of the step.
+            inputs_hash {string} -- The hash of the current inputs of the step.
+
+        Returns:
+            Boolean -- Return True if the step can be skipped.
+        """
+
+        if self.is_completed(name, inputs_hash):
+            print("Skipping %s, it was completed in a previous run." % name)
+            return True
+        self.resuming = False
+        return False
+
+    def complete(self, name, inputs_hash):
+        """Record a completed step.
+
+        Arguments:
+            name {string} -- The name of the step.
+            inputs_hash {string} -- The hash of the inputs of the step.
+        """
+
+        with self.lock:
+            self.steps[name] = {"inputs": inputs_hash, "completed_at": time.time()}
+            self._write()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+"""Rewrite the unversioned Vault keys of a bucket in the versioned envelope.
+
+The unversioned keys are JSON-encoded and hex-encoded, and don't record their cipher
+parameters, so every read of them tries two decryptions. The keys are decrypted and
+checked before they are rewritten, the keys that can't be decrypted are left untouched.
+Keys written while the tool runs, eg. by a Vault init or rekey, are left untouched and
+reported `changed`, run the tool again to migrate them.
+
+Readers older than the versioned envelope can't read the migrated keys, update every
+deployment that reads them before migrating a bucket.
+
+Usage:
+    python migrate_vault_keys.py BUCKET --secret-file FILE [--env ENV ...] [--dry-run]
+"""
+
+import argparse
+import os
+import sys
+from os import path
+
+MODULE_UTILS_PATH = path.realpath(path.join(path.dirname(path.realpath(__file__)), '..', 'packer', 'provision',
+                                            'roles', 'libraries', 'module_utils'))
+
+# vault_s3 loads secret_storage and aws_utils with the module_utils loader of ansible, which
+# reads its paths from the environment, and so does this script
+os.environ.setdefault('ANSIBLE_MODULE_UTILS', MODULE_UTILS_PATH)
+sys.path.insert(0, MODULE_UTILS_PATH)
+
+import vault_s3
+from ansible.plugins.loader import module_utils_loader as ml
+
+# the aws_utils of vault_s3, which keys its caches on the clients of aws_utils
+aws_utils = ml._load_module_source('aws_utils', ml.find_plugin('aws_utils'))
+
+
+def get_migrate_args():
+    """Parse argument for the script.
+
+    Returns:
+        object -- the object contains the arguments of the script.
+    """
+
+    parser = argparse.ArgumentParser(description='Rewrite the unversioned Vault keys of a bucket.')
+
+    parser.add_argument('bucket',
+                        help='The S3 bucket of the Vault keys')
+    parser.add_argument('--secret-file', '-s', dest='secret_file', required=True,
+                        help='The path of the file holding the object storage encryption secret')
+    parser.add_argument('--env', '-e', dest='environments', action='append', default=None,
+                        help='An environment to migrate, repeat it for several (default: all)')
+    parser.add_argument('--region', '-r', default=None,
+                        help='The region of the bucket (default: the region of the AWS configuration)')
+    parser.add_argument('--endpoint-url', dest='endpoint_url', default=None,
+                        help='The URL of the S3 service, like a local stand-in (default: AWS)')
+    parser.add_argument('--dry-run', dest='dry_run', action='store_true', default=False,
+                        help='Only report the keys to migrate')
+
+    args = parser.parse_args()
+    return args
+
+
+def read_secret(secret_path):
+    """Read the object storage encryption secret, without the trailing newline.
+
+    Arguments:
+        secret_path {string} -- the path of the file holding the secret.
+
+    Returns:
+        string -- the secret.
+    """
+
+    with open(secret_path, 'rb') as f:
+        return f.read().rstrip(b'\r\n')
+
+
+def main():
+    args = get_migrate_args()
+    crypt_secret = read_secret(args.secret_file)
+    client = aws_utils.get_client('s3', region=args.region, endpoint_url=args.endpoint_url)
+
+    outcome = vault_s3.migrate_keys_s3(client, args.bucket, crypt_secret,
+                                       environments=args.environments, dry_run=args.dry_run)
+    if not outcome:
+        print("There are no Vault keys in bucket %s." % args.bucket)
+        return
+
+    for environment in sorted(outcome):
+        status = outcome[environment]
+        if args.dry_run and status == 'migrated':
+            status = 'to migrate'
+        print("%-24s %s" % (environment, status))
+
+    if any(status.startswith('error') or status == 'changed' for status in outcome.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import errno
+import os
+import signal
+import sys
+import time
+from multiprocessing import Process
+
+
+def validate_graph(graph):
+    """Check that every dependency in the graph is a node of the graph and that
+    the graph has no cycle.
+
+    Arguments:
+        graph {dict} -- The dependency graph, like:
+        {
+            "bootstrap": [],
+            "master": ["bootstrap"],
+            "private_slave": ["bootstrap"]
+        }
+
+    Raises:
+        Exception -- If a dependency is unknown or the graph contains a cycle.
+
+    Returns:
+        list -- The nodes of the graph, each one after all of its dependencies.
+    """
+
+    for name, dependencies in graph.items():
+        for dependency in dependencies:
+            if dependency not in graph:
+                raise Exception("The node %s depends on the unknown node %s." % (name, dependency))
+
+    # Remove the nodes without pending dependencies until nothing is left.
+    order = []
+    pending = dict((name, set(dependencies)) for name, dependencies in graph.items())
+    while pending:
+        ready = sorted(name for name, dependencies in pending.items() if not dependencies)
+        if not ready:
+            raise Exception("The dependency graph has a cycle between %s." % ", ".join(sorted(pending)))
+        for name in ready:
+            del pending[name]
+        for dependencies in pending.values():
+            dependencies.difference_update(ready)
+        order.extend(ready)
+
+    return order
+
+
+def get_parallelism(graph, done=None):
+    """Get the largest number of nodes of the graph that can run at the same time, the
+    nodes at the same depth once the done nodes are left out. It's the number of nodes that
+    share the resources of the host in the worst case.
+
+    Arguments:
+        graph {dict} -- The dependency graph, see validate_graph().
+        done {set} -- The nodes that have already finished and are not run. (default: {None})
+
+    Returns:
+        int -- The number of nodes that can run at the same time, at least 1.
+    """
+
+    done = set(done or [])
+    depths = {}
+    for name in validate_graph(graph):
+        depths[name] = max([depths[dependency] + 1 for dependency in graph[name]] or [0])
+
+    widths = {}
+    for name, depth in depths.items():
+        if name not in done:
+            widths[depth] = widths.get(depth, 0) + 1
+
+    return max([1] + list(widths.values()))
+
+
+def _run_node(runner, name):
+    """Run a node in the child process and use its result as the exit code. The child
+    leads a process group of its own, so the processes it forks, like the ansible workers
+    and their ssh connections, are terminated with it.
+
+    Arguments:
+        runner {function} -- The function that runs the node.
+        name {string} -- The name of the node.
+    """
+
+    os.setpgrp()
+    sys.exit(runner(name))
+
+
+def _terminate_node(process):
+    """Terminate the process group of a running node and wait for the node to exit.
+
+    Arguments:
+        process {Process} -- The process of the node.
+    """
+
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except OSError as e:
+        if e.errno != errno.ESRCH:
+            raise
+        # the child has exited, or doesn't lead its group yet
+        process.terminate()
+    process.join()
+
+
+def run_graph(graph, runner, interval=1, done=None, on_start=None, on_exit=None, is_ready=None):
+    """Run the nodes of a dependency graph. A node is started in its own process as soon
+    as all of its dependencies have finished successfully, so independent nodes run at
+    the same time. On the first failure the running nodes are terminated, with all the
+    processes they started, and nothing else is started. The running nodes are terminated
+    too when the run is interrupted, eg. by Ctrl-C, which only reaches the scheduler since
+    every node has a process group of its own.
+
+    Arguments:
+        graph {dict} -- The dependency graph, see validate_graph().
+        runner {function} -- The function that runs a node. It's called with the name of
+        the node and returns 0 on success.
+        interval {int} -- Seconds between two polls of the running nodes.
+        done {set} -- The nodes that have already finished and are not run. (default: {None})
+        on_start {function} -- Called with the name of every node that starts. (default: {None})
+        on_exit {function} -- Called with the name and the return code of every node that
+        exits, including the ones terminated after a failure. (default: {None})
+        is_ready {function} -- Called with the name of every node whose dependencies have
+        finished, the node starts once it returns True, like when its hosts are reachable.
+        It can raise to stop the run, the running nodes are terminated. (default: {None})
+
+    Returns:
+        tuple -- The name and the return code of the failed node, or (None, 0).
+    """
+
+    validate_graph(graph)
+
+    done = set(done or [])
+    running = {}
+
+    try:
+        while len(done) < len(graph):
+            # Start every node whose dependencies have all finished, once it is ready.
+            for name in sorted(graph):
+                if name in done or name in running:
+                    continue
+                if not all(dependency in done for dependency in graph[name]):
+                    continue
+                if is_ready is None or is_ready(name):
+                    print("Starting %s ..." % name)
+                    if on_start is not None:
+                        on_start(name)
+                    process = Process(target=_run_node, args=(runner, name))
+                    process.start()
+                    running[name] = process
+
+            time.sleep(interval)
+
+            for name, process in list(running.items()):
+                if process.is_alive():
+                    continue
+                del running[name]
+                if on_exit is not None:
+                    on_exit(name, process.exitcode)
+                if process.exitcode != 0:
+                    print("%s failed with return code %s." % (name, process.exitcode))
+                    # the processes the failed node left behind, if any
+                    _terminate_node(process)
+                    for other_name, other in running.items():
+                        _terminate_node(other)
+                        if on_exit is not None:
+                            on_exit(other_name, other.exitcode)
+                    return name, process.exitcode
+                print("%s finished." % name)
+                done.add(name)
+    except BaseException:
+        for process in running.values():
+            _terminate_node(process)
+        raise
+
+    return None, 0
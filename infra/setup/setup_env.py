@@ -1,20 +1,56 @@
 #!/usr/bin/env python
 
 import argparse
+import shutil
 import sys
-from os import path, makedirs, environ
+import time
+from multiprocessing.pool import ThreadPool
+from os import path, listdir, makedirs, environ
 from env_generators import (
     generate_ansible_cfg, generate_inventory, generate_ssh_cfg,
-    generate_sshkey_pair, generate_terraform_cfg,
+    generate_sshkey_pair, generate_terraform_cfg, read_inventory_snapshot,
+    write_inventory_snapshot,
 )
 from code_executor import (
-    execute_ansible, execute_terraform,
+    AnsibleSession, create_terraform_workspace, execute_terraform, get_terraform_inputs,
+    init_terraform,
 )
-from helpers import get_bastion_ip, check_ssh
+from helpers import (
+    DEFAULT_WORKSPACE, get_bastion_ip, check_ssh, enable_template_bytecode_cache, get_files_hash,
+    get_new_hosts, has_removed_hosts,
+)
+from journal import StepJournal
+from scheduler import get_parallelism, run_graph, validate_graph
+import tracing
+
+
+# The playbooks to run, each with the playbooks it depends on. The slave nodes only need
+# the bootstrap node to serve the installer, so they are installed alongside the masters.
+PLAYBOOK_GRAPH = {
+    'bootstrap': [],
+    'master': ['bootstrap'],
+    'public_slave': ['bootstrap'],
+    'private_slave': ['bootstrap'],
+}
+
+# The inventory group configured by each playbook.
+PLAYBOOK_GROUPS = {
+    'bootstrap': 'bastion',
+    'master': 'master',
+    'public_slave': 'public_slave',
+    'private_slave': 'private_slave',
+}
 
 
-def get_args():
+class NodesUnavailable(Exception):
+    """Raised when the ssh check is over and some nodes a playbook needs are not available."""
+
+
+def get_args(argv=None):
     """Parse argument for the script.
+
+    Arguments:
+        argv {list} -- The arguments to parse, None for the ones of the script. (default: {None})
     
     Returns:
         object -- the object contains the arguments of the script.
@@ -30,8 +66,22 @@ def get_args():
                         help='Give the type of cluster, like dcos or k8s')
     parser.add_argument('--name', '-n', dest='name', required=True,
                         help='The name of the cluster')
+    parser.add_argument('--workspace', '-w', dest='workspace', default=None,
+                        help='The terraform workspace of the cluster, to keep its state apart')
+    parser.add_argument('--key-type', dest='key_type', choices=['rsa', 'ed25519'], default='rsa',
+                        help='The type of the ssh key pair generated for a new environment')
+    parser.add_argument('--max-forks', dest='max_forks', type=int, default=None,
+                        help='The maximum number of ansible forks of a playbook')
+    parser.add_argument('--auto-approve', dest='auto_approve', action='store_true',
+                        help='Apply the terraform plan without asking for approval')
+    parser.add_argument('--refresh', dest='refresh', action='store_true',
+                        help='Run terraform even if its inputs are unchanged since the last apply')
+    parser.add_argument('--all-hosts', dest='all_hosts', action='store_true',
+                        help='Configure all the hosts, even if only new slave hosts were added')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='Skip the steps completed in the previous runs with unchanged inputs')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 def get_terraform_path(args):
@@ -54,6 +104,26 @@ def get_terraform_path(args):
     else:
         raise Exception("The terraform path %s doesn't exists." % terraform_path)
 
+def get_terraform_modules_path(args):
+    """Get the path of the terraform modules used by the terraform code of the provider.
+
+    Arguments:
+        args {object} -- The object of the script argument.
+
+    Returns:
+        string -- The string of the terraform modules path.
+    """
+
+    current_path = path.dirname(path.realpath(__file__))
+    modules_path = path.realpath(path.join(
+        current_path, '../terraform/modules/', args.provider
+    ))
+
+    if path.isdir(modules_path):
+        return modules_path
+    else:
+        raise Exception("The terraform modules path %s doesn't exists." % modules_path)
+
 def get_ansible_path(args):
     """Get the path of the ansible code path according the script arguments.
     
@@ -75,8 +145,12 @@ def get_ansible_path(args):
         raise Exception("The ansible path %s doesn't exists." % ansible_path)
 
 def get_env_path(args):
-    """Get the path of the the folder that contain hosts.yml and ssh.cfg. If the folder
-    doesn't exists, create it.
+    """Get the path of the the folder that contain hosts.yml and ssh.cfg. Each cluster has
+    its own folder. If the folder doesn't exists, create it.
+
+    Clusters used to share the folder of their provider, environment and cluster type. If
+    that folder still holds the key pair of a cluster with this name, its files are moved
+    into the new folder, so the cluster keeps its key pair.
     
     Arguments:
         args {object} -- The object of the script argument.
@@ -86,9 +160,10 @@ def get_env_path(args):
     """
 
     current_path = path.dirname(path.realpath(__file__))
-    env_path = path.realpath(path.join(
+    legacy_env_path = path.realpath(path.join(
         current_path, './env/',args.provider, args.env, args.cluster
     ))
+    env_path = path.join(legacy_env_path, args.name)
 
     try: 
         makedirs(env_path)
@@ -97,15 +172,68 @@ def get_env_path(args):
             return env_path
         else:
             raise
-    else:
-        return env_path  
 
+    # The terraform cfg file used to be in the terraform folder, it tells which cluster
+    # the legacy folder belongs to.
+    legacy_files = [
+        name for name in listdir(legacy_env_path) if path.isfile(path.join(legacy_env_path, name))
+    ]
+    legacy_terraform_cfg = path.join(get_terraform_path(args), 'terraform.tfvars')
+    if 'private.key' not in legacy_files or not path.isfile(legacy_terraform_cfg):
+        return env_path
+    with open(legacy_terraform_cfg) as f:
+        is_legacy_cluster = 'name = "%s"' % args.name in f.read()
+    if is_legacy_cluster:
+        print("Moving the files of cluster %s from %s to %s ..." % (args.name, legacy_env_path, env_path))
+        for name in legacy_files:
+            shutil.move(path.join(legacy_env_path, name), path.join(env_path, name))
+    return env_path
+
+
+def get_playbook_limits(snapshot, nodes_ips_dict, ansible_hash):
+    """Work out the hosts each playbook has to configure. When the only changes since the
+    last successful configuration are new slave hosts, only the new hosts are configured.
+    The bootstrap config lists the masters, so a change of the bastion or the masters
+    configures all the hosts again.
+
+    Arguments:
+        snapshot {dict} -- The snapshot of the inventory that was last configured, or None.
+        nodes_ips_dict {dict} -- The dictionary of node ip addresses.
+        ansible_hash {string} -- The hash of the current ansible code.
+
+    Returns:
+        dict -- The limit of each playbook to run, None to run it against all its hosts.
+        Playbooks with nothing to configure are left out.
+    """
+
+    all_hosts = dict((name, None) for name in PLAYBOOK_GRAPH)
+    if (snapshot is None or snapshot["ansible_hash"] != ansible_hash or
+            has_removed_hosts(snapshot["nodes"], nodes_ips_dict)):
+        return all_hosts
+
+    new_hosts = get_new_hosts(snapshot["nodes"], nodes_ips_dict)
+    if not new_hosts or 'bastion' in new_hosts or 'master' in new_hosts:
+        return all_hosts
+
+    # The bastion facts are needed for the url of the bootstrap node.
+    bastion_ip = get_bastion_ip(nodes_ips_dict)
+    limits = {}
+    for name, group in PLAYBOOK_GROUPS.items():
+        if group in new_hosts:
+            limits[name] = ",".join([bastion_ip] + new_hosts[group])
+    return limits
+
+def setup(args):
+    """Create the cloud resources of a cluster and setup the cluster on them.
+
+    Arguments:
+        args {object} -- The object of the script argument.
+    """
 
-def main():
-    # Get the argument of the script.
-    args = get_args()
     # Get the terraform folder.
     terraform_path = get_terraform_path(args)
+    # Get the terraform modules folder.
+    modules_path = get_terraform_modules_path(args)
     # Get the ansible folder.
     ansible_path = get_ansible_path(args)
     # Get or create environment folder.
@@ -113,71 +241,202 @@ def main():
     # Get the cluster name from the arguments.
     cluster_name = args.name
     provider_name = args.provider
+    # The default workspace keeps its state in the working dir, like no workspace at all.
+    workspace = args.workspace if args.workspace != DEFAULT_WORKSPACE else None
+    # Keep the compiled templates in the env folder for the next runs.
+    enable_template_bytecode_cache(path.join(env_path, 'template_cache'))
 
-    print("Generating key pair ...")
-    private_key, public_key = generate_sshkey_pair(env_path)
-    print("Generated key pair successfully.")
-
-    print("Generating terraform cfg file ...")
-    generate_terraform_cfg(provider_name, terraform_path, env_path, cluster_name)
-    print("Generated terraform cfg successfully.")
-
-    print("Executing terraform code to create cloud resources ...")
-    print("Terraform working dir is %s" % terraform_path)
-    terra_return_code, terra_stdout, terra_stderr = execute_terraform(terraform_path)
-    # If there is no error, the stderr returned is unicode instead of a None type. So have to
-    # Check the length of the stderr.
-    if len(terra_stderr) == 0:
-        print("Executed terraform code to create cloud resources successfully.")
-    else:
-        print(terra_stderr)
-        sys.exit()
+    # The key pair, the terraform cfg file and terraform init don't depend on each other,
+    # so they are prepared at the same time. The tfvars are only passed to plan and apply,
+    # with -var-file, terraform init doesn't read them.
+    print("Generating key pair and terraform cfg file, initializing terraform ...")
+    pool = ThreadPool(3)
+    try:
+        keypair_result = pool.apply_async(
+            tracing.wrap('generate key pair', generate_sshkey_pair, key_type=args.key_type),
+            (env_path, args.key_type)
+        )
+        terraform_cfg_result = pool.apply_async(
+            tracing.wrap('generate terraform cfg', generate_terraform_cfg),
+            (provider_name, env_path, cluster_name)
+        )
+        init_result = pool.apply_async(init_terraform, (terraform_path,))
+
+        private_key, public_key = keypair_result.get()
+        print("Generated key pair successfully.")
+        terraform_cfg_result.get()
+        print("Generated terraform cfg successfully.")
+        if init_result.get() != 0:
+            print("Failed to initialize terraform.")
+            sys.exit(1)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Keep the state of the cluster in its own terraform workspace. The workspace is always
+    # set, the one selected in the working dir may be another cluster's.
+    if workspace is not None:
+        if create_terraform_workspace(terraform_path, workspace) != 0:
+            print("Failed to create terraform workspace %s." % workspace)
+            sys.exit(1)
+    environ["TF_WORKSPACE"] = workspace or DEFAULT_WORKSPACE
+    print("Set env varible 'TF_WORKSPACE' to: %s" % environ["TF_WORKSPACE"])
+
+    # The journal of the completed steps, used to resume a failed run.
+    journal = StepJournal(env_path, resume=args.resume)
+
+    terraform_inputs = get_terraform_inputs(terraform_path, env_path, modules_path, workspace)
+    with tracing.span('terraform') as span_args:
+        span_args['skipped'] = journal.skip('terraform', get_files_hash(terraform_inputs))
+        if not span_args['skipped']:
+            print("Executing terraform code to create cloud resources ...")
+            print("Terraform working dir is %s" % terraform_path)
+            terra_return_code = execute_terraform(terraform_path, env_path, modules_path, workspace,
+                                                  auto_approve=args.auto_approve,
+                                                  refresh=args.refresh)
+            if terra_return_code == 0:
+                print("Executed terraform code to create cloud resources successfully.")
+                journal.complete('terraform', get_files_hash(terraform_inputs))
+            else:
+                sys.exit(1)
 
     # Get the bastion ip and generate ssh config file.
-    nodes_ips_dict = generate_inventory(env_path, terraform_path)
+    with tracing.span('generate inventory') as span_args:
+        nodes_ips_dict = generate_inventory(env_path, terraform_path, workspace)
+        for group, ips in nodes_ips_dict.items():
+            span_args[group] = len(ips["hosts"])
     bastion_ip = get_bastion_ip(nodes_ips_dict)
     generate_ssh_cfg(env_path, bastion_ip)
 
     # Generate ansible config file.
     generate_ansible_cfg(env_path)
 
-    # Check the ssh availbility of bastion server.
-    is_bastion_available = check_ssh(bastion_ip, 'centos', private_key)
-
-    # Run ansbile playbooks when the bastion is available.
-    if is_bastion_available:
-        # Get inventory file path.
-        inventory_path = path.realpath(path.join(env_path, 'hosts.yml'))
-        # Get playbooks' path.
-        bootstrap_playbook = path.realpath(path.join(ansible_path, 'bootstrap.yml'))
-        master_playbook = path.realpath(path.join(ansible_path, 'master.yml'))
-        public_slave_playbook = path.realpath(path.join(ansible_path, 'public_slave.yml'))
-        private_slave_playbook = path.realpath(path.join(ansible_path, 'private_slave.yml'))
-
-        # Set environment varible "ANSIBLE_CONFIG" for ansible.
-        ansible_cfg_path = path.realpath(path.join(env_path, 'ansible.cfg'))
-        environ["ANSIBLE_CONFIG"] = ansible_cfg_path
-        print "Set env varible 'ANSIBLE_CONFIG' to: %s" % environ.get('ANSIBLE_CONFIG', 'Not Set')
-        print("Executing ansible playbooks ...")
-        bootstrap_result = execute_ansible(inventory_path, bootstrap_playbook, dcos_cluster_name=cluster_name)
-        if bootstrap_result != 0:
-            print("Something wrong when executing bootstrap playbook.")
-            sys.exit()
-        master_result = execute_ansible(inventory_path, master_playbook, dcos_cluster_name=cluster_name)
-        if master_result != 0:
-            print("Something wrong when executing master playbook.")
-            sys.exit()
-        public_slave_result = execute_ansible(inventory_path, public_slave_playbook, dcos_cluster_name=cluster_name)
-        if public_slave_result != 0:
-            print("Something wrong when executing public slave playbook.")
-            sys.exit()
-        private_slave_result = execute_ansible(inventory_path, private_slave_playbook, dcos_cluster_name=cluster_name)
-        if private_slave_result != 0:
-            print("Something wrong when executing private slave playbook.")
-            sys.exit()
-        print("Executed ansible playbooks successfully.")
+    # Get inventory file path.
+    inventory_path = path.realpath(path.join(env_path, 'hosts.yml'))
+
+    # Check the ssh availbility of all the nodes. The check runs alongside the playbooks,
+    # every playbook starts as soon as the nodes of its group are available.
+    inventory_hash = get_files_hash([inventory_path])
+    ready_groups = set()
+    ssh_span = tracing.begin('ssh check')
+    ssh_span['args']['skipped'] = journal.skip('ssh_check', inventory_hash)
+    ssh_pool = ssh_result = None
+    if ssh_span['args']['skipped']:
+        tracing.end(ssh_span)
+        ready_groups.update(nodes_ips_dict)
     else:
-        print("Bastion is not available.")
+        def check_nodes():
+            try:
+                ready_times = check_ssh(nodes_ips_dict, 'centos', private_key,
+                                        on_group_ready=lambda group, _: ready_groups.add(group))
+            except BaseException, e:
+                tracing.end(ssh_span, error=repr(e))
+                raise
+            unavailable = sorted(ip for ip, ready_time in ready_times.items() if ready_time is None)
+            tracing.end(ssh_span, hosts=len(ready_times), unavailable=len(unavailable))
+            if not unavailable:
+                journal.complete('ssh_check', inventory_hash)
+            return unavailable
+
+        ssh_pool = ThreadPool(1)
+        ssh_result = ssh_pool.apply_async(check_nodes)
+
+    def playbook_ready(name):
+        if 'bastion' in ready_groups and PLAYBOOK_GROUPS[name] in ready_groups:
+            return True
+        # the check is over without the group, some of its nodes are not available
+        if ssh_result.ready():
+            raise NodesUnavailable(ssh_result.get())
+        return False
+
+    # Set environment varible "ANSIBLE_CONFIG" for ansible.
+    ansible_cfg_path = path.realpath(path.join(env_path, 'ansible.cfg'))
+    environ["ANSIBLE_CONFIG"] = ansible_cfg_path
+    print "Set env varible 'ANSIBLE_CONFIG' to: %s" % environ.get('ANSIBLE_CONFIG', 'Not Set')
+
+    # Only configure the new hosts when slave hosts were added to a configured cluster.
+    ansible_hash = get_files_hash([ansible_path], [cluster_name])
+    snapshot = None if args.all_hosts else read_inventory_snapshot(env_path)
+    playbook_limits = get_playbook_limits(snapshot, nodes_ips_dict, ansible_hash)
+
+    # A playbook is skipped when it and all the playbooks it depends on were completed
+    # with the same inventory and ansible code.
+    playbooks_hash = get_files_hash([inventory_path, ansible_path], [cluster_name])
+    completed_playbooks = set()
+    for name in validate_graph(PLAYBOOK_GRAPH):
+        if name not in playbook_limits:
+            print("Skipping %s playbook, its hosts are already configured." % name)
+            completed_playbooks.add(name)
+            continue
+        if (journal.is_completed(name + '_playbook', playbooks_hash) and
+                all(dependency in completed_playbooks for dependency in PLAYBOOK_GRAPH[name])):
+            print("Skipping %s playbook, it was completed in a previous run." % name)
+            completed_playbooks.add(name)
+
+    # Parse the inventory once, the playbooks run in processes forked from this one.
+    # The playbooks running at the same time share the forks the control host can run.
+    session = AnsibleSession(inventory_path, max_forks=args.max_forks,
+                             parallel=get_parallelism(PLAYBOOK_GRAPH, completed_playbooks),
+                             dcos_cluster_name=cluster_name)
+
+    def run_playbook(name):
+        return session.run(path.realpath(path.join(ansible_path, name + '.yml')),
+                           limit=playbook_limits[name])
+
+    # The playbooks run in child processes, so their spans are recorded here.
+    playbook_spans = {}
+
+    def start_playbook(name):
+        playbook_spans[name] = tracing.begin(name + ' playbook', 'playbook ' + name,
+                                             limit=playbook_limits[name] or 'all')
+
+    def exit_playbook(name, return_code):
+        tracing.end(playbook_spans.pop(name), exit_code=return_code)
+        if return_code == 0:
+            journal.complete(name + '_playbook', playbooks_hash)
+
+    print("Executing ansible playbooks ...")
+    failed_playbook = None
+    try:
+        failed_playbook, _ = run_graph(PLAYBOOK_GRAPH, run_playbook, done=completed_playbooks,
+                                       on_start=start_playbook, on_exit=exit_playbook,
+                                       is_ready=playbook_ready)
+    except NodesUnavailable:
+        pass
+    finally:
+        session.close()
+
+    # Wait for the end of the check, the playbooks may not have needed all the groups.
+    unavailable_nodes = []
+    if ssh_result is not None:
+        try:
+            unavailable_nodes = ssh_result.get()
+        finally:
+            ssh_pool.close()
+            ssh_pool.join()
+    if unavailable_nodes:
+        print("Nodes are not available: %s" % ", ".join(unavailable_nodes))
+        sys.exit(1)
+
+    if failed_playbook is not None:
+        print("Something wrong when executing %s playbook." % failed_playbook)
+        sys.exit(1)
+    write_inventory_snapshot(env_path, nodes_ips_dict, ansible_hash)
+    print("Executed ansible playbooks successfully.")
+
+def main():
+    # Get the argument of the script.
+    args = get_args()
+    span = tracing.begin('setup', cluster=args.name)
+    try:
+        setup(args)
+    finally:
+        # Keep a timing trace of every run, including the failed ones.
+        tracing.end(span)
+        trace_path = path.join(get_env_path(args),
+                               'trace-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+        tracing.write_trace(trace_path)
+        print("Wrote the timing trace to %s" % trace_path)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
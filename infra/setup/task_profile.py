@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+
+import glob
+import json
+from os import path, remove
+
+
+def get_percentile(values, percentile):
+    """Get a percentile of a list of values, using the nearest rank.
+
+    Arguments:
+        values {list} -- The sorted values.
+        percentile {int} -- The percentile, between 0 and 100.
+
+    Returns:
+        float -- The value of the percentile.
+    """
+
+    index = max(0, int(round(percentile / 100.0 * len(values))) - 1)
+    return values[min(index, len(values) - 1)]
+
+
+def clear_profile_records(records_dir):
+    """Remove the task times recorded by the previous runs.
+
+    Arguments:
+        records_dir {string} -- The folder of the records files.
+    """
+
+    for records_path in glob.glob(path.join(records_dir, '*.json')):
+        remove(records_path)
+
+
+def get_profile_report(records, limit=10):
+    """Aggregate the task times of the playbooks.
+
+    Arguments:
+        records {list} -- The task times recorded by the callback.
+        limit {int} -- The number of tasks and hosts to report. (default: {10})
+
+    Returns:
+        dict -- The slowest tasks, the slowest hosts and the tasks with the longest tail,
+        where a few hosts take much longer than the others.
+    """
+
+    tasks = {}
+    hosts = {}
+    for record in records:
+        if record["status"] == 'skipped':
+            continue
+        key = (record["playbook"], record["task"])
+        tasks.setdefault(key, []).append(record["duration"])
+        hosts.setdefault(record["host"], []).append(record["duration"])
+
+    task_stats = []
+    for (playbook, task), durations in tasks.items():
+        durations.sort()
+        median = get_percentile(durations, 50)
+        task_stats.append({
+            "playbook": playbook,
+            "task": task,
+            "hosts": len(durations),
+            "min": durations[0],
+            "median": median,
+            "p95": get_percentile(durations, 95),
+            "max": durations[-1],
+            "spread": durations[-1] - median,
+        })
+
+    host_stats = [
+        {"host": host, "tasks": len(durations), "total": sum(durations)}
+        for host, durations in hosts.items()
+    ]
+
+    return {
+        "slowest_tasks": sorted(task_stats, key=lambda stats: stats["max"], reverse=True)[:limit],
+        "slowest_hosts": sorted(host_stats, key=lambda stats: stats["total"], reverse=True)[:limit],
+        "long_tail_tasks": sorted(
+            (stats for stats in task_stats if stats["hosts"] > 1),
+            key=lambda stats: stats["spread"], reverse=True
+        )[:limit],
+    }
+
+
+def write_profile_report(records_dir, report_path, limit=10):
+    """Aggregate the task times recorded by the playbooks, write them to the report file
+    and print a summary.
+
+    Arguments:
+        records_dir {string} -- The folder of the records files.
+        report_path {string} -- The path of the report file.
+        limit {int} -- The number of tasks and hosts to report. (default: {10})
+
+    Returns:
+        dict -- The report, None when no task time was recorded.
+    """
+
+    records = []
+    for records_path in sorted(glob.glob(path.join(records_dir, '*.json'))):
+        with open(records_path, 'r') as file_handler:
+            records.extend(json.load(file_handler))
+    if not records:
+        return None
+
+    report = get_profile_report(records, limit)
+    with open(report_path, 'w') as file_handler:
+        json.dump(report, file_handler, indent=2, sort_keys=True)
+
+    print("Slowest ansible tasks:")
+    for stats in report["slowest_tasks"]:
+        print("  %7.1fs  %s: %s (median %.1fs on %d hosts)" % (
+            stats["max"], stats["playbook"], stats["task"], stats["median"], stats["hosts"]))
+    print("Slowest ansible hosts:")
+    for stats in report["slowest_hosts"]:
+        print("  %7.1fs  %s (%d tasks)" % (stats["total"], stats["host"], stats["tasks"]))
+    print("Wrote the ansible task profile to %s" % report_path)
+    return report
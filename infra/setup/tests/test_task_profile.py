@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""Tests of the task_profile callback with the playbooks of an ansible session.
+
+Usage:
+    python -m unittest discover -s tests
+"""
+
+import imp
+import json
+import shutil
+import sys
+import tempfile
+import unittest
+from os import environ, path
+
+sys.path.insert(0, path.realpath(path.join(path.dirname(path.realpath(__file__)), '..')))
+
+from code_executor import CALLBACK_PLUGINS_PATH, TASK_PROFILE_DIR_ENV, AnsibleSession
+
+task_profile = imp.load_source('task_profile_callback', path.join(CALLBACK_PLUGINS_PATH, 'task_profile.py'))
+
+INVENTORY = """
+all:
+  hosts:
+    localhost:
+      ansible_connection: local
+      ansible_python_interpreter: %s
+"""
+
+PLAYBOOK = """
+- hosts: all
+  gather_facts: no
+  become: no
+  tasks:
+    - name: %s task
+      debug:
+        msg: %s
+"""
+
+
+class Named(object):
+    """A stand-in for the playbooks, tasks and hosts sent to the callback."""
+
+    def __init__(self, name, **kwargs):
+        self.name = name
+        self.__dict__.update(kwargs)
+
+    def get_name(self):
+        return self.name
+
+
+class TaskProfileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.inventory_path = path.join(self.work_dir, 'hosts.yml')
+        with open(self.inventory_path, 'w') as file_handler:
+            file_handler.write(INVENTORY % sys.executable)
+
+    def tearDown(self):
+        environ.pop(TASK_PROFILE_DIR_ENV, None)
+        shutil.rmtree(self.work_dir, True)
+
+    def write_playbook(self, name):
+        playbook_path = path.join(self.work_dir, name + '.yml')
+        with open(playbook_path, 'w') as file_handler:
+            file_handler.write(PLAYBOOK % (name, name))
+        return playbook_path
+
+    def test_records_every_playbook_of_a_run(self):
+        playbook_paths = [self.write_playbook('first'), self.write_playbook('second')]
+
+        session = AnsibleSession(self.inventory_path)
+        try:
+            self.assertEqual(session.run(playbook_paths), 0)
+        finally:
+            session.close()
+
+        for name in ('first', 'second'):
+            with open(path.join(session.profile_path, name + '.json')) as file_handler:
+                records = json.load(file_handler)
+            self.assertEqual([(r['playbook'], r['task'], r['host'], r['status']) for r in records],
+                             [(name, name + ' task', 'localhost', 'ok')])
+
+        with open(session.profile_path + '.json') as file_handler:
+            report = json.load(file_handler)
+        self.assertEqual(sorted(stats['playbook'] for stats in report['slowest_tasks']), ['first', 'second'])
+
+    def test_records_every_playbook_with_the_stats_sent_once(self):
+        environ[TASK_PROFILE_DIR_ENV] = path.join(self.work_dir, 'records')
+        callback = task_profile.CallbackModule()
+
+        for name in ('first', 'second'):
+            callback.v2_playbook_on_start(Named(name, _file_name=path.join(self.work_dir, name + '.yml')))
+            callback.v2_playbook_on_play_start(Named(name + ' play'))
+            task = Named(name + ' task', _uuid=name)
+            callback.v2_playbook_on_task_start(task, False)
+            callback.v2_runner_on_ok(Named(None, _task=task, _host=Named('localhost')))
+        callback.v2_playbook_on_stats(None)
+
+        for name in ('first', 'second'):
+            with open(path.join(self.work_dir, 'records', name + '.json')) as file_handler:
+                records = json.load(file_handler)
+            self.assertEqual([(r['playbook'], r['play'], r['task']) for r in records],
+                             [(name, name + ' play', name + ' task')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from os import getpid
+
+
+class Tracer(object):
+    """Collect timed spans and write them in the trace event format of Chrome, which the
+    trace viewer of Chrome (chrome://tracing) and Perfetto (ui.perfetto.dev) can open.
+    Every span is drawn on a track, by default the track of the thread that records it.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.tracks = {}
+        self.lock = threading.Lock()
+
+    def _get_track_id(self, track):
+        """Get the id of a track, allocating one the first time the track is used.
+
+        Arguments:
+            track {string} -- The name of the track, None for the track of the current thread.
+
+        Returns:
+            int -- The id of the track.
+        """
+
+        if track is None:
+            track = threading.current_thread().name
+        with self.lock:
+            if track not in self.tracks:
+                self.tracks[track] = len(self.tracks) + 1
+            return self.tracks[track]
+
+    def add_span(self, name, start, duration, track=None, **kwargs):
+        """Record a span that is over.
+
+        Arguments:
+            name {string} -- The name of the span.
+            start {float} -- The start of the span, as returned by time.time().
+            duration {float} -- The duration of the span in seconds.
+            track {string} -- The name of the track to draw the span on. (default: {None})
+            kwargs -- The metadata of the span, like host counts or exit codes.
+        """
+
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": int(start * 1e6),
+            "dur": int(duration * 1e6),
+            "pid": getpid(),
+            "tid": self._get_track_id(track),
+            "args": kwargs,
+        }
+        with self.lock:
+            self.events.append(event)
+
+    def begin(self, name, track=None, **kwargs):
+        """Start a span that ends with end().
+
+        Arguments:
+            name {string} -- The name of the span.
+            track {string} -- The name of the track to draw the span on. (default: {None})
+            kwargs -- The metadata of the span.
+
+        Returns:
+            dict -- The started span, to pass to end().
+        """
+
+        return {"name": name, "start": time.time(), "track": track, "args": kwargs}
+
+    def end(self, span, **kwargs):
+        """End a span started with begin().
+
+        Arguments:
+            span {dict} -- The span returned by begin().
+            kwargs -- More metadata of the span.
+        """
+
+        span["args"].update(kwargs)
+        self.add_span(span["name"], span["start"], time.time() - span["start"], span["track"],
+                      **span["args"])
+
+    @contextmanager
+    def span(self, name, track=None, **kwargs):
+        """Record a span around a block of code. The block can add metadata to the dictionary
+        it gets, for example the exit code of a command.
+
+        Arguments:
+            name {string} -- The name of the span.
+            track {string} -- The name of the track to draw the span on. (default: {None})
+            kwargs -- The metadata of the span.
+        """
+
+        span = self.begin(name, track, **kwargs)
+        try:
+            yield span["args"]
+        except BaseException, e:
+            self.end(span, error=repr(e))
+            raise
+        self.end(span)
+
+    def wrap(self, name, func, track=None, **kwargs):
+        """Wrap a function so that every call of it is recorded as a span.
+
+        Arguments:
+            name {string} -- The name of the span.
+            func {function} -- The function to wrap.
+            track {string} -- The name of the track to draw the span on. (default: {None})
+            kwargs -- The metadata of the span.
+
+        Returns:
+            function -- The wrapped function.
+        """
+
+        def traced(*args, **func_kwargs):
+            with self.span(name, track, **kwargs):
+                return func(*args, **func_kwargs)
+        return traced
+
+    def write(self, trace_path):
+        """Write the spans recorded so far to a trace file.
+
+        Arguments:
+            trace_path {string} -- The path of the trace file.
+        """
+
+        with self.lock:
+            events = list(self.events)
+            tracks = dict(self.tracks)
+
+        # Name the tracks after the threads or the names they were given.
+        for track, track_id in tracks.items():
+            events.append({
+                "name": "thread_name", "ph": "M", "pid": getpid(), "tid": track_id,
+                "args": {"name": track},
+            })
+
+        with open(trace_path, 'w') as file_handler:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file_handler)
+
+
+# The tracer of the process, shared by the modules of the setup.
+TRACER = Tracer()
+
+add_span = TRACER.add_span
+begin = TRACER.begin
+end = TRACER.end
+span = TRACER.span
+wrap = TRACER.wrap
+write_trace = TRACER.write